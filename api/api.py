@@ -19,7 +19,7 @@ from .handlers.userhandler              import UserHandler
 from .handlers.uidhandler               import UIDHandler
 from .master_subject_code.handlers      import MasterSubjectCodeHandler
 from .jobs.handlers                     import BatchHandler, JobsHandler, JobHandler, GearsHandler, GearHandler, RulesHandler, RuleHandler
-from .metrics.handler                   import MetricsHandler
+from .metrics.handler                   import MetricsHandler, ProfileHandler
 from .upload                            import Upload
 from .reports.handler                   import ReportHandler
 from .data_export.handlers              import DownloadHandler
@@ -162,6 +162,7 @@ endpoints = [
             route('/next',                          JobsHandler, h='next',                 m=['GET']),
             route('/stats',                         JobsHandler, h='stats',                m=['GET']),
             route('/reap',                          JobsHandler, h='reap_stale',           m=['POST']),
+            route('/reconcile',                     JobsHandler, h='reconcile_counters',   m=['POST']),
             route('/add',                           JobsHandler, h='add',                  m=['POST']),
             route('/determine_provider',            JobsHandler, h='determine_provider',   m=['POST']),
             route('/<:[^/]+>',                      JobHandler),
@@ -383,6 +384,7 @@ endpoints = [
 
         # Metrics
         route('/metrics', MetricsHandler, m=['GET']),
+        route('/profile', ProfileHandler, m=['GET']),
 
         # Data views
         route('/views/data', DataViewHandler, h='execute_adhoc', m=['POST']),
@@ -1,6 +1,7 @@
 import bson
 import datetime
 
+from . import authcache
 from .. import config, util
 from ..web.errors import APIAuthProviderException
 
@@ -33,10 +34,13 @@ class APIKey(object):
         """
         key = APIKey._preprocess_key(key)
 
-        timestamp = datetime.datetime.utcnow()
-        api_key = config.db.apikeys.find_one_and_update({'_id': key}, {'$set': {'last_used': timestamp}})
+        api_key = authcache.get('apikeys', key)
+        if api_key is None:
+            api_key = config.db.apikeys.find_one({'_id': key})
+            authcache.put('apikeys', key, api_key)
 
         if api_key:
+            authcache.touch('apikeys', key, 'last_used', datetime.datetime.utcnow())
 
             # Some api keys may have additional requirements that must be met
             try:
@@ -66,7 +70,7 @@ class APIKey(object):
         Generates API key, replaces existing API key if it exists
         """
         api_key = cls.generate_api_key(uid)
-        config.db.apikeys.delete_many({'origin.id': uid, 'type': cls.key_type})
+        cls.revoke(uid)
         config.db.apikeys.insert_one(api_key)
         return api_key['_id']
 
@@ -74,6 +78,7 @@ class APIKey(object):
     def revoke(cls, uid):
         """Remove all API keys associated to an entity"""
         config.db.apikeys.delete_many({'origin.id': uid, 'type': cls.key_type})
+        authcache.invalidate('apikeys', match=lambda k: k['origin']['id'] == uid and k['type'] == cls.key_type)
 
     @classmethod
     def get(cls, uid):
@@ -134,6 +139,9 @@ class JobApiKey(APIKey):
     @classmethod
     def remove(cls, job_id):
         config.db.apikeys.delete_many({'type': cls.key_type, 'job': str(job_id)})
+        # Job keys are only accepted while their job is running (see check), in every process
+        authcache.invalidate('apikeys', match=lambda k: k['type'] == cls.key_type and k.get('job') == str(job_id),
+                             local=True)
 
     @classmethod
     def check(cls, api_key):
@@ -0,0 +1,174 @@
+"""
+Per-process cache of authentication documents with write-behind last-used tracking.
+
+Every authenticated request used to read its api key, session token or device from the database
+and write back a last_used / last_seen timestamp. Instead, the documents are cached for a short
+time (core.auth_cache_ttl seconds) and the timestamps are recorded in memory and written in a
+single bulk write every core.auth_flush_interval seconds.
+
+Revoking or changing a credential invalidates it in the cache of the process that made the
+change and bumps the revision of its namespace, stored in the database. Every process checks the
+revisions at most every AUTH_CHECK_SECONDS and drops the namespaces whose revision changed, so a
+revoked credential stops working everywhere within that time.
+"""
+import atexit
+import collections
+import copy
+import threading
+import time
+
+import pymongo
+
+from .. import config
+
+log = config.log
+
+AUTH_CACHE_SIZE = 10000
+AUTH_CHECK_SECONDS = 1
+
+# (namespace, key) -> (expiry, document)
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+# namespace -> revision the cached documents were loaded under
+_revisions = None
+_revisions_checked = 0
+
+# (collection, _id, field) -> latest timestamp not yet written to the database
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def cache_ttl():
+    try:
+        return int(config.get_item('core', 'auth_cache_ttl'))
+    except KeyError:
+        return 0
+
+def flush_interval():
+    try:
+        return int(config.get_item('core', 'auth_flush_interval'))
+    except KeyError:
+        return 0
+
+
+def get_revisions():
+    doc = config.db.singletons.find_one({'_id': 'auth_revision'}) or {}
+    doc.pop('_id', None)
+    return doc
+
+def _check_revisions():
+    """Drop the namespaces invalidated by other processes, checking at most every AUTH_CHECK_SECONDS"""
+    global _revisions, _revisions_checked # pylint: disable=global-statement
+    now = time.time()
+    if _revisions is not None and now - _revisions_checked <= AUTH_CHECK_SECONDS:
+        return
+
+    revisions = get_revisions()
+    with _cache_lock:
+        if _revisions is not None:
+            changed = set(namespace for namespace in set(revisions) | set(_revisions)
+                          if revisions.get(namespace) != _revisions.get(namespace))
+            for namespace, key in list(_cache):
+                if namespace in changed:
+                    del _cache[(namespace, key)]
+        _revisions = revisions
+        _revisions_checked = now
+
+def get(namespace, key):
+    """
+    Return a copy of the cached document, or None if it is not cached or has expired.
+    """
+    _check_revisions()
+    with _cache_lock:
+        entry = _cache.get((namespace, key))
+        if entry is None:
+            return None
+        expiry, doc = entry
+        if expiry < time.time():
+            del _cache[(namespace, key)]
+            return None
+    return copy.deepcopy(doc)
+
+def put(namespace, key, doc):
+    ttl = cache_ttl()
+    if ttl <= 0 or doc is None:
+        return
+    with _cache_lock:
+        _cache.pop((namespace, key), None)
+        _cache[(namespace, key)] = (time.time() + ttl, copy.deepcopy(doc))
+        while len(_cache) > AUTH_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def invalidate(namespace, key=None, match=None, local=False):
+    """
+    Drop cached documents of a namespace: the one with the given key, those for which match(doc)
+    is true, or all of them if neither is given. Other processes drop the whole namespace on their
+    next revision check, unless local is set (for documents that are checked on every use anyway).
+    """
+    if not local:
+        config.db.singletons.update_one({'_id': 'auth_revision'}, {'$inc': {namespace: 1}}, upsert=True)
+    with _cache_lock:
+        for namespace_, key_ in list(_cache):
+            if namespace_ != namespace:
+                continue
+            if key is not None and key_ != key:
+                continue
+            if match is not None and not match(_cache[(namespace_, key_)][1]):
+                continue
+            del _cache[(namespace_, key_)]
+
+def clear():
+    global _revisions # pylint: disable=global-statement
+    with _cache_lock:
+        _cache.clear()
+        _revisions = None
+
+
+def touch(collection, _id, field, timestamp):
+    """
+    Record that a document was used at timestamp; the field is set on the next flush.
+    """
+    with _pending_lock:
+        pending_key = (collection, _id, field)
+        if _pending.get(pending_key) is None or _pending[pending_key] < timestamp:
+            _pending[pending_key] = timestamp
+
+def last_touched(collection, _id, field):
+    """
+    Return the latest timestamp recorded for a document that has not been written yet, if any.
+    """
+    with _pending_lock:
+        return _pending.get((collection, _id, field))
+
+def flush():
+    """
+    Write all recorded timestamps with one bulk write per collection. Timestamps only move
+    forward ($max), so flushes from several processes can interleave in any order.
+    """
+    global _last_flush # pylint: disable=global-statement
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.time()
+
+    operations = collections.defaultdict(list)
+    for (collection, _id, field), timestamp in pending.iteritems():
+        operations[collection].append(pymongo.UpdateOne({'_id': _id}, {'$max': {field: timestamp}}))
+
+    for collection, ops in operations.iteritems():
+        try:
+            config.db[collection].bulk_write(ops, ordered=False)
+        except Exception: # pylint: disable=broad-except
+            # Never fail a request (or shutdown) over usage timestamps
+            log.exception('Failed to write %d last used timestamps to %s', len(ops), collection)
+
+def flush_if_due():
+    if time.time() - _last_flush >= flush_interval() and _pending:
+        flush()
+
+atexit.register(flush)
+# Entries were cached with the previous core settings (TTL)
+config.on_section_change('core', lambda _: clear())
+# Session tokens were cached for the previous auth providers
+config.on_section_change('auth', lambda _: clear())
@@ -11,7 +11,7 @@ from xml.etree import ElementTree
 
 from .apikeys import APIKey
 from .. import config, util
-from ..dao import dbutil
+from ..dao import dbutil, userdirectory
 
 from ..web.errors import APIAuthProviderException, APIException, APIUnknownUserException, APIRefreshTokenException
 
@@ -67,6 +67,7 @@ class AuthProvider(object):
                 config.db.users.update_one({'_id': uid, 'avatars.gravatar': {'$ne': gravatar}},{'$set':{'avatars.gravatar': gravatar,'modified': timestamp}})
                 # If the user has no avatar set, use gravar
                 config.db.users.update_one({'_id': uid, 'avatar': {'$exists': False}}, {'$set':{'avatar': gravatar, 'modified': timestamp}})
+                userdirectory.invalidate(uid)
 
     def set_refresh_token_if_exists(self, uid, refresh_token):
         # Also check to make sure if refresh token is missing, that the user
@@ -280,6 +281,7 @@ class GoogleOAuthProvider(AuthProvider):
         config.db.users.update_one({'_id': uid, 'avatars.provider': {'$ne': provider_avatar}}, {'$set':{'avatars.provider': provider_avatar, 'modified': timestamp}})
         # If the user has no avatar set, mark their provider_avatar as their chosen avatar.
         config.db.users.update_one({'_id': uid, 'avatar': {'$exists': False}}, {'$set':{'avatar': provider_avatar, 'modified': timestamp}})
+        userdirectory.invalidate(uid)
 
 
 class WechatOAuthProvider(AuthProvider):
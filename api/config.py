@@ -1,15 +1,17 @@
 import os
+import collections
 import copy
 import json
 import logging
 import pymongo
 import datetime
+import tempfile
 import elasticsearch
 
 from flywheel_common import logging as flylogging
 
 from . import util
-from .dao.dbutil import try_replace_one, try_update_one
+from .dao.dbutil import try_update_one
 
 logging.basicConfig(
     format='%(asctime)s %(name)16.16s %(filename)24.24s %(lineno)5d:%(levelname)4.4s %(message)s',
@@ -24,6 +26,9 @@ logging.getLogger('scitran.api').addHandler(logging.StreamHandler())
 from .metrics.log_handler import MetricsLogHandler
 logging.getLogger().addHandler(MetricsLogHandler())
 
+# Records database command latency, in total and per request
+from .metrics.db_monitor import listener as db_command_listener
+
 # NOTE: Keep in sync with environment variables in sample.config file.
 DEFAULT_CONFIG = {
     'core': {
@@ -31,7 +36,13 @@ DEFAULT_CONFIG = {
         'log_level': 'info',
         'access_log_enabled': False,
         'drone_secret': None,
-        'signed_url_secret': 'secret'
+        'signed_url_secret': 'secret',
+        'auth_cache_ttl': 10,       # Seconds api keys, session tokens and devices are cached per process
+        'auth_flush_interval': 30,  # Seconds between writes of last used / last seen timestamps
+        'profile_slow_request_seconds': 0,  # Requests slower than this are profiled (0 disables)
+        'profile_path': os.path.join(tempfile.gettempdir(), 'core-profiles'),  # Where worker / slow request profiles are written
+        'gzip_level': 6,            # Response compression level, 1-9 (0 disables)
+        'gzip_min_size': 1024,      # Responses smaller than this (in bytes) are not compressed
     },
     'site': {
         'id': 'local',
@@ -46,7 +57,11 @@ DEFAULT_CONFIG = {
     },
     'queue': {
         'max_retries': 3,
-        'retry_on_fail': False
+        'retry_on_fail': False,
+        'heartbeat_timeout': 300,   # Seconds without a heartbeat after which a running job is orphaned
+        'max_jobs_per_ask': 100,
+        'fair_share': 'project',    # Tenant level pending jobs are fair-shared across: group, project or none
+        'fair_share_weights': {}    # Relative queue share of group or project ids, defaults to 1
     },
     'auth': {
         'google': {
@@ -158,7 +173,14 @@ def apply_runtime_features(config):
 # Create config for startup, will be merged with db config when db is available
 __config = apply_env_variables(copy.deepcopy(DEFAULT_CONFIG))
 __config_persisted = False
-__last_update = datetime.datetime.utcfromtimestamp(0)
+
+# The config document carries a version that is bumped on every change. Processes check the
+# version (a tiny read) at most every CONFIG_CHECK_SECONDS and reload the document only when it
+# changed, then notify the callbacks registered for the sections that differ.
+CONFIG_CHECK_SECONDS = 5
+__version = None
+__last_check = datetime.datetime.utcfromtimestamp(0)
+__section_callbacks = collections.defaultdict(list)
 
 if not os.path.exists(__config['persistent']['data_path']):
     os.makedirs(__config['persistent']['data_path'])
@@ -177,6 +199,7 @@ db = pymongo.MongoClient(
     connectTimeoutMS=__config['persistent']['db_connect_timeout'],
     serverSelectionTimeoutMS=__config['persistent']['db_server_selection_timeout'],
     connect=False, # Connect on first operation to avoid multi-threading related errors
+    event_listeners=[db_command_listener],
 ).get_default_database()
 log.debug(str(db))
 
@@ -186,6 +209,7 @@ log_db = pymongo.MongoClient(
     connectTimeoutMS=__config['persistent']['db_connect_timeout'],
     serverSelectionTimeoutMS=__config['persistent']['db_server_selection_timeout'],
     connect=False, # Connect on first operation to avoid multi-threading related errors
+    event_listeners=[db_command_listener],
 ).get_default_database()
 log.debug(str(log_db))
 
@@ -240,6 +264,9 @@ def initialize_db():
     db.analyses.create_index([('parent.type', 1), ('parent.id', 1)], **kwargs)
     db.jobs.create_index([('inputs.id', 1), ('inputs.type', 1)], **kwargs)
     db.jobs.create_index([('state', 1), ('now', 1), ('modified', 1)], **kwargs)
+    db.jobs.create_index([('state', 1), ('priority', -1), ('modified', 1)], **kwargs)
+    db.jobs.create_index([('state', 1), ('priority', -1), ('parents.group', 1), ('modified', 1)], **kwargs)
+    db.jobs.create_index([('state', 1), ('priority', -1), ('parents.project', 1), ('modified', 1)], **kwargs)
     db.jobs.create_index('related_container_ids', **kwargs)
     db.jobs.create_index('created', **kwargs)
     db.jobs.create_index('modified', **kwargs)
@@ -250,6 +277,8 @@ def initialize_db():
     db.jobs.create_index('compute_provider_id', **kwargs)
     db.gears.create_index('name', **kwargs)
     db.gears.create_index('gear.custom.flywheel.invalid', **kwargs)
+    db.job_log_chunks.create_index([('job', 1), ('seq', 1)], **kwargs)
+    db.job_counters.create_index([('state', 1), ('gear_id', 1), ('compute_provider_id', 1)], unique=True, **kwargs)
     db.batch.create_index('jobs', **kwargs)
     db.project_rules.create_index('project_id', **kwargs)
     db.data_views.create_index('parent', **kwargs)
@@ -289,8 +318,54 @@ def initialize_db():
                    {'$setOnInsert': {'created': now, 'modified': now, 'label': 'Unknown', 'permissions': [], 'editions': {}}},
                    upsert=True)
 
+def on_section_change(section, callback):
+    """
+    Register callback(section_config) to be called when a config section changed on reload.
+    """
+    __section_callbacks[section].append(callback)
+
+def get_config_version():
+    doc = db.singletons.find_one({'_id': 'config'}, {'version': 1})
+    return doc.get('version', 0) if doc else 0
+
+def bump_config_version():
+    """
+    Mark the config changed, so that every process reloads it on its next version check.
+    This process checks on its next get_config call.
+    """
+    global __last_check #pylint: disable=global-statement
+    db.singletons.update_one({'_id': 'config'}, {'$inc': {'version': 1}})
+    __last_check = datetime.datetime.utcfromtimestamp(0)
+
+def reload_if_changed():
+    """
+    Reload the config if its version changed since it was loaded. Returns True if it was reloaded.
+    """
+    global __config, __version #pylint: disable=global-statement
+    version = get_config_version()
+    if version == __version:
+        return False
+
+    log.debug('Reloading configuration version %s', version)
+    old_config = __config
+    __config = apply_runtime_features(db.singletons.find_one({'_id': 'config'}))
+    __version = version
+
+    for section, callbacks in __section_callbacks.items():
+        if old_config.get(section) != __config.get(section):
+            for callback in callbacks:
+                try:
+                    callback(__config.get(section))
+                except Exception: # pylint: disable=broad-except
+                    log.exception('Error handling change of config section %s', section)
+    return True
+
+def _persisted_fields(cfg):
+    """The part of a config document that tells if it changed (ie. without its bookkeeping fields)"""
+    return {key: value for key, value in cfg.iteritems() if key not in ('_id', 'created', 'modified', 'version')}
+
 def get_config():
-    global __last_update, __config, __config_persisted #pylint: disable=global-statement
+    global __last_check, __config, __config_persisted, __version #pylint: disable=global-statement
     now = datetime.datetime.utcnow()
     if not __config_persisted:
         initialize_db()
@@ -304,26 +379,38 @@ def get_config():
             __config = apply_env_variables(startup_config)
         else:
             __config['created'] = now
-        __config['modified'] = now
-
-        # Attempt to set the config object, ignoring duplicate key problems.
-        # This worker might have lost the race - in which case, be grateful about it.
-        #
-        # Ref:
-        # https://github.com/scitran/core/issues/212
-        # https://github.com/scitran/core/issues/844
-        _, success = try_replace_one(db, 'singletons', {'_id': 'config'}, __config, upsert=True)
-        if not success:
-            log.debug('Worker lost config upsert race; ignoring.')
+
+        if db_config is None or _persisted_fields(__config) != _persisted_fields(db_config):
+            __config['modified'] = now
+            update = {key: value for key, value in __config.iteritems() if key not in ('_id', 'version')}
+
+            # Other processes pick up the persisted config (with this process's env) as a change.
+            # The version is incremented in the same update, so that concurrent bumps are not lost.
+            # Ignore duplicate key problems: this worker might have lost the upsert race - in which
+            # case, be grateful about it.
+            #
+            # Ref:
+            # https://github.com/scitran/core/issues/212
+            # https://github.com/scitran/core/issues/844
+            try:
+                persisted = db.singletons.find_one_and_update(
+                    {'_id': 'config'}, {'$set': update, '$inc': {'version': 1}},
+                    projection={'version': 1}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+                __config['version'] = persisted['version']
+            except pymongo.errors.DuplicateKeyError:
+                log.debug('Worker lost config upsert race; ignoring.')
+                # Reload the winner's config on the next version check
+                __config['version'] = None
+        else:
+            __config['version'] = db_config.get('version', 0)
 
         __config = apply_runtime_features(__config)
         __config_persisted = True
-        __last_update = now
-    elif now - __last_update > datetime.timedelta(seconds=120):
-        log.debug('Refreshing configuration from database')
-        __config = db.singletons.find_one({'_id': 'config'})
-        __config = apply_runtime_features(__config)
-        __last_update = now
+        __version = __config['version']
+        __last_check = now
+    elif now - __last_check > datetime.timedelta(seconds=CONFIG_CHECK_SECONDS):
+        __last_check = now
+        reload_if_changed()
     return __config
 
 def get_public_config():
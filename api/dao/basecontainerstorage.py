@@ -8,6 +8,7 @@ from flywheel_common.errors import PermissionError
 from . import consistencychecker
 from . import containerutil
 from . import dbutil
+from . import userdirectory
 from .. import config
 from .. import util
 
@@ -34,6 +35,9 @@ CONTAINER_DEFAULTS.update({
     'info':         {}
 })
 
+# Maximum number of parent ids per query when walking the hierarchy top down
+TOP_DOWN_CHUNK_SIZE = 10000
+
 JOIN_ORIGIN_FIELDS = {
     'job': ('created', 'modified', 'gear_info', ),
     'device': ('name', ),
@@ -70,6 +74,16 @@ class ContainerStorage(object):
 
     @classmethod
     def get_top_down_hierarchy(cls, cont_name, cid, include_subjects=False):
+        return dict(cls.iter_top_down_hierarchy(cont_name, cid, include_subjects=include_subjects))
+
+    @classmethod
+    def iter_top_down_hierarchy(cls, cont_name, cid, include_subjects=False, chunk_size=TOP_DOWN_CHUNK_SIZE):
+        """
+        Yield (cont_name, ids) for the container and for each level below it, top down.
+
+        The children of a level are fetched with one $in query per chunk_size parents, so walking
+        the hierarchy takes O(depth) queries instead of one per parent.
+        """
         parent_to_child = {
             'groups': 'projects',
             'projects': 'sessions',
@@ -82,23 +96,23 @@ class ContainerStorage(object):
                 'subjects': 'sessions',
             })
 
-        parent_tree = {
-            cont_name: [cid]
-        }
+        yield cont_name, [cid]
         parent_name = cont_name
+        parent_ids = [ContainerStorage.factory(cont_name).format_id(cid)]
         while parent_to_child.get(parent_name):
-            # Parent storage
-            storage = ContainerStorage.factory(parent_name)
             child_name = parent_to_child[parent_name]
-            parent_tree[child_name] = []
+            parent_key = containerutil.singularize(parent_name)
+            dbc = config.db[child_name]
 
-            # For each parent id, find all of its children and add them to the list of child ids in the parent tree
-            for parent_id in parent_tree[parent_name]:
-                children = [cont['_id'] for cont in storage.get_children(parent_id, projection={'_id':1}, include_subjects=include_subjects)]
-                parent_tree[child_name].extend(children)
+            # No queries once a level is empty
+            child_ids = []
+            for i in range(0, len(parent_ids), chunk_size):
+                query = {parent_key: {'$in': parent_ids[i:i + chunk_size]}, 'deleted': {'$exists': False}}
+                child_ids.extend(cont['_id'] for cont in dbc.find(query, {'_id': 1}))
+            yield child_name, child_ids
 
             parent_name = child_name
-        return parent_tree
+            parent_ids = child_ids
 
     @classmethod
     def filter_container_files(cls, cont):
@@ -155,13 +169,74 @@ class ContainerStorage(object):
 
 
     def get_parent_tree(self, _id, cont=None, projection=None, add_self=False):
+        if not cont:
+            cont = self.get_container(_id, projection=projection)
+
+        return self.get_parent_trees([cont], projection=projection, add_self=add_self)[0]
+
+    def get_parent_trees(self, conts, projection=None, add_self=False):
+        """
+        Return the parent tree of each of the given containers of this storage, as a list of lists.
+
+        Each tree lists the container's ancestors bottom up (preceded by the container itself if add_self
+        is set), each with its cont_type. Ancestors are looked up by the containers' `parents` map, with
+        one query per ancestor level for all of the containers.
+        """
+        ancestor_types = []
+        storage = self
+        while storage.parent_cont_name:
+            ancestor_types.append(containerutil.singularize(storage.parent_cont_name))
+            storage = ContainerStorage.factory(storage.parent_cont_name)
+
+        if any('parents' not in cont for cont in conts) or not ancestor_types:
+            # Not in the hierarchy, or the parents map is not available
+            return [self._walk_parent_tree(cont, projection=projection, add_self=add_self) for cont in conts]
+
+        # (cont_type, _id) -> ancestor
+        ancestors = {}
+        for cont_type in ancestor_types:
+            ids = list(set(cont['parents'][cont_type] for cont in conts if cont['parents'].get(cont_type)))
+            if not ids:
+                continue
+            storage = ContainerStorage.factory(cont_type)
+            for ancestor in storage.dbc.find({'_id': {'$in': ids}, 'deleted': {'$exists': False}}, projection):
+                storage._from_mongo(ancestor)  # pylint: disable=protected-access
+                storage.filter_container_files(ancestor)
+                ancestor['cont_type'] = storage.cont_name
+                ancestors[(cont_type, ancestor['_id'])] = ancestor
+
+        trees = []
+        for cont in conts:
+            tree = []
+            if add_self:
+                cont['cont_type'] = self.cont_name
+                tree.append(cont)
+            # Walk up the hierarchy until we reach the top or a missing parent
+            for cont_type in ancestor_types:
+                ancestor = ancestors.get((cont_type, cont['parents'].get(cont_type)))
+                if ancestor is None:
+                    break
+                tree.append(copy.copy(ancestor))
+            trees.append(tree)
+
+        # Sessions are returned with their subject joined
+        for tree in trees:
+            for i, ancestor in enumerate(tree):
+                if add_self and i == 0:
+                    continue
+                if ancestor['cont_type'] == 'sessions' and 'subject' in ancestor:
+                    subject = copy.deepcopy(tree[i + 1]) if i + 1 < len(tree) else {}
+                    if ancestor.get('age'):
+                        subject['age'] = ancestor['age']
+                    ancestor['subject'] = subject
+
+        return trees
+
+    def _walk_parent_tree(self, cont, projection=None, add_self=False):
         parents = []
 
         curr_storage = self
 
-        if not cont:
-            cont = self.get_container(_id, projection=projection)
-
         if add_self:
             # Add the referenced container to the list
             cont['cont_type'] = self.cont_name
@@ -285,6 +360,8 @@ class ContainerStorage(object):
             result = self.dbc.insert_one(payload)
         except pymongo.errors.DuplicateKeyError:
             raise APIConflictException('Object with id {} already exists.'.format(payload['_id']))
+        if self.cont_name in containerutil.PLURAL_CONT_TYPES:
+            containerutil.index_containers(self.cont_name, [result.inserted_id])
         return result
 
     def update_el(self, _id, payload, unset_payload=None, recursive=False, r_payload=None, replace_metadata=False):
@@ -344,6 +421,8 @@ class ContainerStorage(object):
         self.cleanup_ancillary_data(_id)
         if self.use_delete_tag:
             return self.dbc.update_one({'_id': _id}, {'$set': {'deleted': datetime.datetime.utcnow()}})
+        if self.cont_name in containerutil.PLURAL_CONT_TYPES:
+            containerutil.unindex_container(_id)
         return self.dbc.delete_one({'_id':_id})
 
     def cleanup_ancillary_data(self, _id):
@@ -467,10 +546,12 @@ class ContainerStorage(object):
         Given a list of containers, adds avatar and name context to each member of the permissions and notes lists
         """
 
-        # Get list of all users, hash by uid
-        # TODO: This is not an efficient solution if there are hundreds of inactive users
-        users_list = ContainerStorage.factory('users').get_all_el({}, None, None)
-        users = {user['_id']: user for user in users_list}
+        # Get the referenced users only, by uid
+        uids = set()
+        for container in containers:
+            for item in container.get('permissions', []) + container.get('notes', []):
+                uids.add(item.get('user', item['_id']))
+        users = userdirectory.get_users(uids)
 
         for container in containers:
             permissions = container.get('permissions', [])
@@ -541,7 +622,14 @@ class ContainerStorage(object):
             query = {'_id': {'$in': list(ids)}}
             results_map = fetch_results[container_type]
 
-            for join_doc in config.db[collection_name].find(query, projection):
+            if container_type == 'user' and not all_fields:
+                # Names are in the user directory
+                join_docs = [{key: value for key, value in user.iteritems() if key in ('_id',) + projection}
+                             for user in userdirectory.get_users(ids).itervalues()]
+            else:
+                join_docs = config.db[collection_name].find(query, projection)
+
+            for join_doc in join_docs:
                 if set_gear_name and container_type == 'job':
                     # Alias job.gear_info.name as job.gear_name until UI starts using gear_info.name directly
                     join_doc['gear_name'] = join_doc.get('gear_info', {}).get('name')
@@ -1,9 +1,11 @@
 import datetime
 import bson
 import copy
+import pymongo
 
 from . import containerutil
 from . import hierarchy
+from . import userdirectory
 from .. import config
 from .. import util
 
@@ -47,13 +49,16 @@ class GroupStorage(ContainerStorage):
         self._to_mongo(payload)
 
         # Groups do not need ad-hoc check and do not call Super
-        return self.dbc.update_one(
+        result = self.dbc.update_one(
             {'_id': payload['_id']},
             {
                 '$set': payload,
                 '$setOnInsert': {'permissions': permissions, 'created': created}
             },
             upsert=True)
+        if result.upserted_id is not None:
+            containerutil.index_containers(self.cont_name, [result.upserted_id])
+        return result
 
     def cleanup_ancillary_data(self, _id):
         safe_cleanup_views(_id)
@@ -67,6 +72,16 @@ class UserStorage(ContainerStorage):
     def __init__(self):
         super(UserStorage,self).__init__('users', use_object_id=False)
 
+    def update_el(self, _id, payload, unset_payload=None, recursive=False, r_payload=None, replace_metadata=False):
+        result = super(UserStorage, self).update_el(_id, payload, unset_payload=unset_payload, recursive=recursive, r_payload=r_payload, replace_metadata=replace_metadata)
+        userdirectory.invalidate(_id)
+        return result
+
+    def delete_el(self, _id):
+        result = super(UserStorage, self).delete_el(_id)
+        userdirectory.invalidate(_id)
+        return result
+
     def cleanup_ancillary_data(self, _id):
         safe_cleanup_views(_id)
         self.cleanup_user_permissions(_id)
@@ -453,24 +468,15 @@ class AnalysisStorage(ContainerStorage):
         return analyses
 
 
-    # pylint: disable=arguments-differ
-    def create_el(self, analysis, parent_type, parent_id, origin, uid=None):
+    def _fill_analysis(self, analysis, parent_type, parent, origin):
         """
-        Create an analysis.
-        * Fill defaults if not provided
-        * Flatten input filerefs using `FileReference.get_file()`
-        If `analysis` has a `job` key, create a "job-based" analysis:
-            * Analysis inputs will be copied from the job inputs
-            * Create analysis and job, both referencing each other
-            * Do not create (remove) analysis if can't enqueue job
+        Fill analysis defaults and flatten its input filerefs, popping and returning its job (if any).
         """
-        parent_type = containerutil.singularize(parent_type)
-        parent = self.get_parent(None, cont={'parent': {'type': parent_type, 'id': parent_id}})
         defaults = {
             '_id': bson.ObjectId(),
             'parent': {
                 'type': parent_type,
-                'id': bson.ObjectId(parent_id)
+                'id': bson.ObjectId(parent['_id'])
             },
             'created': datetime.datetime.utcnow(),
             'modified': datetime.datetime.utcnow(),
@@ -503,17 +509,103 @@ class AnalysisStorage(ContainerStorage):
         if analysis.get('info') is not None:
             analysis['info'] = util.mongo_sanitize_fields(analysis['info'])
 
+        return job
+
+    @staticmethod
+    def _prepare_analysis_job(job, analysis_id):
+        job['destination'] = {'type': 'analysis', 'id': str(analysis_id)}
+        tags = job.get('tags', [])
+        if 'analysis' not in tags:
+            tags.append('analysis')
+            job['tags'] = tags
+        return job
+
+    def create_job_analyses(self, analyses, parent_type, origin):
+        """
+        Bulk counterpart of `create_el` for job-based analyses, used to launch batches.
+
+        `analyses` is a list of (analysis, parent_id) pairs, each analysis having a `job` key.
+        Parents are read with one query, the analyses and their jobs are inserted with one
+        insert_many each and the analyses are pointed to their jobs with one bulk write.
+        If any job can not be enqueued, the analyses are removed and the error is raised.
+
+        Returns the inserted jobs.
+        """
+        parent_type = containerutil.singularize(parent_type)
+        parent_storage = ContainerStorage.factory(parent_type)
+        parent_ids = list(set(bson.ObjectId(parent_id) for _, parent_id in analyses))
+        parents = {
+            parent['_id']: parent for parent in
+            parent_storage.dbc.find({'_id': {'$in': parent_ids}, 'deleted': {'$exists': False}},
+                                    {'parents': 1, 'public': 1})
+        }
+
+        job_maps = []
+        checked_projects = set()
+        for analysis, parent_id in analyses:
+            parent = parents.get(bson.ObjectId(parent_id))
+            if parent is None:
+                raise APINotFoundException('Could not find {} {}'.format(parent_storage.cont_name, parent_id))
+            job_maps.append(self._fill_analysis(analysis, parent_type, parent, origin))
+            analysis['parents'] = dict(parent.get('parents', {}), **{parent_type: parent['_id']})
+
+            # Ad hoc creation rules are the same for every analysis of a project
+            project_id = analysis['parents'].get('project')
+            if project_id not in checked_projects:
+                self.check_adhoc(analysis, origin)
+                checked_projects.add(project_id)
+
+        if not analyses:
+            return []
+
+        result = self.dbc.insert_many([analysis for analysis, _ in analyses], ordered=False)
+        if len(result.inserted_ids) != len(analyses):
+            raise APIStorageException('Analyses not created for {} {}s'.format(len(analyses), parent_type))
+
+        try:
+            jobs = []
+            for (analysis, _), job_map in zip(analyses, job_maps):
+                job = Queue.enqueue_job(self._prepare_analysis_job(job_map, analysis['_id']), origin)
+                jobs.append(job)
+
+            Job.insert_many(jobs)
+        except:
+            # NOTE #775 remove unusable analyses - until jobs have a 'hold' state
+            self.dbc.delete_many({'_id': {'$in': [analysis['_id'] for analysis, _ in analyses]}})
+            raise
+
+        updates = []
+        for (analysis, _), job in zip(analyses, jobs):
+            gear_info = job.gear_info.copy()
+            gear_info['id'] = job.gear_id
+            updates.append(pymongo.UpdateOne({'_id': analysis['_id']},
+                                             {'$set': {'job': job.id_, 'gear_info': gear_info}}))
+        self.dbc.bulk_write(updates, ordered=False)
+
+        return jobs
+
+    # pylint: disable=arguments-differ
+    def create_el(self, analysis, parent_type, parent_id, origin, uid=None):
+        """
+        Create an analysis.
+        * Fill defaults if not provided
+        * Flatten input filerefs using `FileReference.get_file()`
+        If `analysis` has a `job` key, create a "job-based" analysis:
+            * Analysis inputs will be copied from the job inputs
+            * Create analysis and job, both referencing each other
+            * Do not create (remove) analysis if can't enqueue job
+        """
+        parent_type = containerutil.singularize(parent_type)
+        parent = self.get_parent(None, cont={'parent': {'type': parent_type, 'id': parent_id}})
+        job = self._fill_analysis(analysis, parent_type, parent, origin)
+
         result = super(AnalysisStorage, self).create_el(analysis, origin)
         if not result.acknowledged:
             raise APIStorageException('Analysis not created for container {} {}'.format(parent_type, parent_id))
 
         if job is not None:
             # Create job
-            job['destination'] = {'type': 'analysis', 'id': str(analysis['_id'])}
-            tags = job.get('tags', [])
-            if 'analysis' not in tags:
-                tags.append('analysis')
-                job['tags'] = tags
+            self._prepare_analysis_job(job, analysis['_id'])
 
             try:
                 job = Queue.enqueue_job(job, origin, perm_check_uid=uid)
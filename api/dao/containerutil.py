@@ -1,6 +1,7 @@
 import bson.objectid
 import copy
 import json
+import pymongo
 import requests
 
 from .. import config
@@ -51,6 +52,9 @@ PARENT_FROM_CHILD = {c: CONTAINER_HIERARCHY[ind]   for ind, c in enumerate(CONTA
 
 NON_OBJECT_ID_COLLECTIONS = ['groups', 'users']
 
+# Collection of {_id: container id, type: container collection name} documents
+CONTAINER_INDEX = 'container_index'
+
 def propagate_changes(cont_name, cont_id, query, update, include_refs=False):
     """
     Propagates changes through the hierarcy from the bottom to the current cont_name level, iteratively.
@@ -433,9 +437,65 @@ def create_containerreference_from_dictionary(d):
 def create_containerreference_from_filereference(fr):
     return ContainerReference.from_filereference(fr)
 
+def index_containers(coll_name, ids):
+    """Record that the containers with the given ids are in the container collection coll_name"""
+    if not ids:
+        return
+    try:
+        config.db[CONTAINER_INDEX].insert_many([{'_id': _id, 'type': coll_name} for _id in ids], ordered=False)
+    except (pymongo.errors.BulkWriteError, pymongo.errors.DuplicateKeyError):
+        # Indexed concurrently; ids never change collections
+        pass
+
+def unindex_container(_id):
+    config.db[CONTAINER_INDEX].delete_one({'_id': _id})
+
+def container_types(ids, collections=PLURAL_CONT_TYPES):
+    """Return a dict of id -> collection name for the containers with the given ids.
+
+    Ids are looked up in the container index with one query. Containers not indexed yet (created
+    before the index, or other than through ContainerStorage) are searched for with one query per
+    collection and indexed. Ids not found in the given collections are left out.
+
+    Args:
+        ids (list): The container ids (ObjectIds, or strings for groups)
+        collections (list, optional): The collections to look in, by default all of the containers in CONT_TYPES
+
+    Returns:
+        dict: A dict of id -> collection name
+    """
+    ids = list(set(ids))
+    types = {}
+    indexed = set()
+    for entry in config.db[CONTAINER_INDEX].find({'_id': {'$in': ids}}):
+        indexed.add(entry['_id'])
+        if entry['type'] in collections:
+            types[entry['_id']] = entry['type']
+
+    missing = [_id for _id in ids if _id not in indexed]
+    for coll_name in collections:
+        if not missing:
+            break
+        if coll_name not in PLURAL_CONT_TYPES:
+            continue
+        object_id = coll_name not in NON_OBJECT_ID_COLLECTIONS
+        search_ids = [_id for _id in missing if isinstance(_id, bson.ObjectId) == object_id]
+        if not search_ids:
+            continue
+        found = [cont['_id'] for cont in config.db[coll_name].find({'_id': {'$in': search_ids}}, {'_id': 1})]
+        index_containers(coll_name, found)
+        for _id in found:
+            types[_id] = coll_name
+        missing = [_id for _id in missing if _id not in types]
+
+    return types
+
 def container_search(query, projection=None, collections=PLURAL_CONT_TYPES, early_return=True, **kwargs):
     """ Perform search across multiple collections.
 
+    Queries by a single _id only search the container collection that holds the id (according to
+    the container index, see container_types), and the non-container collections (eg. users).
+
     Args:
         query (dict): The filter specifying elements which must be present for a document to be included in the result set.
         projection (dict, optional): A list of field names that should be returned in the result set, or a dict specifying fields to include or exclude.
@@ -456,8 +516,20 @@ def container_search(query, projection=None, collections=PLURAL_CONT_TYPES, earl
         else:
             bson_query = None
 
+    # Container collections that may hold the id, if searching by id
+    id_collections = None
+    if query.get('_id') and not isinstance(query['_id'], (dict, list)):
+        types = {}
+        if bson_query:
+            types = container_types([bson_query['_id']], collections=collections)
+        if not types and not isinstance(query['_id'], bson.ObjectId):
+            # Not an ObjectId, or a group id that looks like one
+            types = container_types([query['_id']], collections=collections)
+        id_collections = set(types.values())
 
     for coll_name in collections:
+        if id_collections is not None and coll_name in PLURAL_CONT_TYPES and coll_name not in id_collections:
+            continue
         coll = config.db.get_collection(coll_name)
         coll_results = []
         if coll_name in NON_OBJECT_ID_COLLECTIONS and query.get('_id'):
@@ -5,6 +5,7 @@ import time
 
 import pymongo
 
+from .. import util
 from ..web.errors import APIStorageException
 
 
@@ -62,17 +63,35 @@ class PaginationError(Exception):
     pass
 
 
-def paginate_find(collection, find_kwargs, pagination):
+def paginate_find(collection, find_kwargs, pagination, stream=False):
     """Return paginated `db.coll.find()` results.
 
+    The page holds the results and, unless `total` is false in pagination, the total number of
+    matching documents. With `cursor` in pagination, results are paged by keyset instead (see
+    _keyset_sort) and the page holds the `next_cursor` if there are more results.
+
+    If stream is set, results is the cursor itself instead of a list (lists for cursor pages).
+
     Raises PaginationError if the query is incompatible with the pagination:
      * `sort` in find_kwargs and `after_id` in pagination
+     * `cursor` and `after_id` or `skip` in pagination
+     * `cursor` from another sort
     """
 
     if 'filter' in find_kwargs:
         find_kwargs['filter'] = _append_parents(find_kwargs['filter'])
 
+    keyset = pagination and 'cursor' in pagination
+    count_filter = None
     if pagination:
+        if keyset:
+            if 'after_id' in pagination or 'skip' in pagination:
+                raise PaginationError('pagination "cursor" does not support "after_id" or "skip"')
+            cursor = pagination.pop('cursor')
+            if cursor:
+                pagination['sort'] = cursor['sort']
+            cursor_sort = pagination.get('sort', [])
+
         if 'after_id' in pagination:
             if find_kwargs.get('sort'):
                 raise PaginationError('pagination "after_id" does not support sorting')
@@ -89,9 +108,7 @@ def paginate_find(collection, find_kwargs, pagination):
             find_kwargs.setdefault('filter', parsed_filter)
 
         if 'sort' in pagination:
-            sort = find_kwargs.get('sort', [])
-            if isinstance(sort, basestring):
-                sort = [(sort, pymongo.ASCENDING)]
+            sort = _sort_list(find_kwargs.get('sort', []))
             sort.extend(pagination['sort'])
             find_kwargs['sort'] = sort
 
@@ -101,13 +118,102 @@ def paginate_find(collection, find_kwargs, pagination):
         if 'limit' in pagination:
             find_kwargs['limit'] = pagination['limit']
 
+        if keyset:
+            find_kwargs['sort'] = sort = _keyset_sort(find_kwargs.get('sort', []))
+            find_kwargs['projection'] = _keyset_projection(find_kwargs.get('projection'), sort)
+            if cursor:
+                count_filter = find_kwargs.get('filter', {})
+                find_kwargs['filter'] = _and_filter(count_filter, _after_filter(sort, cursor['after']))
+            if 'limit' in pagination:
+                # One more to tell whether there is a next page
+                find_kwargs['limit'] = pagination['limit'] + 1
+
     results = collection.find(**find_kwargs)
-    page = {
-        'total': results.count(),  # count ignores limit and skip by default
-        'results': list(results),
-    }
+    page = {}
+    if not pagination or pagination.get('total', True):
+        if count_filter is None:
+            page['total'] = results.count()  # count ignores limit and skip by default
+        else:
+            page['total'] = collection.count(count_filter)
+
+    if keyset:
+        page['results'], page['next_cursor'] = _keyset_page(list(results), pagination.get('limit'), sort, cursor_sort)
+    else:
+        page['results'] = results if stream else list(results)
     return page
 
+def _sort_list(sort):
+    if isinstance(sort, basestring):
+        return [(sort, pymongo.ASCENDING)]
+    return list(sort)
+
+def _keyset_sort(sort):
+    """
+    Return the sort of a keyset (cursor) pagination: the given sort, made a total order by _id.
+
+    The page after a cursor holds the documents that sort after the sort values of the last
+    document of the previous page, which is an index range scan on the sort keys instead of
+    counting and skipping all of the documents before the page.
+    """
+    sort = _sort_list(sort)
+    if '_id' not in [key for key, _ in sort]:
+        sort.append(('_id', pymongo.ASCENDING))
+    return sort
+
+def _keyset_projection(projection, sort):
+    """Return projection, including the sort keys if it is an inclusion projection"""
+    if not projection or not all(projection.values()):
+        return projection
+    projection = dict(projection)
+    projection.update((key, 1) for key, _ in sort)
+    return projection
+
+def _after_filter(sort, after):
+    """
+    Return the filter of the documents that sort after the given values.
+
+    Null and missing values sort before all others, so they follow the last non-null value of a
+    descending key and precede the first non-null value of an ascending one. Range queries only
+    match values of the same type, so the non-null values of each sort key are expected to have
+    one type (as the sortable fields of the API do).
+    """
+    if len(after) != len(sort):
+        raise PaginationError('pagination "cursor" is from another sort')
+    clauses = []
+    for i, (key, order) in enumerate(sort):
+        clause = {prev_key: value for (prev_key, _), value in zip(sort[:i], after[:i])}
+        if after[i] is None:
+            if order != pymongo.ASCENDING:
+                continue
+            clause[key] = {'$exists': True, '$ne': None}
+        elif order == pymongo.ASCENDING:
+            clause[key] = {'$gt': after[i]}
+        else:
+            before = {'$or': [{key: {'$lt': after[i]}}, {key: None}]}
+            clause = {'$and': [clause, before]} if clause else before
+        clauses.append(clause)
+    return {'$or': clauses}
+
+def _and_filter(filter_, other):
+    if not filter_:
+        return other
+    return {'$and': [filter_, other]}
+
+def _get_field(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+def _keyset_page(results, limit, sort, cursor_sort):
+    """Return the page of results (queried with limit + 1) and the cursor of the next page, if any"""
+    if limit is None or len(results) <= limit:
+        return results, None
+    results = results[:limit]
+    after = [_get_field(results[-1], key) for key, _ in sort]
+    return results, util.encode_pagination_cursor(cursor_sort, after)
+
 def _append_parents(filter_):
     """
         Processes the filter dictionary to pull container filters out of the
@@ -134,10 +240,22 @@ def _append_parents(filter_):
 def paginate_pipe(collection, pipeline, pagination):
     """Return paginated `db.coll.aggregate()` results.
 
+    The page is structured like the one of paginate_find.
+
     Raises PaginationError if the query is incompatible with the pagination:
      * any pipeline stage is `$sort` and `after_id` in pagination
-     * pagination skip used without limit
+     * pagination skip used without limit (unless total is false)
+     * `cursor` and `after_id` or `skip` in pagination
+     * `cursor` from another sort
     """
+    keyset = pagination and 'cursor' in pagination
+    if keyset:
+        if 'after_id' in pagination or 'skip' in pagination:
+            raise PaginationError('pagination "cursor" does not support "after_id" or "skip"')
+        cursor = pagination.pop('cursor')
+        cursor_sort = cursor['sort'] if cursor else pagination.get('sort', [])
+        pagination['sort'] = _keyset_sort(cursor_sort)
+
     if pagination:
         if 'after_id' in pagination:
             if any('$sort' in stage for stage in pipeline):
@@ -156,8 +274,35 @@ def paginate_pipe(collection, pipeline, pagination):
         if 'filter' in pagination:
             pipeline.append({'$match': pagination['filter']})
 
-        if 'sort' in pagination:
-            pipeline.append({'$sort': collections.OrderedDict(pagination['sort'])})
+    if keyset:
+        # Cursors hold the sort before pipe_key, values are read with the pipe's keys
+        sort = pagination['sort']
+        count_pipeline = list(pipeline)
+        if cursor:
+            pipeline.append({'$match': _after_filter(sort, cursor['after'])})
+        pipeline.append({'$sort': collections.OrderedDict(sort)})
+        if 'limit' in pagination:
+            # One more to tell whether there is a next page
+            pipeline.append({'$limit': pagination['limit'] + 1})
+
+        page = {}
+        if pagination.get('total', True):
+            count_pipeline.append({'$group': {'_id': None, 'total': {'$sum': 1}}})
+            page['total'] = next(collection.aggregate(count_pipeline), {'total': 0})['total']
+        results = list(collection.aggregate(pipeline))
+        page['results'], page['next_cursor'] = _keyset_page(results, pagination.get('limit'), sort, cursor_sort)
+        return page
+
+    if pagination and 'sort' in pagination:
+        pipeline.append({'$sort': collections.OrderedDict(pagination['sort'])})
+
+    if pagination and not pagination.get('total', True):
+        # Without the total, results are skipped and limited instead of sliced from one document
+        if 'skip' in pagination:
+            pipeline.append({'$skip': pagination['skip']})
+        if 'limit' in pagination:
+            pipeline.append({'$limit': pagination['limit']})
+        return {'results': list(collection.aggregate(pipeline))}
 
     pipeline.append({'$group': {'_id': None, 'total': {'$sum': 1}, 'results': {'$push': '$$ROOT'}}})
 
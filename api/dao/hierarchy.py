@@ -6,6 +6,8 @@ import difflib
 import pymongo
 import pymongo.errors
 import re
+import threading
+import time
 
 from .. import util
 from .. import config
@@ -40,6 +42,94 @@ def get_container(cont_name, _id):
         '_id': _id,
     })
 
+# Ancestors of each container level, bottom up
+ANCESTOR_TYPES = {
+    'acquisition':  ['session', 'subject', 'project', 'group'],
+    'session':      ['subject', 'project', 'group'],
+    'subject':      ['project', 'group'],
+    'project':      ['group'],
+    'group':        [],
+}
+
+# Ancestor containers are cached briefly: access logging resolves the same few trees over and over
+# (eg. for every file downloaded from a session)
+ANCESTOR_CACHE_SECONDS = 10
+ANCESTOR_CACHE_SIZE = 10000
+_ancestor_cache = {}
+_ancestor_cache_lock = threading.Lock()
+
+
+def _get_ancestors(cont_name, ids):
+    """
+    Return a dict of _id -> container of the given type, reading those not in the cache in one query.
+    """
+    now = time.time()
+    result = {}
+    with _ancestor_cache_lock:
+        for _id in ids:
+            entry = _ancestor_cache.get((cont_name, _id))
+            if entry is not None and entry[0] > now:
+                result[_id] = copy.deepcopy(entry[1])
+
+    missing = [_id for _id in ids if _id not in result]
+    if missing:
+        found = list(config.db[containerutil.pluralize(cont_name)].find({'_id': {'$in': missing}}))
+        with _ancestor_cache_lock:
+            if len(_ancestor_cache) + len(found) > ANCESTOR_CACHE_SIZE:
+                _ancestor_cache.clear()
+            for cont in found:
+                _ancestor_cache[(cont_name, cont['_id'])] = (now + ANCESTOR_CACHE_SECONDS, copy.deepcopy(cont))
+                result[cont['_id']] = cont
+    return result
+
+def clear_ancestor_cache():
+    with _ancestor_cache_lock:
+        _ancestor_cache.clear()
+
+def get_parent_trees(cont_name, ids):
+    """
+    Given a container type and a list of ids, returns a dict of id -> that container and its parent tree
+    (see get_parent_tree).
+
+    The containers are read with one query, and their ancestors (from their `parents` maps) with at most
+    one query per level. Containers that do not exist, or whose session, subject or project do not exist,
+    are left out.
+    """
+    cont_name = containerutil.singularize(cont_name)
+
+    if cont_name not in ['acquisition', 'session', 'subject', 'project', 'group', 'analysis']:
+        raise ValueError('Can only construct tree from group, project, subject, session, analysis or acquisition level')
+
+    if cont_name != 'group':
+        ids = [bson.ObjectId(_id) for _id in ids]
+    conts = list(config.db[containerutil.pluralize(cont_name)].find({'_id': {'$in': ids}}))
+
+    def ancestor_types(cont):
+        if cont_name != 'analysis':
+            return ANCESTOR_TYPES[cont_name]
+        # Analyses only report the tree of session level parents
+        if cont['parent']['type'] == 'session':
+            return ['session'] + ANCESTOR_TYPES['session']
+        return []
+
+    ancestors = {}
+    for level in ['session', 'subject', 'project', 'group']:
+        level_ids = list(set(cont.get('parents', {}).get(level) for cont in conts
+                             if level in ancestor_types(cont)) - {None})
+        ancestors[level] = _get_ancestors(level, level_ids) if level_ids else {}
+
+    trees = {}
+    for cont in conts:
+        tree = {cont_name: cont}
+        for level in ancestor_types(cont):
+            ancestor = ancestors[level].get(cont.get('parents', {}).get(level))
+            if ancestor is None and level != 'group':
+                break
+            tree[level] = ancestor
+        else:
+            trees[cont['_id']] = tree
+    return trees
+
 def get_parent_tree(cont_name, _id):
     """
     Given a contanier and an id, returns that container and its parent tree.
@@ -51,64 +141,13 @@ def get_parent_tree(cont_name, _id):
         'group':    <group>
     }
     """
-
     cont_name = containerutil.singularize(cont_name)
-
-    if cont_name not in ['acquisition', 'session', 'subject', 'project', 'group', 'analysis']:
-        raise ValueError('Can only construct tree from group, project, subject, session, analysis or acquisition level')
-
-    analysis_id     = None
-    acquisition_id  = None
-    session_id      = None
-    subject_id      = None
-    project_id      = None
-    group_id        = None
-    tree            = {}
-
-    if cont_name == 'analysis':
-        analysis_id = bson.ObjectId(_id)
-        analysis = get_container('analysis', analysis_id)
-        tree['analysis'] = analysis
-        if analysis is None:
-            raise APIStorageException('Analysis {} does not exist'.format(analysis_id))
-        if analysis['parent']['type'] == 'session':
-            session_id = analysis['parent']['id']
-    if cont_name == 'acquisition':
-        acquisition_id = bson.ObjectId(_id)
-        acquisition = get_container('acquisition', acquisition_id)
-        tree['acquisition'] = acquisition
-        if acquisition is None:
-            raise APIStorageException('Acquisition {} does not exist'.format(acquisition_id))
-        session_id = acquisition['session']
-    if cont_name == 'session' or session_id:
-        if not session_id:
-            session_id = bson.ObjectId(_id)
-        session = get_container('session', session_id)
-        tree['session'] = session
-        if session is None:
-            raise APIStorageException('Session {} does not exist'.format(session_id))
-        subject_id = session['subject']
-    if cont_name == 'subject' or subject_id:
-        if not subject_id:
-            subject_id = bson.ObjectId(_id)
-        subject = get_container('subject', subject_id)
-        if subject is None:
-            raise APIStorageException('Subject {} does not exist'.format(subject_id))
-        tree['subject'] = subject
-        project_id = subject['project']
-    if cont_name == 'project' or project_id:
-        if not project_id:
-            project_id = bson.ObjectId(_id)
-        project = get_container('project', project_id)
-        if project is None:
-            raise APIStorageException('Project {} does not exist'.format(project_id))
-        tree['project'] = project
-        group_id = project['group']
-    if cont_name == 'group' or group_id:
-        if not group_id:
-            group_id = _id
-        tree['group'] = get_container('group', group_id)
-    return tree
+    trees = get_parent_trees(cont_name, [_id])
+    if not trees:
+        if cont_name == 'group':
+            return {'group': None}
+        raise APIStorageException('{} {} or its parents do not exist'.format(cont_name.capitalize(), _id))
+    return trees.values()[0]
 
 def is_session_compliant(session, templates):
     """
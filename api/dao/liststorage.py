@@ -139,6 +139,7 @@ class FileStorage(ListStorage):
         super(FileStorage,self).__init__(cont_name, 'files', use_object_id=True)
 
     def _create_jobs(self, container_before, replaced_files=None):
+        # Rules are only evaluated for the changed files, which create_jobs finds by comparing the file lists
         container_after = self.get_container(container_before['_id'])
         container_type = containerutil.singularize(self.cont_name)
         return rules.create_jobs(config.db, container_before, container_after,
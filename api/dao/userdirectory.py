@@ -0,0 +1,96 @@
+"""
+Per-process directory of user names, avatars and emails, for joining users into containers.
+
+Joins used to read every user document for every listing. Instead, the users referenced by a page
+are read by id the first time they are needed and kept in memory. The directory is refreshed
+incrementally: at most every REFRESH_SECONDS, the users modified since the last refresh are read
+again. Entries are dropped after MAX_AGE_SECONDS, so that users deleted by other processes (which
+leave no modified timestamp behind) disappear as well.
+
+Changing or deleting a user invalidates it in the directory of the process that made the change.
+"""
+import copy
+import datetime
+import threading
+import time
+
+from .. import config
+
+DIRECTORY_FIELDS = ('firstname', 'lastname', 'avatar', 'email', 'modified')
+DIRECTORY_SIZE = 50000
+
+REFRESH_SECONDS = 5
+MAX_AGE_SECONDS = 300
+
+# Users modified this long before a refresh are read again, so that writes in flight during the
+# previous refresh (or from a server with a slightly late clock) are not missed
+REFRESH_LAG = datetime.timedelta(seconds=5)
+
+# uid -> (time read, user)
+_users = {}
+_lock = threading.Lock()
+# Time of the last refresh (time.time() and database time)
+_last_refresh = 0
+_refreshed_until = None
+
+
+def _projection():
+    return {field: 1 for field in DIRECTORY_FIELDS}
+
+def _refresh():
+    """Re-read the cached users modified since the last refresh, if a refresh is due"""
+    global _last_refresh, _refreshed_until # pylint: disable=global-statement
+    now = time.time()
+    with _lock:
+        if now - _last_refresh < REFRESH_SECONDS:
+            return
+        _last_refresh = now
+        since = _refreshed_until
+        _refreshed_until = datetime.datetime.utcnow() - REFRESH_LAG
+        for uid in [uid for uid, (read, _) in _users.iteritems() if now - read >= MAX_AGE_SECONDS]:
+            del _users[uid]
+        if since is None or not _users:
+            return
+
+    modified = list(config.db.users.find({'modified': {'$gte': since}}, _projection()))
+    with _lock:
+        for user in modified:
+            if user['_id'] in _users:
+                _users[user['_id']] = (_users[user['_id']][0], user)
+
+
+def get_users(uids):
+    """
+    Return a dict of uid -> user (with the DIRECTORY_FIELDS it has) for the given uids, reading those
+    not in the directory in one query. Users that do not exist are left out.
+    """
+    _refresh()
+    result = {}
+    with _lock:
+        for uid in uids:
+            entry = _users.get(uid)
+            if entry is not None:
+                result[uid] = copy.deepcopy(entry[1])
+
+    missing = [uid for uid in set(uids) if uid not in result]
+    if missing:
+        now = time.time()
+        found = list(config.db.users.find({'_id': {'$in': missing}}, _projection()))
+        with _lock:
+            if len(_users) + len(found) > DIRECTORY_SIZE:
+                _users.clear()
+            for user in found:
+                _users[user['_id']] = (now, copy.deepcopy(user))
+                result[user['_id']] = user
+    return result
+
+def invalidate(uid=None):
+    """Drop a user (or all of them, starting over) from the directory"""
+    global _last_refresh, _refreshed_until # pylint: disable=global-statement
+    with _lock:
+        if uid is None:
+            _users.clear()
+            _last_refresh = 0
+            _refreshed_until = None
+        else:
+            _users.pop(uid, None)
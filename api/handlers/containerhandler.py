@@ -197,13 +197,10 @@ class ContainerHandler(base.RequestHandler):
         permchecker(noop)('GET', cid)
         cid = bson.ObjectId(cid)
 
-        page = dbutil.paginate_find(config.db.jobs, {'filter': {'parents.project': {'$eq': cid}}}, self.pagination)
-        cleaned_results = []
-        if page.get('results'):
-            for job_map in page.get('results'):
-                cleaned_results.append(remove_potential_phi_from_job(job_map))
-            page['results'] = cleaned_results
-
+        # Results are streamed to the client unless paginated
+        page = dbutil.paginate_find(config.db.jobs, {'filter': {'parents.project': {'$eq': cid}}}, self.pagination,
+                                    stream=True)
+        page['results'] = (remove_potential_phi_from_job(job_map) for job_map in page['results'])
         return self.format_page(page)
 
 
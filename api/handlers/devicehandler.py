@@ -3,7 +3,7 @@ import datetime as dt
 from ..web import base
 from .. import config
 from .. import util
-from ..auth import require_privilege, Privilege
+from ..auth import authcache, require_privilege, Privilege
 from ..auth.apikeys import DeviceApiKey
 from ..dao import containerstorage
 from ..web.errors import APINotFoundException, APIValidationException, APIException
@@ -37,6 +37,11 @@ def get_device_statuses(devices):
 
     return statuses
 
+def invalidate_device(device_id):
+    """Drop a changed or deleted device from the auth cache"""
+    for namespace in ('devices', 'devices_by_label'):
+        authcache.invalidate(namespace, match=lambda device: str(device['_id']) == str(device_id))
+
 class DeviceHandler(base.RequestHandler):
 
     def __init__(self, request=None, response=None):
@@ -45,6 +50,7 @@ class DeviceHandler(base.RequestHandler):
 
     @require_privilege(Privilege.is_user)
     def get(self, device_id):
+        authcache.flush()
         device = self.storage.get_container(device_id)
         if self.user_is_admin:
             self.join_api_key(device)
@@ -52,6 +58,7 @@ class DeviceHandler(base.RequestHandler):
 
     @require_privilege(Privilege.is_user)
     def get_all(self):
+        authcache.flush()
         page = self.storage.get_all_el(None, None, None, pagination=self.pagination)
         devices = page['results']
         if self.user_is_admin and self.is_true('join_keys'):
@@ -88,6 +95,7 @@ class DeviceHandler(base.RequestHandler):
         device = self.storage.get_container(device_id)
 
         self.storage.update_el(device_id, payload)
+        invalidate_device(device_id)
 
         is_disabled = payload['disabled']
         if is_disabled:
@@ -100,10 +108,12 @@ class DeviceHandler(base.RequestHandler):
         result = self.storage.delete_el(device_id)
         if result.deleted_count != 1:
             raise APINotFoundException('Device not found')
+        invalidate_device(device_id)
         return {'deleted': result.deleted_count}
 
     @require_privilege(Privilege.is_user)
     def get_status(self):
+        authcache.flush()
         return get_device_statuses(self.storage.get_all_el(None, None, None))
 
     @require_privilege(Privilege.is_admin)
@@ -136,6 +146,7 @@ class DeviceHandler(base.RequestHandler):
             raise APIValidationException(reason='Cannot change device type')
 
         result = self.storage.update_el(device_id, payload)
+        invalidate_device(device_id)
         return {'modified': result.modified_count}
 
     @require_privilege(Privilege.is_drone)
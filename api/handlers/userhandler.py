@@ -256,7 +256,9 @@ class UserHandler(base.RequestHandler):
             whitelist['gear-name'] = [self.get_param('gear')]
 
         query = Queue.lists_to_query(whitelist, {}, [])
-        page = dbutil.paginate_find(config.db.jobs, {'filter': query}, self.pagination)
+        pagination = self.pagination
+        pagination['total'] = True
+        page = dbutil.paginate_find(config.db.jobs, {'filter': query}, pagination)
 
         result = {
             'stats': Queue.job_states(whitelist, {}, []),
@@ -4,18 +4,27 @@ Batch
 import bson
 import copy
 import datetime
+import pymongo
+import threading
 
 from .. import config
 from ..dao import dbutil
-from ..dao.containerstorage import AcquisitionStorage, AnalysisStorage
+from ..dao.containerstorage import AnalysisStorage
 from .jobs import Job
 from .queue import Queue
-from ..web.errors import APINotFoundException, APIStorageException
+from ..web.errors import APIConflictException, APINotFoundException, APIStorageException
 from . import gears
 from . import job_util
 
 log = config.log
 
+# Number of jobs created with each bulk write when running a batch job
+BATCH_RUN_CHUNK_SIZE = 500
+
+# How long a batch launch can go without a heartbeat (one per chunk) before its launcher is
+# considered gone, e.g. after the process running it was restarted
+BATCH_LAUNCH_TIMEOUT = datetime.timedelta(seconds=600)
+
 BATCH_JOB_TRANSITIONS = {
     # To  <-------  #From
     'failed':       'running',
@@ -153,6 +162,36 @@ def update(batch_id, payload):
 def run(batch_job):
     """
     Creates jobs from proposed inputs, returns jobs enqueued.
+    Moves the 'pending' batch job to 'running'.
+    """
+
+    job_maps, analysis_gear = _get_job_maps(batch_job)
+    _start(batch_job, len(job_maps))
+    return _launch(batch_job, job_maps, analysis_gear)
+
+def run_in_background(batch_job):
+    """
+    Moves the 'pending' batch job to 'running' and creates its jobs in a background thread.
+    The progress of the launch is reported on the batch document, along with a heartbeat that
+    lets check_state and reap_stale_launches fail the batch if the launcher dies.
+    """
+
+    job_maps, analysis_gear = _get_job_maps(batch_job)
+    _start(batch_job, len(job_maps))
+
+    def launch():
+        try:
+            _launch(batch_job, job_maps, analysis_gear)
+        except Exception: # pylint: disable=broad-except
+            log.exception('Error launching batch %s', batch_job['_id'])
+
+    thread = threading.Thread(target=launch, name='batch-' + str(batch_job['_id']))
+    thread.daemon = True
+    thread.start()
+
+def _get_job_maps(batch_job):
+    """
+    Return the maps of the jobs to create for a batch job, and the gear if they are analysis jobs.
     """
 
     proposal = batch_job.get('proposal')
@@ -166,30 +205,18 @@ def run(batch_job):
         gear = gears.get_gear(gear_id)
         gear_name = gear['gear']['name']
 
-        config_ = batch_job.get('config')
-        origin = batch_job.get('origin')
         tags = proposal.get('tags', [])
         tags.append('batch')
 
-        if gear.get('category') == 'analysis':
-            analysis_base = proposal.get('analysis', {})
-            if not analysis_base.get('label'):
-                time_now = datetime.datetime.utcnow()
-                analysis_base['label'] = {'label': '{} {}'.format(gear_name, time_now)}
-            an_storage = AnalysisStorage()
-            acq_storage = AcquisitionStorage()
-
-        jobs = []
-        job_ids = []
-
         job_defaults = {
-            'config':   config_,
+            'config':   batch_job.get('config'),
             'gear_id':  gear_id,
             'tags':     tags,
             'batch':    str(batch_job.get('_id')),
             'inputs':   {}
         }
 
+        job_maps = []
         for proposed_job in proposed_jobs:
             job_map = copy.deepcopy(job_defaults)
             if 'inputs' in proposed_job:
@@ -202,72 +229,132 @@ def run(batch_job):
             if 'compute_provider_id' in proposed_job:
                 job_map['compute_provider_id'] = proposed_job['compute_provider_id']
 
-            if gear.get('category') == 'analysis':
-                analysis = copy.deepcopy(analysis_base)
-
-                # Create analysis
-                # NOTE: Batch destinations *MUST* be a session or acquisition
-                if job_map['destination']['type'] == 'acquisition':
-                    acquisition_id = job_map['destination']['id']
-                    session_id = acq_storage.get_container(acquisition_id, projection={'session': 1}).get('session')
-                else:
-                    session_id = bson.ObjectId(job_map['destination']['id'])
+            job_maps.append(job_map)
 
-                analysis['job'] = job_map
-                result = an_storage.create_el(analysis, 'sessions', session_id, origin, None)
-
-                analysis = an_storage.get_el(result.inserted_id)
-                an_storage.inflate_job_info(analysis)
-                job = analysis.get('job')
-                job_id = bson.ObjectId(job.id_)
-
-            else:
-                job = Queue.enqueue_job(job_map, origin)
-                job.insert()
-                job_id = job.id_
+        if gear.get('category') == 'analysis':
+            analysis_base = proposal.get('analysis', {})
+            if not analysis_base.get('label'):
+                time_now = datetime.datetime.utcnow()
+                analysis_base['label'] = {'label': '{} {}'.format(gear_name, time_now)}
+            return job_maps, analysis_base
 
-            jobs.append(job)
-            job_ids.append(job_id)
+        return job_maps, None
 
     elif 'preconstructed_jobs' in proposal:
-        preconstructed_jobs = proposal.get('preconstructed_jobs')
-
-        # If Running a batch from already-constructed jobs
-        if preconstructed_jobs:
-            origin = batch_job.get('origin')
-            jobs = []
-            job_ids = []
-
-            for preconstructed_job in preconstructed_jobs:
-                job = Queue.enqueue_job(preconstructed_job, origin)
-                job.insert()
-                job_id = job.id_
-                jobs.append(job)
-                job_ids.append(job_id)
+        return proposal.get('preconstructed_jobs') or [], None
+
     else:
         raise APIStorageException('The batch job is not formatted correctly.')
 
-    update(batch_job['_id'], {'state': 'running', 'jobs': job_ids})
+def _start(batch_job, total):
+    """
+    Move a pending batch job to running, ready to receive its jobs.
+    """
+
+    now = datetime.datetime.utcnow()
+    result = config.db.batch.update_one({'_id': batch_job['_id'], 'state': 'pending'}, {'$set': {
+        'state': 'running',
+        'jobs': [],
+        'progress': {'total': total, 'launched': 0, 'heartbeat': now},
+        'modified': now
+    }})
+    if result.modified_count != 1:
+        raise APIConflictException('Batch job {} is not pending'.format(batch_job['_id']))
+
+def _launch(batch_job, job_maps, analysis_base=None):
+    """
+    Create the jobs of a running batch job in chunks, each with bulk writes for the jobs and analyses.
+    After each chunk the batch job's jobs, progress and heartbeat are updated; if it was cancelled
+    in the meantime, the chunk's jobs are cancelled and the launch stops. The launch also stops if
+    it was given up on as stale (see check_state).
+
+    Returns the created jobs.
+    """
+
+    batch_id = batch_job['_id']
+    origin = batch_job.get('origin')
+    jobs = []
+
+    try:
+        for i in xrange(0, len(job_maps), BATCH_RUN_CHUNK_SIZE):
+            chunk = job_maps[i:i + BATCH_RUN_CHUNK_SIZE]
+            if analysis_base is not None:
+                chunk_jobs = _launch_analysis_jobs(chunk, analysis_base, origin)
+            else:
+                chunk_jobs = [Queue.enqueue_job(job_map, origin) for job_map in chunk]
+                Job.insert_many(chunk_jobs)
+            jobs.extend(chunk_jobs)
+
+            chunk_job_ids = [job.id_ for job in chunk_jobs]
+            now = datetime.datetime.utcnow()
+            batch_doc = config.db.batch.find_one_and_update({'_id': batch_id}, {
+                '$push': {'jobs': {'$each': chunk_job_ids}},
+                '$inc': {'progress.launched': len(chunk_job_ids)},
+                '$set': {'progress.heartbeat': now, 'modified': now}
+            }, projection={'state': 1, 'progress': 1}, return_document=pymongo.collection.ReturnDocument.AFTER)
+
+            if batch_doc['state'] == 'cancelled':
+                Queue.cancel_pending(chunk_job_ids)
+                break
+            if batch_doc['progress'].get('error'):
+                break
+
+    except Exception as e:
+        config.db.batch.update_one({'_id': batch_id}, {'$set': {
+            'progress.error': str(e),
+            'modified': datetime.datetime.utcnow()
+        }})
+        raise
+
+    finally:
+        # Jobs of the first chunks may already have finished
+        new_state = check_state(batch_id)
+        if new_state:
+            update(batch_id, {'state': new_state})
+
     return jobs
 
+def _launch_analysis_jobs(job_maps, analysis_base, origin):
+    """
+    Create the analyses of a chunk of batch jobs along with their jobs.
+    """
+
+    # NOTE: Batch destinations *MUST* be a session or acquisition
+    acquisition_ids = [bson.ObjectId(job_map['destination']['id']) for job_map in job_maps
+                       if job_map['destination']['type'] == 'acquisition']
+    sessions = {}
+    if acquisition_ids:
+        sessions = {
+            acquisition['_id']: acquisition.get('session') for acquisition in
+            config.db.acquisitions.find({'_id': {'$in': acquisition_ids}, 'deleted': {'$exists': False}}, {'session': 1})
+        }
+
+    analyses = []
+    for job_map in job_maps:
+        if job_map['destination']['type'] == 'acquisition':
+            acquisition_id = bson.ObjectId(job_map['destination']['id'])
+            if acquisition_id not in sessions:
+                raise APINotFoundException('Could not find acquisitions {}'.format(acquisition_id))
+            session_id = sessions[acquisition_id]
+        else:
+            session_id = bson.ObjectId(job_map['destination']['id'])
+
+        analysis = copy.deepcopy(analysis_base)
+        analysis['job'] = job_map
+        analyses.append((analysis, session_id))
+
+    return AnalysisStorage().create_job_analyses(analyses, 'sessions', origin)
+
 def cancel(batch_job):
     """
     Cancels all pending jobs, returns number of jobs cancelled.
     """
 
-    pending_jobs = config.db.jobs.find({'state': 'pending', '_id': {'$in': batch_job.get('jobs')}})
-    cancelled_jobs = 0
-    for j in pending_jobs:
-        job = Job.load(j)
-        try:
-            Queue.mutate(job, {'state': 'cancelled'})
-            cancelled_jobs += 1
-        except Exception: # pylint: disable=broad-except
-            # if the cancellation fails, move on to next job
-            continue
-
+    # Cancel the batch first, so that jobs still being launched are cancelled by the launch itself
     update(batch_job['_id'], {'state': 'cancelled'})
-    return cancelled_jobs
+
+    batch_doc = config.db.batch.find_one({'_id': batch_job['_id']}, {'jobs': 1})
+    return Queue.cancel_pending(batch_doc.get('jobs', []))
 
 def check_state(batch_id):
     """
@@ -280,6 +367,12 @@ def check_state(batch_id):
     if batch.get('state') == 'cancelled':
         return None
 
+    # Jobs are still being launched, unless the launcher is gone
+    progress = batch.get('progress', {})
+    if progress.get('launched', 0) < progress.get('total', 0) and not progress.get('error'):
+        if not _is_stale_launch(batch) or not _stop_stale_launch(batch):
+            return None
+
     batch_jobs = config.db.jobs.find({'_id':{'$in': batch.get('jobs', [])}, 'state': {'$nin': ['complete', 'failed', 'cancelled']}})
     non_failed_batch_jobs = config.db.jobs.find({'_id':{'$in': batch.get('jobs', [])}, 'state': {'$ne': 'failed'}})
 
@@ -291,6 +384,55 @@ def check_state(batch_id):
     else:
         return None
 
+def reap_stale_launches():
+    """
+    Stop the launches of running batch jobs whose launcher is gone, and move the batch jobs to
+    complete or failed if none of their launched jobs are left to finish.
+    Should be called periodically.
+
+    Returns the number of stopped launches.
+    """
+
+    stale = config.db.batch.find({
+        'state': 'running',
+        'progress.heartbeat': {'$lt': datetime.datetime.utcnow() - BATCH_LAUNCH_TIMEOUT},
+        'progress.error': {'$exists': False},
+    }, {'progress': 1})
+
+    stopped = 0
+    for batch in stale:
+        if batch['progress']['launched'] >= batch['progress']['total']:
+            continue
+        if _stop_stale_launch(batch):
+            stopped += 1
+            new_state = check_state(batch['_id'])
+            if new_state:
+                update(batch['_id'], {'state': new_state})
+    return stopped
+
+def _is_stale_launch(batch):
+    heartbeat = batch['progress'].get('heartbeat')
+    return heartbeat is not None and heartbeat < datetime.datetime.utcnow() - BATCH_LAUNCH_TIMEOUT
+
+def _stop_stale_launch(batch):
+    """
+    Record that the launch of a batch job stopped, unless it made progress in the meantime.
+    Returns True if the launch was stopped.
+    """
+
+    result = config.db.batch.update_one({
+        '_id': batch['_id'],
+        'progress.heartbeat': batch['progress']['heartbeat'],
+        'progress.error': {'$exists': False},
+    }, {'$set': {
+        'progress.error': 'The batch launch stopped after launching {} of {} jobs'.format(
+            batch['progress']['launched'], batch['progress']['total']),
+        'modified': datetime.datetime.utcnow()
+    }})
+    if result.modified_count:
+        log.warning('Stopped the stale launch of batch %s', batch['_id'])
+    return bool(result.modified_count)
+
 def get_stats():
     """
     Return the number of jobs by state.
@@ -5,21 +5,99 @@ Gears
 from __future__ import absolute_import
 
 import bson.objectid
+import collections
 import copy
 import datetime
 from dxf import DXF
 from jsonschema import Draft4Validator, ValidationError
 import gears as gear_tools
 import json
+import threading
+import time
 from urlparse import urlparse
 
 from .. import config
 from ..dao import dbutil
+from .mappers import RulesMapper
 
 from ..web.errors import APIValidationException, APINotFoundException
 
 log = config.log
 
+# Gear documents and their compiled validators, keyed by gear id. The cache is local to the
+# process; every gear change bumps a revision stored in the database. A process checks the
+# revision at most every GEAR_CHECK_SECONDS, and drops all of its entries when the revision
+# changed. The process making a change drops its own entries right away.
+GEAR_CACHE_SIZE = 256
+GEAR_CHECK_SECONDS = 5
+_gear_cache = collections.OrderedDict()
+_gear_cache_lock = threading.Lock()
+_gear_cache_revision = None
+_gear_cache_checked = 0
+
+def get_gears_revision():
+    doc = config.db.singletons.find_one({'_id': 'gear_revision'}, {'revision': 1})
+    return doc.get('revision', 0) if doc else 0
+
+def bump_gears_revision():
+    """
+    Mark every cached gear stale, in this and all other API processes.
+    """
+    global _gear_cache_revision # pylint: disable=global-statement
+    config.db.singletons.update_one({'_id': 'gear_revision'}, {'$inc': {'revision': 1}}, upsert=True)
+    with _gear_cache_lock:
+        _gear_cache.clear()
+        _gear_cache_revision = None
+
+def _get_cached_gear_entry(_id):
+    global _gear_cache_revision, _gear_cache_checked # pylint: disable=global-statement
+    now = time.time()
+    if _gear_cache_revision is None or now - _gear_cache_checked > GEAR_CHECK_SECONDS:
+        revision = get_gears_revision()
+        with _gear_cache_lock:
+            if revision != _gear_cache_revision:
+                _gear_cache.clear()
+                _gear_cache_revision = revision
+            _gear_cache_checked = now
+
+    with _gear_cache_lock:
+        revision = _gear_cache_revision
+        entry = _gear_cache.pop(_id, None)
+        if entry is not None:
+            _gear_cache[_id] = entry
+            return entry
+
+    gear = config.db.gears.find_one({'_id': bson.ObjectId(_id)})
+    if gear is None:
+        return None
+
+    entry = {'gear': gear, 'invocation': None, 'validators': {}}
+    with _gear_cache_lock:
+        if revision == _gear_cache_revision:
+            _gear_cache[_id] = entry
+            while len(_gear_cache) > GEAR_CACHE_SIZE:
+                _gear_cache.popitem(last=False)
+    return entry
+
+def _get_gear_validator(gear, key, get_schema):
+    """
+    Return a Draft4Validator for the schema built by get_schema(invocation_schema).
+
+    Validators are kept with the cached gear entry when the gear is cached; manifests are
+    immutable once a gear is installed, so the gear id identifies the schema.
+    """
+    with _gear_cache_lock:
+        entry = _gear_cache.get(str(gear['_id'])) if gear.get('_id') else None
+        validator = entry['validators'].get(key) if entry else None
+    if validator is not None:
+        return validator
+
+    validator = Draft4Validator(get_schema(copy.deepcopy(get_invocation_schema(gear))))
+    if entry is not None:
+        with _gear_cache_lock:
+            entry['validators'][key] = validator
+    return validator
+
 def get_gears(all_versions=False, pagination=None, include_invalid=False):
     """
     Fetch the install-global gears from the database
@@ -59,10 +137,10 @@ def get_gears(all_versions=False, pagination=None, include_invalid=False):
     return page['results'] if pagination is None else page
 
 def get_gear(_id):
-    gear = config.db.gears.find_one({'_id': bson.ObjectId(_id)})
-    if gear is None:
+    entry = _get_cached_gear_entry(str(bson.ObjectId(_id)))
+    if entry is None:
         raise APINotFoundException('Cannot find gear {}'.format(_id))
-    return gear
+    return copy.deepcopy(entry['gear'])
 
 def get_latest_gear(name):
     gears = config.db.gears.find({'gear.name': name, 'gear.custom.flywheel.invalid': {'$ne': True}}).sort('created', direction=-1).limit(1)
@@ -86,21 +164,27 @@ def requires_read_write_key(gear):
     return False
 
 def get_invocation_schema(gear):
-    return gear_tools.derive_invocation_schema(gear['gear'])
+    with _gear_cache_lock:
+        entry = _gear_cache.get(str(gear['_id'])) if gear.get('_id') else None
+        invocation = entry['invocation'] if entry else None
+    if invocation is None:
+        if entry is not None:
+            # Derive from the stored manifest; callers may pass a trimmed copy of the gear
+            invocation = entry['invocation'] = gear_tools.derive_invocation_schema(entry['gear']['gear'])
+        else:
+            invocation = gear_tools.derive_invocation_schema(gear['gear'])
+    return invocation
 
 def add_suggest_info_to_files(gear, files):
     """
     Given a list of files, add information to each file that details those that would work well for each input on a gear.
     """
 
-    invocation_schema = get_invocation_schema(gear)
-
     schemas = {}
     for x in gear['gear']['inputs']:
         input_ = gear['gear']['inputs'][x]
         if input_.get('base') == 'file':
-            schema = gear_tools.isolate_file_invocation(invocation_schema, x)
-            schemas[x] = Draft4Validator(schema)
+            schemas[x] = _get_file_validator(gear, x)
 
     for f in files:
         f['suggested'] = {}
@@ -111,7 +195,6 @@ def add_suggest_info_to_files(gear, files):
 
 def suggest_for_files(gear, files, context=None):
 
-    invocation_schema = get_invocation_schema(gear)
     schemas = {}
     suggested_inputs = {}
 
@@ -130,8 +213,7 @@ def suggest_for_files(gear, files, context=None):
                     'found': False
                 }]
         elif input_.get('base') == 'file':
-            schema = gear_tools.isolate_file_invocation(invocation_schema, x)
-            schemas[x] = Draft4Validator(schema)
+            schemas[x] = _get_file_validator(gear, x)
 
     for input_name, schema in schemas.iteritems():
         suggested_inputs[input_name] = []
@@ -144,11 +226,13 @@ def suggest_for_files(gear, files, context=None):
 
     return suggested_inputs
 
+def _get_file_validator(gear, input_name):
+    return _get_gear_validator(gear, ('file', input_name),
+                               lambda invocation: gear_tools.isolate_file_invocation(invocation, input_name))
+
 def validate_gear_config(gear, config_):
     if len(gear.get('gear', {}).get('config', {})) > 0:
-        invocation = gear_tools.derive_invocation_schema(gear['gear'])
-        ci = gear_tools.isolate_config_invocation(invocation)
-        validator = Draft4Validator(ci)
+        validator = _get_gear_validator(gear, ('config',), gear_tools.isolate_config_invocation)
 
         try:
             validator.validate(fill_gear_default_values(gear, config_))
@@ -192,6 +276,7 @@ def insert_gear(doc):
     doc['modified'] = now
 
     result = config.db.gears.insert(doc)
+    bump_gears_revision()
 
     if installed_gears:
         installed_gear_ids = [str(gear['_id']) for gear in installed_gears]
@@ -201,10 +286,19 @@ def insert_gear(doc):
 
 def remove_gear(_id):
     result = config.db.gears.delete_one({"_id": bson.ObjectId(_id)})
+    bump_gears_revision()
 
     if result.deleted_count != 1:
         raise Exception("Deleted failed " + str(result.raw_result))
 
+def invalidate_job_requests(gear_id):
+    """
+    Drop the engine requests precomputed for pending jobs of a gear whose document changed.
+    They are regenerated from the current gear when the jobs are started.
+    """
+    config.db.jobs.update_many({'gear_id': str(gear_id), 'state': 'pending', 'request': {'$exists': True}},
+                               {'$unset': {'request': ''}})
+
 def upsert_gear(doc):
     check_for_gear_insertion(doc)
 
@@ -224,7 +318,13 @@ def check_for_gear_insertion(doc):
         raise Exception('Gear "' + doc['gear']['name'] + '" version "' + doc['gear']['version'] + '" already exists, consider changing the version string.')
 
 def auto_update_rules(gear_id, installed_gear_ids):
-    config.db.project_rules.update_many({'gear_id': {'$in': installed_gear_ids}, 'auto_update': True}, {"$set": {'gear_id': str(gear_id)}})
+    query = {'gear_id': {'$in': installed_gear_ids}, 'auto_update': True}
+    project_ids = config.db.project_rules.distinct('project_id', query)
+    config.db.project_rules.update_many(query, {"$set": {'gear_id': str(gear_id)}})
+
+    rules_mapper = RulesMapper()
+    for project_id in project_ids:
+        rules_mapper.bump_revision(project_id)
 
 def get_registry_connectivity():
     """
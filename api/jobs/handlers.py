@@ -3,17 +3,20 @@ API request handlers for the jobs module
 """
 import bson
 import datetime
+import dateutil.parser
 import StringIO
 from jsonschema import ValidationError
 from urlparse import urlparse
 
 from . import batch
+from . import job_counters
 from . import mappers, models
 from .job_util import (
     resolve_context_inputs,
     get_context_for_destination,
     remove_potential_phi_from_job,
     validate_job_compute_provider,
+    validate_job_priority,
     log_job_access,
 )
 from .. import config
@@ -35,7 +38,7 @@ from ..site.providers import get_provider
 
 from .gears import (
     validate_gear_config, get_gears, get_gear, get_latest_gear, confirm_registry_asset,
-    get_invocation_schema, remove_gear, insert_gear,
+    get_invocation_schema, remove_gear, insert_gear, invalidate_job_requests, bump_gears_revision,
     upsert_gear, check_for_gear_insertion, filter_optional_inputs,
     add_suggest_info_to_files, count_file_inputs, requires_read_write_key
 )
@@ -323,6 +326,8 @@ class GearHandler(base.RequestHandler):
         config.db.gears.update_one({'_id': gear_id}, {'$set': {
             'exchange.rootfs-url': '/api/gears/temp/' + str(gear_id)}
         })
+        bump_gears_revision()
+        invalidate_job_requests(gear_id)
 
         return {'_id': str(gear_id)}
 
@@ -533,13 +538,9 @@ class JobsHandler(base.RequestHandler):
     @require_privilege(Privilege.is_admin)
     def get(self):
         """List all jobs."""
-        page = dbutil.paginate_find(config.db.jobs, {}, self.pagination)
-        cleaned_results = []
-        if page.get('results'):
-            for job_map in page.get('results'):
-                cleaned_results.append(remove_potential_phi_from_job(job_map))
-            page['results'] = cleaned_results
-
+        # Results are streamed to the client unless paginated
+        page = dbutil.paginate_find(config.db.jobs, {}, self.pagination, stream=True)
+        page['results'] = (remove_potential_phi_from_job(job_map) for job_map in page['results'])
         return self.format_page(page)
 
     @require_privilege(Privilege.is_user)
@@ -552,6 +553,7 @@ class JobsHandler(base.RequestHandler):
 
         # Check and raise if non-admin user attempts to override compute provider
         validate_job_compute_provider(payload, self)
+        validate_job_priority(payload, self)
 
         uid = None
         if not self.user_is_admin:
@@ -585,6 +587,7 @@ class JobsHandler(base.RequestHandler):
     def stats(self):
         all_flag = self.is_true('all')
         unique = self.is_true('unique')
+        backlog = self.is_true('backlog')
         tags = self.request.GET.getall('tags')
         last = self.request.GET.get('last')
 
@@ -595,17 +598,29 @@ class JobsHandler(base.RequestHandler):
         if last is not None:
             last = int(last)
 
-        return Queue.get_statistics(tags=tags, last=last, unique=unique, all_flag=all_flag)
+        return Queue.get_statistics(tags=tags, last=last, unique=unique, all_flag=all_flag, backlog=backlog)
 
     @require_privilege(Privilege.is_admin)
     def next(self):
         peek = self.is_true('peek')
         tags = self.request.GET.getall('tags')
+        count = self.request.GET.get('count')
 
         # Allow for tags to be specified multiple times, or just comma-deliminated
         if len(tags) == 1:
             tags = tags[0].split(',')
 
+        # Starting multiple jobs returns a (possibly empty) list instead of a single job
+        if count is not None:
+            try:
+                count = int(count)
+            except ValueError:
+                count = -1
+            if count < 0:
+                raise InputValidationException('count must be a non-negative integer')
+            whitelist, blacklist = Queue.legacy_tag_parse(tags)
+            return Queue.start_jobs(count, whitelist, blacklist, [], peek)
+
         job = Queue.start_job_parsing_tags(tags=tags, peek=peek)
 
         if job is None:
@@ -626,8 +641,12 @@ class JobsHandler(base.RequestHandler):
 
     @require_privilege(Privilege.is_admin)
     def reap_stale(self):
-        count = Queue.scan_for_orphans()
-        return { 'orphaned': count }
+        return Queue.scan_for_orphans()
+
+    @require_privilege(Privilege.is_admin)
+    def reconcile_counters(self):
+        """Rebuild the job counters by state, gear and compute provider from the jobs"""
+        return {'corrected': job_counters.reconcile()}
 
 class JobHandler(base.RequestHandler):
     """Provides /Jobs/<jid> routes."""
@@ -882,34 +901,60 @@ class JobHandler(base.RequestHandler):
                         job.inputs[x].check_access(self.uid, 'ro')
                 # Unlike jobs-add, explicitly not checking write access to destination.
 
+    def _log_range(self):
+        """Parse the offset, tail and since parameters that select a range of a job's logs"""
+        log_range = {}
+
+        for param in ('offset', 'tail'):
+            value = self.get_param(param)
+            if value is not None:
+                try:
+                    log_range[param] = int(value)
+                except ValueError:
+                    log_range[param] = -1
+                if log_range[param] < 0:
+                    raise InputValidationException('{} must be a non-negative integer'.format(param))
+
+        since = self.get_param('since')
+        if since is not None:
+            try:
+                log_range['since'] = dateutil.parser.parse(since)
+            except (ValueError, OverflowError):
+                raise InputValidationException('since must be a date and time')
+
+        return log_range
+
+    @staticmethod
+    def _encoded(generator):
+        for output in generator:
+            yield output.encode('utf-8') if isinstance(output, unicode) else output
+
     @log_access(AccessType.view_job_logs)
     def get_logs(self, _id):
         """Get a job's logs"""
 
         self._log_read_check(_id)
-        return Logs.get(_id)
+        return Logs.get(_id, **self._log_range())
 
     @log_access(AccessType.view_job_logs)
     def get_logs_text(self, _id):
         """Get a job's logs in raw text"""
 
         self._log_read_check(_id)
+        log_range = self._log_range()
         filename = 'job-' + _id + '-logs.txt'
 
-        set_for_download(self.response, filename=filename)
-        for output in Logs.get_text_generator(_id):
-            self.response.write(output)
+        set_for_download(self.response, stream=self._encoded(Logs.get_text_generator(_id, **log_range)),
+                         filename=filename)
 
     @log_access(AccessType.view_job_logs)
     def get_logs_html(self, _id):
         """Get a job's logs in html"""
 
         self._log_read_check(_id)
+        log_range = self._log_range()
 
-        for output in Logs.get_html_generator(_id):
-            self.response.write(output)
-
-        return
+        self.response.app_iter = self._encoded(Logs.get_html_generator(_id, **log_range))
 
     @require_privilege(Privilege.is_admin)
     def add_logs(self, _id):
@@ -1208,6 +1253,8 @@ class BatchHandler(base.RequestHandler):
             try:
                 # Ensure that user is admin if compute_provider_id is set
                 validate_job_compute_provider(job_, self)
+                # Ensure that user is admin if the priority is raised
+                validate_job_priority(job_, self)
 
                 job_['batch'] = str(batch_id)
                 Queue.enqueue_job(job_, self.origin, perm_check_uid=uid)
@@ -1233,12 +1280,19 @@ class BatchHandler(base.RequestHandler):
         """
         Creates jobs from proposed inputs, returns jobs enqueued.
         Moves 'pending' batch job to 'running'.
+        Use param async=true to create the jobs in the background and return the batch job,
+        which reports the progress of the launch.
         """
 
         batch_job = batch.get(_id)
         self._check_permission(batch_job)
         if batch_job.get('state') != 'pending':
             self.abort(400, 'Can only run pending batch jobs.')
+
+        if self.is_true('async'):
+            batch.run_in_background(batch_job)
+            self.response.status = 202
+            return batch.get(_id, projection={'proposal': 0})
         return batch.run(batch_job)
 
     @require_privilege(Privilege.is_user)
@@ -0,0 +1,171 @@
+"""
+Materialized job counts by state, gear and compute provider.
+
+Counting jobs by state scans the (large) jobs collection, so the counts are kept in the
+job_counters collection instead: one document per state, gear and compute provider, which is
+incremented and decremented along with every job insert and state transition. Each counter also
+carries the gear name and capabilities, so that counts can be filtered the way engines ask for work.
+
+Counter updates are not transactional with the job writes; reconcile() rebuilds all counters
+from the jobs collection.
+"""
+import bson
+import collections
+import pymongo
+import pymongo.errors
+
+from .. import config
+
+log = config.log
+
+
+def _provider_id(provider_id):
+    if provider_id is not None and bson.ObjectId.is_valid(provider_id):
+        return bson.ObjectId(provider_id)
+    return provider_id
+
+def _job_key(job):
+    """
+    Return the counter key of a job object or document, as (gear_id, compute_provider_id).
+    """
+    if isinstance(job, dict):
+        return job.get('gear_id'), _provider_id(job.get('compute_provider_id'))
+    return job.gear_id, _provider_id(job.compute_provider_id)
+
+def _gear_info(job):
+    gear_info = (job.get('gear_info') if isinstance(job, dict) else job.gear_info) or {}
+    return {'gear_name': gear_info.get('name'), 'capabilities': gear_info.get('capabilities') or []}
+
+def _apply(deltas, gear_infos):
+    for (state, gear_id, provider_id), delta in deltas.iteritems():
+        if not delta:
+            continue
+        query = {'state': state, 'gear_id': gear_id, 'compute_provider_id': provider_id}
+        update = {'$inc': {'count': delta}, '$setOnInsert': gear_infos[(gear_id, provider_id)]}
+        try:
+            config.db.job_counters.update_one(query, update, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # A concurrent upsert created the counter first
+            config.db.job_counters.update_one(query, update)
+
+def count_inserted(jobs):
+    """
+    Count newly inserted jobs (objects or documents) in their current state.
+    """
+    deltas = collections.Counter()
+    gear_infos = {}
+    for job in jobs:
+        key = _job_key(job)
+        state = job.get('state') if isinstance(job, dict) else job.state
+        deltas[(state,) + key] += 1
+        gear_infos[key] = _gear_info(job)
+    _apply(deltas, gear_infos)
+
+def count_transition(jobs, from_state, to_state):
+    """
+    Move jobs (objects or documents) that transitioned from one state to another between counters.
+    """
+    deltas = collections.Counter()
+    gear_infos = {}
+    for job in jobs:
+        key = _job_key(job)
+        deltas[(from_state,) + key] -= 1
+        deltas[(to_state,) + key] += 1
+        gear_infos[key] = _gear_info(job)
+    _apply(deltas, gear_infos)
+
+def count_provider_change(job, state, compute_provider_id):
+    """
+    Move a job whose compute provider changed to the counter of its new provider.
+    """
+    gear_id, old_provider_id = _job_key(job)
+    new_provider_id = _provider_id(compute_provider_id)
+    if old_provider_id == new_provider_id:
+        return
+    gear_info = _gear_info(job)
+    _apply({(state, gear_id, old_provider_id): -1, (state, gear_id, new_provider_id): 1},
+           {(gear_id, old_provider_id): gear_info, (gear_id, new_provider_id): gear_info})
+
+def get_counts(gear_names=None, excluded_gear_names=None, provider_ids=None, excluded_provider_ids=None,
+               capabilities=None):
+    """
+    Return the number of jobs in each state (only states that have jobs) for the given filters.
+
+    Jobs are counted if their gear name and compute provider are in the given lists (if any) and not
+    in the excluded ones. If capabilities are given, only jobs whose gear capabilities are a subset of
+    them are counted.
+    """
+    query = {'count': {'$ne': 0}}
+    if gear_names is not None or excluded_gear_names is not None:
+        query['gear_name'] = {}
+        if gear_names is not None:
+            query['gear_name']['$in'] = gear_names
+        if excluded_gear_names is not None:
+            query['gear_name']['$nin'] = excluded_gear_names
+    if provider_ids is not None or excluded_provider_ids is not None:
+        query['compute_provider_id'] = {}
+        if provider_ids is not None:
+            query['compute_provider_id']['$in'] = [_provider_id(p) for p in provider_ids]
+        if excluded_provider_ids is not None:
+            query['compute_provider_id']['$nin'] = [_provider_id(p) for p in excluded_provider_ids]
+
+    counts = collections.Counter()
+    for counter in config.db.job_counters.find(query):
+        if capabilities is not None and not set(counter.get('capabilities') or []).issubset(capabilities):
+            continue
+        counts[counter['state']] += counter['count']
+    return dict(counts)
+
+def get_counts_by_gear():
+    """
+    Return the number of jobs (in any state) of each gear id.
+    """
+    counts = collections.Counter()
+    for counter in config.db.job_counters.find({'count': {'$ne': 0}}, {'gear_id': 1, 'count': 1}):
+        counts[counter['gear_id']] += counter['count']
+    return dict(counts)
+
+def reconcile():
+    """
+    Rebuild the counters from the jobs collection with a single aggregation.
+    Counters of jobs that changed state while the aggregation ran may be off until the next pass.
+
+    Returns the number of counters that were corrected.
+    """
+    actual = {}
+    for result in config.db.jobs.aggregate([
+        {'$group': {
+            '_id': {'state': '$state', 'gear_id': '$gear_id', 'compute_provider_id': '$compute_provider_id'},
+            'gear_name': {'$first': '$gear_info.name'},
+            'capabilities': {'$first': '$gear_info.capabilities'},
+            'count': {'$sum': 1}
+        }}
+    ], allowDiskUse=True):
+        key = (result['_id'].get('state'), result['_id'].get('gear_id'), result['_id'].get('compute_provider_id'))
+        actual[key] = result
+
+    operations = []
+    seen = set()
+    for counter in config.db.job_counters.find():
+        key = (counter['state'], counter['gear_id'], counter['compute_provider_id'])
+        seen.add(key)
+        count = actual[key]['count'] if key in actual else 0
+        if counter['count'] != count:
+            operations.append(pymongo.UpdateOne({'_id': counter['_id']}, {'$set': {'count': count}}))
+
+    for key, result in actual.iteritems():
+        if key not in seen:
+            state, gear_id, provider_id = key
+            operations.append(pymongo.UpdateOne(
+                {'state': state, 'gear_id': gear_id, 'compute_provider_id': provider_id},
+                {'$set': {
+                    'count': result['count'],
+                    'gear_name': result.get('gear_name'),
+                    'capabilities': result.get('capabilities') or []
+                }},
+                upsert=True))
+
+    if operations:
+        config.db.job_counters.bulk_write(operations, ordered=False)
+        log.info('Reconciled %d job counters', len(operations))
+    return len(operations)
@@ -12,6 +12,9 @@ from ..web.request import AccessType
 from ..site.providers import validate_provider_class
 
 
+# Priority of jobs that do not specify one. Higher priority jobs are dispensed first.
+DEFAULT_JOB_PRIORITY = 0
+
 def remove_potential_phi_from_job(job_map):
     """Remove certain fields from jobs to simplify the endpoint, the fields
     are produced metadata and info objects on config.inputs items
@@ -174,3 +177,22 @@ def validate_job_compute_provider(job_map, request_handler, validate_provider=Fa
                 raise errors.ValidationError('Provider id is not a regsitered provider on this system')
 
     return compute_provider_id
+
+def validate_job_priority(job_map, request_handler):
+    """Verify that the user can set the job priority, if provided.
+
+    Non-admin users may lower the priority of their jobs, but only admins
+    can raise a job above the default priority.
+
+    Returns:
+        int: The priority if specified, otherwise None
+
+    Raises:
+        APIPermissionException: If a non-admin user attempts to raise the priority
+    """
+    priority = job_map.get('priority')
+    if priority is not None and priority > DEFAULT_JOB_PRIORITY:
+        if not request_handler.user_is_admin:
+            raise errors.PermissionError('Only admin can raise job priority!')
+
+    return priority
@@ -5,6 +5,8 @@ Jobs
 import bson
 import copy
 import datetime
+import pymongo
+import pymongo.errors
 import string
 from urlparse import urlparse
 
@@ -14,7 +16,9 @@ from ..dao.containerutil import create_filereference_from_dictionary, create_con
 from .. import config
 from ..web.errors import APINotFoundException
 
+from . import job_counters
 from . import job_util
+from .job_util import DEFAULT_JOB_PRIORITY
 
 class Job(object):
     def __init__(self, gear, inputs, destination=None, tags=None,
@@ -24,7 +28,8 @@ class Job(object):
                  saved_files=None, produced_metadata=None, batch=None,
                  failed_output_accepted=False, profile=None,
                  parents=None, failure_reason=None, transitions=None,
-                 related_container_ids=None, label=None, compute_provider_id=None):
+                 related_container_ids=None, label=None, compute_provider_id=None,
+                 priority=DEFAULT_JOB_PRIORITY):
         """
         Creates a job.
 
@@ -48,7 +53,8 @@ class Job(object):
         state: string (optional)
             The state of this job. Defaults to 'pending'.
         request: map (optional)
-            The request that is used for the engine. Generated when job is started.
+            The request that is used for the engine. Generated when job is enqueued, or when it is started
+            if the request was dropped because the job or its gear changed.
         id_: string (optional)
             The database identifier for this job.
         config: map (optional)
@@ -70,6 +76,8 @@ class Job(object):
             An optional label for the job
         compute_provider_id: ObjectId (optional)
             The compute provider id for job execution
+        priority: integer (optional)
+            The scheduling priority of this job, higher is dispensed first. Defaults to 0.
         """
 
         # TODO: validate inputs against the manifest
@@ -136,6 +144,7 @@ class Job(object):
         self.related_container_ids = related_container_ids
         self.label              = label
         self.compute_provider_id = bson.ObjectId(compute_provider_id) if compute_provider_id else None
+        self.priority           = priority
 
     def intention_equals(self, other_job):
         """
@@ -214,7 +223,8 @@ class Job(object):
             transitions=d.get('transitions', {}),
             related_container_ids=d.get('related_container_ids', []),
             label = d.get('label'),
-            compute_provider_id = d.get('compute_provider_id')
+            compute_provider_id = d.get('compute_provider_id'),
+            priority = d.get('priority', DEFAULT_JOB_PRIORITY)
         )
 
     @classmethod
@@ -291,18 +301,36 @@ class Job(object):
 
         return d
 
-    def insert(self, ignore_insertion_block=False):
+    def insert(self):
         """
         Warning: this will not stop you from inserting a job for a gear that has gear.custom.flywheel.invalid set to true.
+
+        Jobs prepared by Queue.enqueue_job already carry their id (their request references it),
+        so inserting the same job twice is caught by the unique _id rather than by checking for an id.
         """
 
-        if self.id_ is not None and not ignore_insertion_block:
+        try:
+            result = config.db.jobs.insert_one(self.mongo())
+        except pymongo.errors.DuplicateKeyError:
             raise Exception('Cannot insert job that has already been inserted')
 
-        result = config.db.jobs.insert_one(self.mongo())
         self.id_ = result.inserted_id
+        job_counters.count_inserted([self])
         return result.inserted_id
 
+    @staticmethod
+    def insert_many(jobs):
+        """
+        Insert jobs prepared by Queue.enqueue_job with a single write, setting their ids to ObjectIds.
+        """
+
+        if not jobs:
+            return
+        config.db.jobs.insert_many([job.mongo() for job in jobs], ordered=False)
+        for job in jobs:
+            job.id_ = bson.ObjectId(job.id_)
+        job_counters.count_inserted(jobs)
+
     def save(self):
         self.modified = datetime.datetime.utcnow()
         update = self.mongo()
@@ -485,39 +513,45 @@ class JobTicket(object):
         config.db.job_tickets.remove({'_id': bson.ObjectId(_id)})
 
 class Logs(object):
+    """
+    Job logs are stored as append-only chunks in job_log_chunks, one per add, ordered by seq.
+    The job's job_logs document keeps the chunk sequence and the log length, and, for jobs logged
+    before chunking, the legacy 'logs' array, which is read as the start of the log.
+    """
 
     @staticmethod
-    def get(_id):
-        log = config.db.job_logs.find_one({'_id': _id})
+    def get(_id, offset=None, tail=None, since=None):
+        log_header = config.db.job_logs.find_one({'_id': _id})
 
-        if log is None:
+        if log_header is None:
             return { '_id': _id, 'logs': [] }
-        else:
-            return log
+
+        start, length, stanzas = Logs._select(_id, log_header, offset=offset, tail=tail, since=since)
+        return { '_id': _id, 'logs': list(stanzas), 'offset': start, 'length': length }
 
     @staticmethod
-    def get_text_generator(_id):
-        log = config.db.job_logs.find_one({'_id': _id})
+    def get_text_generator(_id, offset=None, tail=None, since=None):
+        log_header = config.db.job_logs.find_one({'_id': _id})
 
-        if log is None:
+        if log_header is None:
             yield 'No logs were found for this job.'
         else:
-            for stanza in log['logs']:
+            for stanza in Logs._select(_id, log_header, offset=offset, tail=tail, since=since)[2]:
                 msg = stanza['msg']
                 yield msg
 
     @staticmethod
-    def get_html_generator(_id):
-        log = config.db.job_logs.find_one({'_id': _id})
+    def get_html_generator(_id, offset=None, tail=None, since=None):
+        log_header = config.db.job_logs.find_one({'_id': _id})
 
-        if log is None:
+        if log_header is None:
             yield '<span class="fd--1">No logs were found for this job.</span>'
 
         else:
             open_span = False
             last = None
 
-            for stanza in log['logs']:
+            for stanza in Logs._select(_id, log_header, offset=offset, tail=tail, since=since)[2]:
                 fd = stanza['fd']
                 msg = stanza['msg']
 
@@ -534,6 +568,47 @@ class Logs(object):
             if open_span:
                 yield '</span>\n'
 
+    @staticmethod
+    def _select(_id, log_header, offset=None, tail=None, since=None):
+        """
+        Select a range of a job's log stanzas, without loading the rest of the log.
+
+        Args:
+            _id (str): The job id
+            log_header (dict): The job's job_logs document
+            offset (int): Skip the stanzas before this index
+            tail (int): Only return the last this many stanzas
+            since (datetime): Only return the stanzas added at or after this time.
+                Stanzas logged before chunking have no time and are skipped.
+
+        Returns:
+            tuple: The index of the first selected stanza, the length of the log and a stanza generator
+        """
+        legacy = log_header.get('logs', [])
+        length = len(legacy) + log_header.get('length', 0)
+
+        start = offset or 0
+        if tail is not None:
+            start = max(start, length - tail)
+
+        # Chunk positions do not count the legacy stanzas
+        chunk_start = start - len(legacy)
+
+        def stanzas():
+            if since is None:
+                for stanza in legacy[start:]:
+                    yield stanza
+
+            query = {'job': _id, 'end': {'$gt': chunk_start}}
+            if since is not None:
+                query['created'] = {'$gte': since}
+
+            for chunk in config.db.job_log_chunks.find(query).sort([('seq', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]):
+                for stanza in chunk['logs'][max(chunk_start - chunk['start'], 0):]:
+                    yield stanza
+
+        return start, length, stanzas()
+
     @staticmethod
     def add(_id, doc):
         """
@@ -546,12 +621,53 @@ class Logs(object):
         if len(doc) <= 0:
             return
 
-        log = config.db.job_logs.find_one({'_id': _id})
+        log_header = config.db.job_logs.find_one_and_update(
+            {'_id': _id},
+            {'$inc': {'seq': 1, 'length': len(doc)}},
+            projection={'seq': 1, 'length': 1},
+            upsert=True,
+            return_document=pymongo.collection.ReturnDocument.AFTER
+        )
+
+        config.db.job_log_chunks.insert_one(Logs._chunk(_id, log_header, doc))
 
-        if log is None: # Race
-            config.db.job_logs.insert_one({'_id': _id, 'logs': []})
+    @staticmethod
+    def _chunk(_id, log_header, doc):
+        """Return the chunk document appending doc to a log, given its header after reserving the chunk"""
+        return {
+            'job': _id,
+            'seq': log_header['seq'],
+            'start': log_header['length'] - len(doc),
+            'end': log_header['length'],
+            'created': datetime.datetime.utcnow(),
+            'logs': doc,
+        }
+
+    @staticmethod
+    def add_system_logs_many(job_lines):
+        """Shortcut method for adding system logs to several jobs
+
+        Each job's chunk is reserved atomically (as with add), and the chunks are inserted with one bulk write.
+
+        Args:
+            job_lines (dict): Map of job id to the list of lines to add to that job's logs
+        """
+        docs = {_id: [{'msg': line, 'fd': -1} for line in lines] for _id, lines in job_lines.iteritems() if lines}
+        if not docs:
+            return
 
-        config.db.job_logs.update({'_id': _id}, {'$push':{'logs':{'$each':doc}}})
+        chunks = []
+        for _id, doc in docs.iteritems():
+            log_header = config.db.job_logs.find_one_and_update(
+                {'_id': _id},
+                {'$inc': {'seq': 1, 'length': len(doc)}},
+                projection={'seq': 1, 'length': 1},
+                upsert=True,
+                return_document=pymongo.collection.ReturnDocument.AFTER
+            )
+            chunks.append(Logs._chunk(_id, log_header, doc))
+
+        config.db.job_log_chunks.insert_many(chunks, ordered=False)
 
     @staticmethod
     def add_system_logs(_id, lines):
@@ -9,6 +9,7 @@ class RulesMapper(object):
     def __init__(self, db=None):
         self.db = db or config.db
         self.dbc = self.db.project_rules
+        self.revisions = self.db.rule_revisions
 
     def insert(self, rule):
         """Insert a new rule
@@ -23,6 +24,7 @@ class RulesMapper(object):
         # Update the instance id if we didn't insert the rule with an id
         if rule.rule_id != result.inserted_id:
             rule.rule_id = result.inserted_id
+        self.bump_revision(rule.project_id)
         # Return the resulting id
         return result.inserted_id
 
@@ -38,9 +40,10 @@ class RulesMapper(object):
         """
         # Create the update document
         update = {'$set': doc}
-        response = self.dbc.update_one({'_id': bson.ObjectId(rule_id)}, update)
-        if response.matched_count == 0:
+        rule_doc = self.dbc.find_one_and_update({'_id': bson.ObjectId(rule_id)}, update, projection={'project_id': 1})
+        if rule_doc is None:
             raise errors.APINotFoundException('Rule {} not found'.format(rule_id))
+        self.bump_revision(rule_doc.get('project_id'))
 
 
     def find_all(self, project_id=None, gear_id=None, fixed_input=None, auto_update=None,
@@ -117,8 +120,32 @@ class RulesMapper(object):
         Returns:
             int: the number of deleted items
         """
-        result = self.dbc.delete_one({'_id': bson.ObjectId(rule_id)})
-        return result.deleted_count
+        rule_doc = self.dbc.find_one_and_delete({'_id': bson.ObjectId(rule_id)}, projection={'project_id': 1})
+        if rule_doc is None:
+            return 0
+        self.bump_revision(rule_doc.get('project_id'))
+        return 1
+
+    def get_revision(self, project_id):
+        """Get the revision of a project's rules, which changes whenever any of them changes
+
+        Args:
+            project_id (str): The project id
+
+        Returns:
+            int: the revision of the project's rules
+        """
+        result = self.revisions.find_one({'_id': str(project_id)})
+        return result['revision'] if result else 0
+
+    def bump_revision(self, project_id):
+        """Record that a project's rules have changed
+
+        Args:
+            project_id (str): The project id
+        """
+        if project_id is not None:
+            self.revisions.update_one({'_id': str(project_id)}, {'$inc': {'revision': 1}}, upsert=True)
 
     def _load_rule(self, rule_doc):
         """Loads a single rule document from mongo
@@ -1,16 +1,18 @@
 """
-A simple FIFO queue for jobs.
+A priority queue for jobs, with fair-share scheduling across groups or projects.
 """
 
 import bson
 import copy
 import pymongo
 import datetime
+import time
 
 from pprint import pformat
 
 from .. import config
-from .jobs import Job, Logs, JobTicket
+from . import job_counters
+from .jobs import Job, Logs, DEFAULT_JOB_PRIORITY
 from .gears import get_gear, validate_gear_config, fill_gear_default_values
 from ..dao.containerutil import (
     create_filereference_from_dictionary, create_containerreference_from_dictionary,
@@ -52,6 +54,44 @@ JOB_TRANSITIONS = [
 def max_attempts():
     return config.get_item('queue', 'max_retries')
 
+# Job fields that the engine request is generated from
+REQUEST_FIELDS = ('gear_id', 'config', 'inputs', 'destination')
+
+# How many jobs can be started with a single ask
+def max_jobs_per_ask():
+    return int(config.get_item('queue', 'max_jobs_per_ask'))
+
+# Which tenant level pending jobs are fair-shared across: 'group', 'project', or None to disable
+def fair_share_level():
+    level = config.get_item('queue', 'fair_share')
+    return level if level in ('group', 'project') else None
+
+# Relative share of the queue per tenant id, defaults to 1
+def fair_share_weights():
+    return config.get_item('queue', 'fair_share_weights') or {}
+
+def weighted_share(count, weights, tenant):
+    """Return a tenant's job count relative to its fair-share weight"""
+    return float(count) / max(float(weights.get(str(tenant), 1)), 0.001)
+
+# Order in which pending jobs are dispensed: highest priority first, then FIFO
+PENDING_SORT = [('priority', pymongo.DESCENDING), ('modified', pymongo.ASCENDING)]
+
+# How many rounds of fair-share allotment a claim makes before falling back to plain priority order
+FAIR_SHARE_ROUNDS = 5
+
+# How many rounds of candidate selection a multi-job claim makes before giving up on filling the request.
+# Each round only loses candidates to concurrent askers, so this bounds contention rather than work.
+CLAIM_ATTEMPTS = 3
+
+# How long a running job can go without a heartbeat before it is considered orphaned.
+# The default engine heartbeats every 30 seconds. Be careful when lowering this interval.
+def heartbeat_timeout():
+    return int(config.get_item('queue', 'heartbeat_timeout'))
+
+# How many orphaned jobs are failed and retried with each set of bulk writes
+ORPHAN_BATCH_SIZE = 500
+
 # Should a job be retried when explicitly failed.
 # Does not affect orphaned jobs.
 def retry_on_explicit_fail():
@@ -93,10 +133,11 @@ class Queue(object):
             if mutation['state'] == 'running':
 
                 # !!!
-                # !!! DUPE WITH Queue.run_jobs_with_query
+                # !!! DUPE WITH Queue.prepare_started_jobs
                 # !!!
 
-                mutation['request'] = job.generate_request(get_gear(job.gear_id))
+                if job.request is None:
+                    mutation['request'] = job.generate_request(get_gear(job.gear_id))
             elif mutation['state'] in ('complete', 'failed', 'cancelled') and job.state == 'running':
                 if job.transitions and 'running' in job.transitions:
                     mutation['profile.total_time_ms'] = int((now - job.transitions['running']).total_seconds() * 1000)
@@ -114,25 +155,153 @@ class Queue(object):
             'state': job.state,
         }
 
-        result = config.db.jobs.update_one(job_query, {'$set': mutation})
+        update = {'$set': mutation}
+
+        # Changing what a pending job runs drops its precomputed request, to be regenerated when started
+        if job.state == 'pending' and 'request' not in mutation:
+            if any(key.split('.')[0] in REQUEST_FIELDS for key in mutation):
+                update['$unset'] = {'request': ''}
+
+        result = config.db.jobs.update_one(job_query, update)
         if result.modified_count != 1:
             raise Exception('Job modification not saved')
 
+        # Keep the job counters in step; the state in the query guarantees the transition happened once
+        state = mutation.get('state', job.state)
+        if state != job.state:
+            job_counters.count_transition([job], job.state, state)
+        if 'compute_provider_id' in mutation:
+            job_counters.count_provider_change(job, state, mutation['compute_provider_id'])
+
         # If the job did not succeed, check to see if job should be retried.
         if 'state' in mutation and mutation['state'] == 'failed' and retry_on_explicit_fail():
             job.state = 'failed'
             Queue.retry(job)
 
+    @staticmethod
+    def cancel_pending(job_ids):
+        """
+        Cancel the jobs of job_ids that are still pending with a single write.
+        This is the bulk counterpart of mutating each job to 'cancelled'.
+
+        Returns the number of jobs cancelled.
+        """
+
+        if not job_ids:
+            return 0
+
+        # Cancel the jobs of each gear and compute provider separately, to know how to update the job counters
+        query = {'_id': {'$in': [bson.ObjectId(job_id) for job_id in job_ids]}, 'state': 'pending'}
+        by_counter = {}
+        for doc in config.db.jobs.find(query, {'gear_id': 1, 'gear_info': 1, 'compute_provider_id': 1}):
+            by_counter.setdefault((doc.get('gear_id'), doc.get('compute_provider_id')), []).append(doc)
+
+        now = datetime.datetime.utcnow()
+        cancelled = 0
+        for docs in by_counter.itervalues():
+            result = config.db.jobs.update_many(
+                {'_id': {'$in': [doc['_id'] for doc in docs]}, 'state': 'pending'},
+                {'$set': {'state': 'cancelled', 'transitions.cancelled': now, 'modified': now}})
+            job_counters.count_transition(docs[:result.modified_count], 'pending', 'cancelled')
+            cancelled += result.modified_count
+
+        log.info('Cancelled %d pending jobs', cancelled)
+        return cancelled
+
     @staticmethod
     def retry(job, force=False, only_failed=True):
         """
         Given a failed job, either retry the job or fail it permanently, based on the attempt number.
         Can override the attempt limit by passing force=True.
         """
+        return Queue.retry_jobs([job], force=force, only_failed=only_failed)[job.id_]
+
+    @staticmethod
+    def retry_jobs(jobs, force=False, only_failed=True, on_error=None):
+        """
+        Retry a list of failed jobs, or fail them permanently, based on their attempt numbers.
+        The retries are spawned with a single insert_many, along with bulk writes of the related
+        analysis, retried time and batch updates.
+
+        Errors preparing a retry are raised, unless on_error is given: then it is called with the job
+        and the exception, and the other jobs are still retried.
+
+        Returns a map of the given job ids to the respawned job ids (None if not retried).
+        """
+
+        new_ids = {job.id_: None for job in jobs}
+        if not jobs:
+            return new_ids
+
+        # Race condition: jobs should only be marked as failed once a new job has been spawned for it (if any).
+        # No transactions in our database, so we can't do that.
+        # Instead, make a best-hope attempt.
+        already_retried = {
+            doc['previous_job_id']: doc['_id']
+            for doc in config.db.jobs.find({'previous_job_id': {'$in': list(new_ids)}}, {'previous_job_id': 1})
+        }
+
+        retries = []
+        for job in jobs:
+            try:
+                new_job = Queue._prepare_retry(job, force, only_failed, already_retried.get(job.id_))
+            except Exception as e:  # pylint: disable=broad-except
+                if on_error is None:
+                    raise
+                on_error(job, e)
+                continue
+
+            if new_job is not None:
+                retries.append((job, new_job))
+
+        if not retries:
+            return new_ids
+
+        analysis_updates = [
+            pymongo.UpdateOne({'_id': bson.ObjectId(new_job.destination.id)},
+                              {'$set': {'job': str(new_job.id_), 'modified': new_job.created}})
+            for _, new_job in retries if new_job.destination.type == 'analysis'
+        ]
+        if analysis_updates:
+            config.db.analyses.bulk_write(analysis_updates, ordered=False)
+
+        result = config.db.jobs.bulk_write([
+            pymongo.UpdateOne({'_id': bson.ObjectId(job.id_)}, {'$set': {'retried': new_job.created}})
+            for job, new_job in retries
+        ], ordered=False)
+        if result.modified_count != len(retries):
+            log.error('Could not set retried time for %d of %d jobs', len(retries) - result.modified_count, len(retries))
+
+        Job.insert_many([new_job for _, new_job in retries])
+
+        for job, new_job in retries:
+            new_ids[job.id_] = new_job.id_
+            log.info('respawned job %s as %s (attempt %d)', job.id_, new_job.id_, new_job.attempt)
+
+        # If job is part of batch job run, update batch jobs list
+        batch_updates = []
+        for batch in config.db.batch.find({'jobs': {'$in': [job.id_ for job, _ in retries]}}):
+            for job, new_job in retries:
+                if job.id_ in batch['jobs']:
+                    batch['jobs'].remove(job.id_)
+                    batch['jobs'].append(new_job.id_)
+                    log.info('updated batch job list, replacing {} with {}'.format(job.id_, new_job.id_))
+            batch_updates.append(pymongo.UpdateOne({'_id': batch['_id']}, {'$set': {'jobs': batch['jobs']}}))
+        if batch_updates:
+            config.db.batch.bulk_write(batch_updates, ordered=False)
+
+        return new_ids
+
+    @staticmethod
+    def _prepare_retry(job, force, only_failed, retried_as):
+        """
+        Check that a job can be retried and return its (not yet inserted) retry,
+        or None if the job is failed permanently.
+        """
 
         if job.attempt >= max_attempts() and not force:
             log.info('Permanently failed job %s (after %d attempts)', job.id_, job.attempt)
-            return
+            return None
 
         if job.state in ['cancelled', 'complete']:
             if only_failed:
@@ -144,13 +313,8 @@ class Queue(object):
         if job.request is None:
             raise Exception('Cannot retry a job without a request')
 
-        # Race condition: jobs should only be marked as failed once a new job has been spawned for it (if any).
-        # No transactions in our database, so we can't do that.
-        # Instead, make a best-hope attempt.
-        check = config.db.jobs.find_one({'previous_job_id': job.id_ })
-        if check is not None:
-            found = Job.load(check)
-            raise Exception('Job ' + job.id_ + ' has already been retried as ' + str(found.id_))
+        if retried_as is not None:
+            raise Exception('Job ' + job.id_ + ' has already been retried as ' + str(retried_as))
 
         new_job_map = job.map()
         new_job_map['config'] = new_job_map['config']['config']
@@ -158,36 +322,12 @@ class Queue(object):
         new_job.previous_job_id = job.id_
         new_job.attempt += 1
         new_job.request = copy.deepcopy(job.request)
-        new_job.id_ = bson.ObjectId()
 
-        # update input uris that reference the old job id
+        # update input uris that reference the old job id with the one reserved by enqueue_job
         for i in new_job.request['inputs']+new_job.request['outputs']:
             i['uri'] = i['uri'].replace(str(job.id_), str(new_job.id_))
 
-        if new_job.destination.type == 'analysis':
-            config.db.analyses.update_one({'_id': bson.ObjectId(new_job.destination.id)},
-                                          {'$set': {'job': str(new_job.id_),
-                                                    'modified': new_job.created}})
-
-        result = config.db.jobs.update_one({"_id": bson.ObjectId(job.id_)}, {'$set': {"retried": new_job.created}})
-        if result.modified_count != 1:
-            log.error('Could not set retried time for job {}'.format(job.id_))
-
-        new_id = new_job.insert(ignore_insertion_block=True)
-        log.info('respawned job %s as %s (attempt %d)', job.id_, new_id, new_job.attempt)
-
-        # If job is part of batch job run, update batch jobs list
-        batch = config.db.batch.find_one({'jobs': job.id_})
-        if batch:
-            batch['jobs'].remove(job.id_)
-            batch['jobs'].append(new_id)
-            config.db.batch.update_one(
-                {'jobs': job.id_},
-                {'$set': {'jobs': batch['jobs']}}
-            )
-            log.info('updated batch job list, replacing {} with {}'.format(job.id_, new_id))
-
-        return new_id
+        return new_job
 
     @staticmethod
     def enqueue_job(job_map, origin, perm_check_uid=None):
@@ -244,6 +384,10 @@ class Queue(object):
         previous_job_id = job_map.get('previous_job_id', None)
         batch           = job_map.get('batch', None) # A batch id if this job is part of a batch run
         label           = job_map.get('label', "")
+        priority        = job_map.get('priority', DEFAULT_JOB_PRIORITY)
+
+        if not isinstance(priority, (int, long)) or isinstance(priority, bool):
+            raise errors.InputValidationException('Job priority must be an integer')
 
         # Add destination container, or select one
         destination = None
@@ -385,7 +529,13 @@ class Queue(object):
 
         job = Job(gear, inputs, destination=destination, tags=tags, config_=config_, attempt=attempt,
             previous_job_id=previous_job_id, origin=origin, batch=batch, parents=parents, profile=profile,
-            related_container_ids=list(related_containers), label=label, compute_provider_id=compute_provider_id)
+            related_container_ids=list(related_containers), label=label, compute_provider_id=compute_provider_id,
+            priority=priority)
+
+        # Reserve the job id and generate the engine request up front (the request references the id),
+        # so that starting the job is a single write that already holds everything the engine needs.
+        job.id_ = str(bson.ObjectId())
+        job.generate_request(gear)
 
         return job
 
@@ -496,7 +646,7 @@ class Queue(object):
         """
         Atomically change up to N jobs from pending to running.
 
-        Will return empty array if there are no jobs to offer. Searches for jobs in FIFO order.
+        Will return empty array if there are no jobs to offer. Searches for jobs in scheduling order.
         """
 
         query = Queue.lists_to_query(whitelist, blacklist, capabilities)
@@ -513,6 +663,18 @@ class Queue(object):
         If changes are unavoidable, then update the corresponding function above.
         """
 
+        by_state = {s: 0 for s in JOB_STATES}
+
+        # The job counters track gear names, compute providers and capabilities; other filters need an aggregation
+        if not any(xlist.get(key) for xlist in (whitelist, blacklist) for key in ('group', 'tag', 'created-by')):
+            by_state.update(job_counters.get_counts(
+                gear_names=whitelist.get('gear-name') or None,
+                excluded_gear_names=blacklist.get('gear-name') or None,
+                provider_ids=whitelist.get('compute-provider') or None,
+                excluded_provider_ids=blacklist.get('compute-provider') or None,
+                capabilities=capabilities))
+            return by_state
+
         query = Queue.lists_to_query(whitelist, blacklist, capabilities)
 
         # Pipeline aggregation
@@ -525,7 +687,6 @@ class Queue(object):
         ]))
 
         # Map the mongo result to something useful
-        by_state = {s: 0 for s in JOB_STATES}
         by_state.update({r['_id']: r['count'] for r in result})
 
         return by_state
@@ -535,83 +696,283 @@ class Queue(object):
         """
         Given a database query, transitions up to N jobs from pending to running.
 
-        Will return empty array if there are no jobs to offer. Searches for jobs in FIFO order.
+        Will return empty array if there are no jobs to offer. Searches for jobs in scheduling order,
+        see Queue.claim_scheduled_jobs.
         """
 
-        if max_jobs > 1:
-            raise errors.InputValidationException('Starting multiple jobs not supported')
         if max_jobs < 1:
             raise errors.InputValidationException('Must start at least one job')
+        if max_jobs > max_jobs_per_ask():
+            raise errors.InputValidationException('Cannot start more than {} jobs at once'.format(max_jobs_per_ask()))
         if peek and max_jobs > 1:
             raise errors.InputValidationException('Cannot peek more than one job')
 
         query['state'] = 'pending'
 
-        now = datetime.datetime.utcnow()
-        modification = { '$set': {
-            'state': 'running',
-            'transitions.running': now,
-            'modified': now
-        }}
-
         if peek:
-            # placeholder noop
-            modification = {'$setOnInsert': {'1': 1}}
+            return Queue.peek_job_with_query(query)
+
+        docs = Queue.claim_scheduled_jobs(max_jobs, query)
+
+        return Queue.prepare_started_jobs([Job.load(doc) for doc in docs])
 
-        # Search ordering by FIFO
-        result = config.db.jobs.find_one_and_update(
-            query,
-            modification,
-            sort=[('modified', 1)],
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+    @staticmethod
+    def pending_tenants(query):
+        """
+        Find the top pending priority and the tenants that have pending jobs at that priority.
+
+        Tenant discovery is deliberately limited to the indexed state/priority prefix (and any group or
+        project filter of the query), so some of the returned tenants may not have jobs matching the
+        rest of the query.
+
+        Returns (priority, tenant_key, tenants), or None when fair-share does not apply.
+        """
+
+        level = fair_share_level()
+        if not level:
+            return None
+
+        top = config.db.jobs.find_one(query, {'priority': 1}, sort=PENDING_SORT)
+        if top is None:
+            return None
+
+        tenant_key = 'parents.' + level
+        priority = top.get('priority')
+        discovery = {'state': 'pending', 'priority': priority}
+        for key in ('parents.group', 'parents.project'):
+            if key in query:
+                discovery[key] = query[key]
+
+        tenants = config.db.jobs.distinct(tenant_key, discovery)
+        if len(tenants) <= 1:
+            return None
+
+        return priority, tenant_key, tenants
+
+    @staticmethod
+    def claim_scheduled_jobs(max_jobs, query):
+        """
+        Claim up to N pending jobs matching query, in scheduling order.
+
+        Jobs are dispensed highest priority first, FIFO within a priority. When fair-share is enabled
+        (see fair_share_level), the tenants that have pending work at the top priority are allotted
+        jobs one at a time to whichever has the lowest running job count relative to its weight, so
+        that a tenant with a large backlog cannot starve the others. Each tenant's allotment is then
+        claimed in bulk. Tenants that come up short are dropped and their share re-allotted, for at
+        most FAIR_SHARE_ROUNDS rounds, after which any shortfall is claimed in plain priority order.
+        """
+
+        claimed = []
+        pending = Queue.pending_tenants(query)
+
+        if pending is not None:
+            priority, tenant_key, tenants = pending
+            running = Queue.tenant_counts(tenant_key, 'running', tenants)
+            weights = fair_share_weights()
+
+            for _ in range(FAIR_SHARE_ROUNDS):
+                if not tenants or len(claimed) >= max_jobs:
+                    break
+
+                allotment = {}
+                for _ in range(max_jobs - len(claimed)):
+                    _, _, tenant = min((weighted_share(running.get(t, 0) + allotment.get(t, 0), weights, t), str(t), t)
+                                       for t in tenants)
+                    allotment[tenant] = allotment.get(tenant, 0) + 1
+
+                for tenant in sorted(allotment, key=lambda t: (weighted_share(running.get(t, 0), weights, t), str(t))):
+                    docs = Queue.claim_jobs_with_query(allotment[tenant],
+                        {'$and': [query, {tenant_key: tenant, 'priority': priority}]})
+                    claimed.extend(docs)
+                    running[tenant] = running.get(tenant, 0) + len(docs)
+                    if len(docs) < allotment[tenant]:
+                        tenants.remove(tenant)
+
+        if len(claimed) < max_jobs:
+            claimed.extend(Queue.claim_jobs_with_query(max_jobs - len(claimed), query))
+
+        return claimed
+
+    @staticmethod
+    def tenant_counts(tenant_key, state, tenants=None):
+        """
+        Count jobs in a state for each tenant (group or project id) under the given parents key.
+        """
+
+        match = {'state': state}
+        if tenants is not None:
+            match[tenant_key] = {'$in': tenants}
+
+        result = config.db.jobs.aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': '$' + tenant_key,
+                'count': {'$sum': 1}}
+            }
+        ])
+        return {r['_id']: r['count'] for r in result}
+
+    @staticmethod
+    def tenant_backlog():
+        """
+        Return the pending and running job counts and fair-share weight of every tenant with work.
+        """
+
+        level = fair_share_level() or 'group'
+        weights = fair_share_weights()
+
+        backlog = {}
+        for state in ('pending', 'running'):
+            for tenant, count in Queue.tenant_counts('parents.' + level, state).iteritems():
+                entry = backlog.setdefault(str(tenant), {'pending': 0, 'running': 0, 'weight': weights.get(str(tenant), 1)})
+                entry[state] = count
+
+        return {'level': level, 'tenants': backlog}
+
+    @staticmethod
+    def peek_job_with_query(query):
+        """
+        Return the next pending job matching query, with a generated request, without starting it.
+        """
+
+        result = None
+        pending = Queue.pending_tenants(query)
+
+        if pending is not None:
+            priority, tenant_key, tenants = pending
+            running = Queue.tenant_counts(tenant_key, 'running', tenants)
+            weights = fair_share_weights()
+
+            ordered = sorted(tenants, key=lambda t: (weighted_share(running.get(t, 0), weights, t), str(t)))
+            for tenant in ordered[:FAIR_SHARE_ROUNDS]:
+                result = config.db.jobs.find_one({'$and': [query, {tenant_key: tenant, 'priority': priority}]}, sort=PENDING_SORT)
+                if result is not None:
+                    break
+
+        if result is None:
+            result = config.db.jobs.find_one(query, sort=PENDING_SORT)
 
         if result is None:
             return []
 
         job = Job.load(result)
-
-        if peek:
-            gear = get_gear(job.gear_id)
-            for key in gear['gear']['inputs']:
-                if gear['gear']['inputs'][key] == 'api-key':
-                    # API-key gears cannot be peeked
-                    return []
-
-        # Return if there is a job request already
-        if job.request is not None:
-            log.info('Job %s already has a request, so not generating', job.id_)
-            return [job]
-
-        # Create a new request formula
-        # !!!
-        # !!! DUPE WITH Queue.mutate
-        # !!!
         gear = get_gear(job.gear_id)
-        request = job.generate_request(gear)
+        for key in gear['gear']['inputs']:
+            if gear['gear']['inputs'][key] == 'api-key':
+                # API-key gears cannot be peeked
+                return []
 
-        if peek:
-            job.request = request
-            return [job]
+        if job.request is None:
+            job.generate_request(gear)
 
-        # Save and return
-        result = config.db.jobs.find_one_and_update(
-            {
-                '_id': bson.ObjectId(job.id_)
-            },
-            { '$set': {
-                'request': request }
-            },
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+        return [job]
 
-        if result is None:
-            raise Exception('Marked job as running but could not generate and save formula')
+    @staticmethod
+    def claim_jobs_with_query(max_jobs, query):
+        """
+        Atomically transition up to N pending jobs matching query to running.
+
+        A single job is claimed with find_one_and_update. Multiple candidates are selected in
+        scheduling order and claimed with a single update_many that is conditional on the job still
+        matching the (pending) query, so a job claimed by a concurrent asker is skipped rather than
+        handed out twice. Each claim pass is tagged with a unique claim_id, which identifies exactly
+        the jobs that this pass won (and is removed once they are read back).
+
+        Returns the claimed job documents, in scheduling order.
+        """
+
+        if max_jobs == 1:
+            now = datetime.datetime.utcnow()
+            result = config.db.jobs.find_one_and_update(
+                query,
+                { '$set': {
+                    'state': 'running',
+                    'transitions.running': now,
+                    'modified': now
+                }},
+                sort=PENDING_SORT,
+                return_document=pymongo.collection.ReturnDocument.AFTER
+            )
+            if result is None:
+                return []
+            job_counters.count_transition([result], 'pending', 'running')
+            return [result]
+
+        claimed = []
+
+        for _ in range(CLAIM_ATTEMPTS):
+            remaining = max_jobs - len(claimed)
+            candidates = [doc['_id'] for doc in config.db.jobs.find(
+                query, {'_id': 1}, sort=PENDING_SORT, limit=remaining)]
 
-        Logs.add_system_logs(job.id_, 'Gear Name: {}, Gear Version: {}\n'.format(gear['gear']['name'], gear['gear']['version']))
-        log.info('Starting Job {}. Gear Name: {}, Gear Version: {}'.format(job.id_, gear['gear']['name'], gear['gear']['version']))
+            if not candidates:
+                break
+
+            now = datetime.datetime.utcnow()
+            claim_id = bson.ObjectId()
+
+            result = config.db.jobs.update_many(
+                {'$and': [query, {'_id': {'$in': candidates}}]},
+                { '$set': {
+                    'state': 'running',
+                    'transitions.running': now,
+                    'modified': now,
+                    'claim_id': claim_id
+                }}
+            )
+
+            if result.modified_count > 0:
+                docs = list(config.db.jobs.find({'_id': {'$in': candidates}, 'claim_id': claim_id}, {'claim_id': 0}))
+                config.db.jobs.update_many({'_id': {'$in': candidates}, 'claim_id': claim_id}, {'$unset': {'claim_id': ''}})
+                job_counters.count_transition(docs, 'pending', 'running')
+                docs_by_id = {doc['_id']: doc for doc in docs}
+                claimed.extend(docs_by_id[job_id] for job_id in candidates if job_id in docs_by_id)
+
+            if len(claimed) >= max_jobs or len(candidates) < remaining:
+                break
 
-        return [Job.load(result)]
+        return claimed
+
+    @staticmethod
+    def prepare_started_jobs(jobs):
+        """
+        Log the start of a list of freshly started jobs, and make sure each has an engine request.
+
+        Requests are generated when a job is enqueued, so this normally needs no gear lookups. Jobs
+        whose request was dropped since (see Queue.mutate, gears.invalidate_job_requests) get it
+        regenerated with one gear lookup per gear, and all regenerated requests are saved in one bulk
+        write. The start of every job is recorded in its system logs with another bulk write.
+        """
+
+        gears = {}
+        requests = []
+        system_logs = {}
+
+        for job in jobs:
+            if job.request is None:
+                if job.gear_id not in gears:
+                    gears[job.gear_id] = get_gear(job.gear_id)
+
+                # Create a new request formula
+                # !!!
+                # !!! DUPE WITH Queue.mutate
+                # !!!
+                log.info('Job %s has no request, so generating', job.id_)
+                request = job.generate_request(gears[job.gear_id])
+                requests.append(pymongo.UpdateOne({'_id': bson.ObjectId(job.id_)}, {'$set': {'request': request}}))
+
+            gear_name, gear_version = job.gear_info['name'], job.gear_info['version']
+            system_logs[job.id_] = ['Gear Name: {}, Gear Version: {}\n'.format(gear_name, gear_version)]
+            log.info('Starting Job {}. Gear Name: {}, Gear Version: {}'.format(job.id_, gear_name, gear_version))
+
+        if requests:
+            result = config.db.jobs.bulk_write(requests, ordered=False)
+            if result.matched_count != len(requests):
+                raise Exception('Marked jobs as running but could not generate and save formula')
+
+        Logs.add_system_logs_many(system_logs)
+
+        return jobs
 
     @staticmethod
     def search_containers(containers, states=None, tags=None, limit=100, skip=0):
@@ -656,54 +1017,83 @@ class Queue(object):
         """
         Scan the queue for orphaned jobs, mark them as failed, and possibly retry them.
         Should be called periodically.
-        """
 
-        orphaned = 0
-        ticketed_jobs = []
+        Running jobs without a heartbeat for longer than the configured timeout are found with a single
+        query and handled in batches: jobs that are currently attempting to complete (have a ticket)
+        are skipped, and the rest are failed with one update_many, which is conditional on the job still
+        being stale. Each batch is tagged with a unique reap_id, which identifies exactly the jobs that
+        were orphaned (and is removed once they are read back). Their system logs and retries are then
+        written in bulk. The launches of batch jobs whose launcher is gone are stopped as well.
 
+        Returns the number of orphaned and retried jobs, the number of stopped batch launches, and the
+        duration of the scan in milliseconds.
+        """
+        # Imported here, as the batch module imports the queue
+        from .batch import reap_stale_launches
 
-        # When the backend is busy / crashing / being upgraded, heartbeats can take a very long time or fail.
-        # The default engine heartbeats every 30 seconds. Be careful when lowering this interval.
+        start = time.time()
+        orphaned, retried = 0, 0
 
+        # When the backend is busy / crashing / being upgraded, heartbeats can take a very long time or fail.
         query = {
             'state': 'running',
-            'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=300)},
-            '_id': { '$nin': ticketed_jobs },
+            'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=heartbeat_timeout())},
         }
 
-        while True:
-            orphan_candidate = config.db.jobs.find_one(query)
-            if orphan_candidate is None:
-                break
+        candidates = [doc['_id'] for doc in config.db.jobs.find(query, {'_id': 1})]
+
+        for i in range(0, len(candidates), ORPHAN_BATCH_SIZE):
+            batch = candidates[i:i + ORPHAN_BATCH_SIZE]
 
             # If the job is currently attempting to complete, do not orphan.
-            ticket = JobTicket.find(orphan_candidate['_id'])
-            if ticket is not None and len(ticket) > 0:
-                ticketed_jobs.append(orphan_candidate['_id'])
+            ticketed = set(config.db.job_tickets.distinct('job', {'job': {'$in': [str(_id) for _id in batch]}}))
+            batch = [_id for _id in batch if str(_id) not in ticketed]
+            if not batch:
                 continue
 
-            # CAS this job, since it does not have a ticket
-            select = { '_id': orphan_candidate['_id'] }
-
-            doc = config.db.jobs.find_one_and_update(
-                dict(query, **select),
-                {
-                    '$set': {
-                        'state': 'failed', },
-                },
-                return_document=pymongo.collection.ReturnDocument.AFTER
+            # CAS these jobs, since they do not have a ticket
+            reap_id = bson.ObjectId()
+            config.db.jobs.update_many(
+                {'$and': [query, {'_id': {'$in': batch}}]},
+                {'$set': {'state': 'failed', 'reap_id': reap_id}}
             )
 
-            if doc is None:
-                log.info('Job %s was heartbeat during a ticket lookup and thus not orhpaned', orphan_candidate['_id'])
-            else:
-                orphaned += 1
-                j = Job.load(doc)
-                Logs.add_system_logs(j.id_, 'The job did not report in for a long time and was canceled. ')
-                new_id = Queue.retry(j)
-                Logs.add_system_logs(j.id_, 'Retried job as ' + str(new_id) if new_id else 'Job retries exceeded maximum allowed')
+            jobs = [Job.load(doc) for doc in config.db.jobs.find({'_id': {'$in': batch}, 'reap_id': reap_id})]
+            config.db.jobs.update_many({'_id': {'$in': batch}, 'reap_id': reap_id}, {'$unset': {'reap_id': ''}})
+            if len(jobs) < len(batch):
+                log.info('%d jobs were heartbeat during a ticket lookup and thus not orphaned', len(batch) - len(jobs))
+            if not jobs:
+                continue
 
-        return orphaned
+            job_counters.count_transition(jobs, 'running', 'failed')
+            orphaned += len(jobs)
+            Logs.add_system_logs_many({
+                job.id_: ['The job did not report in for a long time and was canceled. '] for job in jobs
+            })
+
+            def retry_failed(job, exc_val):
+                log.error('Could not retry orphaned job %s: %s', job.id_, exc_val)
+
+            new_ids = Queue.retry_jobs(jobs, on_error=retry_failed)
+            retried += sum(1 for new_id in new_ids.itervalues() if new_id)
+            Logs.add_system_logs_many({
+                job_id: ['Retried job as ' + str(new_id) if new_id else 'Job retries exceeded maximum allowed']
+                for job_id, new_id in new_ids.iteritems()
+            })
+
+        stale_batch_launches = reap_stale_launches()
+
+        duration_ms = int((time.time() - start) * 1000)
+        if candidates or stale_batch_launches:
+            log.info('Orphan scan found %d stale jobs, orphaned %d and retried %d, and stopped %d batch launches in %d ms',
+                     len(candidates), orphaned, retried, stale_batch_launches, duration_ms)
+
+        return {
+            'orphaned': orphaned,
+            'retried': retried,
+            'stale_batch_launches': stale_batch_launches,
+            'duration_ms': duration_ms,
+        }
 
     #
     # Legacy calls, to be removed later
@@ -737,7 +1127,7 @@ class Queue(object):
     def start_job_parsing_tags(tags=None, peek=False):
         """
         Calls start_jobs with only 1 job, parsing the old, !-prefixed variant of tag blacklisting.
-        Will return None if there are no jobs to offer. Searches for jobs in FIFO order.
+        Will return None if there are no jobs to offer. Searches for jobs in scheduling order.
         """
 
         whitelist, blacklist = Queue.legacy_tag_parse(tags)
@@ -753,13 +1143,14 @@ class Queue(object):
             return result[0]
 
     @staticmethod
-    def get_statistics(tags=None, last=None, unique=False, all_flag=False):
+    def get_statistics(tags=None, last=None, unique=False, all_flag=False, backlog=False):
         """
         Return a variety of interesting information about the job queue.
         """
 
         if all_flag:
             unique = True
+            backlog = True
             if last is None:
                 last = 3
 
@@ -773,6 +1164,10 @@ class Queue(object):
         if unique:
             results['unique'] = sorted(config.db.jobs.distinct('tags'))
 
+        # List pending and running jobs per fair-share tenant
+        if backlog:
+            results['backlog'] = Queue.tenant_backlog()
+
         # List recently modified jobs for each state
         if last is not None:
             results['recent'] = {s: config.db.jobs.find({
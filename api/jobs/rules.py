@@ -1,3 +1,4 @@
+import collections
 import fnmatch
 import re
 import itertools
@@ -69,98 +70,220 @@ def get_base_rules():
 def _log_file_key_error(file_, container, error):
     log.warning('file ' + file_.get('name', '?') + ' in container ' + str(container.get('_id', '?')) + ' ' + error)
 
-def eval_match(match_type, match_param, file_, container, regex=False):
+def compile_match(match_type, match_param, regex=False):
     """
-    Given a match entry, return if the match succeeded.
+    Compile a match entry into a function of (file_, container) that returns if the match succeeded.
+
+    Patterns are compiled once, so that the returned function is cheap to evaluate against many files.
     """
 
-    def match(value):
-        if regex:
-            return re.match(match_param, value, flags=re.IGNORECASE) is not None
-        elif match_type == 'file.name':
-            return fnmatch.fnmatch(value.lower(), match_param.lower())
-        else:
-            return match_param.lower() == value.lower()
+    if regex:
+        pattern = re.compile(match_param, flags=re.IGNORECASE)
+        def match(value):
+            return pattern.match(value) is not None
+    elif match_type == 'file.name':
+        pattern = re.compile(fnmatch.translate(match_param.lower()))
+        def match(value):
+            return pattern.match(value.lower()) is not None
+    else:
+        param = match_param.lower() if match_param else match_param
+        def match(value):
+            return param == value.lower()
 
     # Match the file's type
     if match_type == 'file.type':
-        file_type = file_.get('type')
-        if file_type:
-            return match(file_type)
-        else:
-            _log_file_key_error(file_, container, 'has no type')
-            return False
+        def evaluate(file_, container):
+            file_type = file_.get('type')
+            if file_type:
+                return match(file_type)
+            else:
+                _log_file_key_error(file_, container, 'has no type')
+                return False
 
     # Match the file's modality
-    if match_type == 'file.modality':
-        file_modality = file_.get('modality')
-        if file_modality:
-            return match(file_modality)
-        else:
-            return False
+    elif match_type == 'file.modality':
+        def evaluate(file_, _container):
+            file_modality = file_.get('modality')
+            if file_modality:
+                return match(file_modality)
+            else:
+                return False
 
     # Match a shell glob for the file name
     elif match_type == 'file.name':
-        return match(file_['name'])
+        def evaluate(file_, _container):
+            return match(file_['name'])
 
     # Match any of the file's classification
     elif match_type == 'file.classification':
-        if match_param:
-            classification_values = list(itertools.chain.from_iterable(file_.get('classification', {}).itervalues()))
-            return any(match(value) for value in classification_values)
-        else:
-            return False
+        def evaluate(file_, _container):
+            if match_param:
+                classification_values = itertools.chain.from_iterable(file_.get('classification', {}).itervalues())
+                return any(match(value) for value in classification_values)
+            else:
+                return False
 
     # Match the container having any file (including this one) with this type
     elif match_type == 'container.has-type':
-        for c_file in container['files']:
-            c_file_type = c_file.get('type')
-            if c_file_type and match(c_file_type):
-                return True
+        def evaluate(_file, container):
+            for c_file in container['files']:
+                c_file_type = c_file.get('type')
+                if c_file_type and match(c_file_type):
+                    return True
 
-        return False
+            return False
 
     # Match the container having any file (including this one) with this classification
     elif match_type == 'container.has-classification':
-        if match_param:
-            for c_file in container['files']:
-                classification_values = list(itertools.chain.from_iterable(c_file.get('classification', {}).itervalues()))
-                if any(match(value) for value in classification_values):
-                    return True
+        def evaluate(_file, container):
+            if match_param:
+                for c_file in container['files']:
+                    classification_values = itertools.chain.from_iterable(c_file.get('classification', {}).itervalues())
+                    if any(match(value) for value in classification_values):
+                        return True
 
-        return False
+            return False
 
-    raise Exception('Unimplemented match type ' + match_type)
+    else:
+        def evaluate(_file, _container):
+            raise Exception('Unimplemented match type ' + match_type)
 
-def eval_rule(rule, file_, container):
+    return evaluate
+
+def eval_match(match_type, match_param, file_, container, regex=False):
     """
-    Decide if a rule should spawn a job.
+    Given a match entry, return if the match succeeded.
     """
+    return compile_match(match_type, match_param, regex=regex)(file_, container)
+
+class CompiledRule(object):
+    """A rule with its match entries compiled, ready to be evaluated against many files"""
 
-    # Are there matches in the 'not' set?
-    for match in rule.not_:
-        if eval_match(match['type'], match['value'], file_, container, regex=match.get('regex')):
+    def __init__(self, rule):
+        self.rule = rule
+        self.not_, self.any_, self.all_ = [], [], []
+        self.container_dependent = False
+        self.fixed_inputs = set()
+
+        # The errors of a rule that could not be compiled (eg. an invalid regex), raised when it is evaluated
+        # so that it is reported like any other rule failure, without affecting the project's other rules
+        self.errors = []
+        try:
+            self.not_ = [self._compile(match) for match in rule.not_]
+            self.any_ = [self._compile(match) for match in rule.any_]
+            self.all_ = [self._compile(match) for match in rule.all_]
+
+            # Whether the rule looks at the container's other files, not only the file being evaluated
+            self.container_dependent = any(match['type'].startswith('container.')
+                                           for match in rule.not_ + rule.any_ + rule.all_)
+
+            self.fixed_inputs = set((fixed_input['type'], str(fixed_input['id']), fixed_input['name'])
+                                    for fixed_input in rule.fixed_inputs or [])
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning('Unable to compile rule %s(name=%s): %s', rule.get('_id'), rule.get('name'), e)
+            self.errors.append(e)
+
+    def has_fixed_input(self, file_refs):
+        """Return True if any of the given FileReferences is one of the rule's fixed inputs"""
+        return any((file_ref.type, file_ref.id, file_ref.name) in self.fixed_inputs for file_ref in file_refs)
+
+    @staticmethod
+    def _compile(match):
+        return compile_match(match['type'], match['value'], regex=match.get('regex'))
+
+    def matches(self, file_, container):
+        """
+        Decide if the rule should spawn a job.
+        """
+        if self.errors:
+            raise self.errors[0]
+
+        # Are there matches in the 'not' set?
+        for match in self.not_:
+            if match(file_, container):
+                return False
+
+        # Are there matches in the 'any' set?
+        # If there were matches in the 'any' array and none of them succeeded
+        if self.any_ and not any(match(file_, container) for match in self.any_):
             return False
 
-    # Are there matches in the 'any' set?
-    must_match = len(rule.any_) > 0
-    has_match = False
+        # Are there matches in the 'all' set?
+        for match in self.all_:
+            if not match(file_, container):
+                return False
 
-    for match in rule.any_:
-        if eval_match(match['type'], match['value'], file_, container, regex=match.get('regex')):
-            has_match = True
-            break
+        return True
 
-    # If there were matches in the 'any' array and none of them succeeded
-    if must_match and not has_match:
-        return False
+class CompiledRuleSet(object):
+    """
+    The compiled rules of a project, indexed so that only the rules that can match a file are evaluated.
 
-    # Are there matches in the 'all' set?
-    for match in rule.all_:
-        if not eval_match(match['type'], match['value'], file_, container, regex=match.get('regex')):
-            return False
+    A rule whose 'all' set requires a plain (non-regex) file type or classification is indexed by that
+    value, and one requiring a plain file name glob by the glob. Other rules are candidates for every file.
+    Candidates are returned in the original rule order.
+    """
 
-    return True
+    def __init__(self, rules):
+        self.rules = [CompiledRule(rule) for rule in rules]
+
+        self.by_type = collections.defaultdict(list)
+        self.by_classification = collections.defaultdict(list)
+        self.by_name = collections.OrderedDict()
+        self.unindexed = []
+
+        for position, compiled in enumerate(self.rules):
+            # Broken rules are candidates for every file, to be reported when evaluated
+            index, value = self._index_key(compiled.rule) if not compiled.errors else (None, None)
+            if index == 'file.type':
+                self.by_type[value.lower()].append(position)
+            elif index == 'file.classification':
+                self.by_classification[value.lower()].append(position)
+            elif index == 'file.name':
+                glob = value.lower()
+                if glob not in self.by_name:
+                    self.by_name[glob] = (re.compile(fnmatch.translate(glob)), [])
+                self.by_name[glob][1].append(position)
+            else:
+                self.unindexed.append(position)
+
+    @staticmethod
+    def _index_key(rule):
+        """Return the most selective (match type, value) that every file matching the rule must satisfy"""
+        required = [match for match in rule.all_
+                    if not match.get('regex') and isinstance(match['value'], basestring) and match['value']]
+        for match_type in ('file.type', 'file.classification', 'file.name'):
+            for match in required:
+                if match['type'] == match_type:
+                    return match_type, match['value']
+        return None, None
+
+    def candidates(self, file_):
+        """Return the compiled rules that may match the given file"""
+        positions = set(self.unindexed)
+
+        file_type = file_.get('type')
+        if file_type and self.by_type:
+            positions.update(self.by_type.get(file_type.lower(), []))
+
+        if self.by_classification:
+            for value in itertools.chain.from_iterable((file_.get('classification') or {}).itervalues()):
+                positions.update(self.by_classification.get(value.lower(), []))
+
+        file_name = file_.get('name')
+        if file_name and self.by_name:
+            file_name = file_name.lower()
+            for pattern, glob_positions in self.by_name.itervalues():
+                if pattern.match(file_name):
+                    positions.update(glob_positions)
+
+        return [self.rules[position] for position in sorted(positions)]
+
+def eval_rule(rule, file_, container):
+    """
+    Decide if a rule should spawn a job.
+    """
+    return CompiledRule(rule).matches(file_, container)
 
 def queue_job_legacy(gear_id, input_, fixed_inputs=None):
     """
@@ -201,12 +324,15 @@ def find_type_in_container(container, type_):
             return c_file
     return None
 
-def create_potential_jobs(db, container, container_type, file_, rule_failure_callback=None):
+def create_potential_jobs(db, container, container_type, file_, rule_failure_callback=None, rule_set=None,
+                          rule_filter=None):
     """
     Check all rules that apply to this file, and creates the jobs that should be run.
     Jobs are created but not enqueued.
     Returns list of potential job objects containing job ready to be inserted and rule.
     rule_failure_callback will be called for each rule evauation that fails for any reason
+    rule_set is the container's CompiledRuleSet, looked up if not given
+    rule_filter optionally limits the evaluated rules to the CompiledRules it returns True for
     """
 
     potential_jobs = []
@@ -220,15 +346,16 @@ def create_potential_jobs(db, container, container_type, file_, rule_failure_cal
             return []
 
     # Get configured rules for this project
-    rules = get_rules_for_container(db, container)
+    if rule_set is None:
+        rule_set = get_compiled_rules_for_container(db, container)
 
-    # Add hardcoded rules that cannot be removed or changed
-    for hardcoded_rule in get_base_rules():
-        rules.append(hardcoded_rule)
+    for compiled in rule_set.candidates(file_):
+        if rule_filter is not None and not rule_filter(compiled):
+            continue
 
-    for rule in rules:
+        rule = compiled.rule
         try:
-            if eval_rule(rule, file_, container):
+            if compiled.matches(file_, container):
                 gear_id = rule.gear_id
 
                 input_ = FileReference(type=container_type, id=str(container['_id']), name=file_['name'])
@@ -254,11 +381,36 @@ def create_potential_jobs(db, container, container_type, file_, rule_failure_cal
 
     return potential_jobs
 
-def create_jobs(db, container_before, container_after, container_type, replaced_files=None, rule_failure_callback=None):
+def get_changed_files(files_before, files_after):
+    """
+    Return the set of names of files that were added, removed or modified between two file lists.
+    """
+    def by_name(files):
+        result = collections.defaultdict(list)
+        for f in files:
+            result[f['name']].append(f)
+        return result
+
+    before, after = by_name(files_before), by_name(files_after)
+    return set(name for name in set(before) | set(after) if before.get(name) != after.get(name))
+
+def _container_file_attributes(files):
+    """Return the file types and classifications that container.* match entries look at"""
+    types = frozenset(f.get('type') for f in files if f.get('type'))
+    classifications = frozenset(itertools.chain.from_iterable(
+        (f.get('classification') or {}).itervalues() for f in files))
+    return types, classifications
+
+def create_jobs(db, container_before, container_after, container_type, replaced_files=None, rule_failure_callback=None,
+                changed_files=None):
     """
     Given a before and after set of file attributes, enqueue a list of jobs that would only be possible
     after the changes.
     Returns the algorithm names that were queued.
+
+    Only the changed files (given by name, or found by comparing the file lists if not given) are evaluated
+    against every rule. The jobs of unchanged files can only differ through rules that look at the container's
+    other files, or that have a replaced file as fixed input, so only those rules are evaluated for them.
     """
     if container_type == 'collection':
         return []
@@ -273,11 +425,33 @@ def create_jobs(db, container_before, container_after, container_type, replaced_
     files_before    = container_before.get('files', [])
     files_after     = container_after.get('files', [])
 
-    for f in files_before:
-        jobs_before.extend(create_potential_jobs(db, container_before, container_type, f, rule_failure_callback=rule_failure_callback))
+    # Before and after are the same container, so they share the project's rules
+    rule_set = get_compiled_rules_for_container(db, container_after)
+
+    if changed_files is None:
+        changed_files = get_changed_files(files_before, files_after)
+    changed_files = set(changed_files)
 
-    for f in files_after:
-        jobs_after.extend(create_potential_jobs(db, container_after, container_type, f, rule_failure_callback=rule_failure_callback))
+    container_changed = _container_file_attributes(files_before) != _container_file_attributes(files_after)
+
+    unchanged_file_rules = set(id(compiled) for compiled in rule_set.rules
+        if (container_changed and compiled.container_dependent) or compiled.has_fixed_input(replaced_files))
+
+    def unchanged_file_filter(compiled):
+        return id(compiled) in unchanged_file_rules
+
+    for files, container, jobs in ((files_before, container_before, jobs_before),
+                                   (files_after, container_after, jobs_after)):
+        for f in files:
+            if f['name'] in changed_files:
+                rule_filter = None
+            elif unchanged_file_rules:
+                rule_filter = unchanged_file_filter
+            else:
+                continue
+
+            jobs.extend(create_potential_jobs(db, container, container_type, f,
+                rule_failure_callback=rule_failure_callback, rule_set=rule_set, rule_filter=rule_filter))
 
     # Using a uniqueness constraint, create a list of the set difference of jobs_after \ jobs_before
     # (members of jobs_after that are not in jobs_before)
@@ -334,26 +508,69 @@ def create_jobs(db, container_before, container_after, container_type, replaced_
 
 
 # TODO: consider moving to a module that has a variety of hierarchy-management helper functions
-def get_rules_for_container(db, container):
+def get_project_id_for_container(db, container):
     """
-    Recursively walk the hierarchy until the project object is found.
+    Recursively walk the hierarchy until the project object is found, and return its id.
     """
 
+    if 'session' in container or 'project' in container:
+        project_id = container.get('parents', {}).get('project')
+        if project_id:
+            return str(project_id)
+
     if 'session' in container:
         session = db.sessions.find_one({'_id': container['session']})
-        return get_rules_for_container(db, session)
+        return get_project_id_for_container(db, session)
     elif 'project' in container:
         project = db.projects.find_one({'_id': container['project']})
-        return get_rules_for_container(db, project)
+        return get_project_id_for_container(db, project)
     else:
-        rules_mapper = RulesMapper()
         # Assume container is a project, or a collection (which currently cannot have a rules property)
-        result = list(rules_mapper.find_all(project_id=str(container['_id']), disabled={'$ne': True}))
+        return str(container['_id'])
 
-        if not result:
-            return []
-        else:
-            return result
+def get_rules_for_container(db, container):
+    """
+    Return the enabled rules of the container's project.
+    """
+    return [compiled.rule for compiled in get_compiled_rules_for_container(db, container).rules]
+
+def get_compiled_rules_for_container(db, container):
+    """
+    Return the CompiledRuleSet of the container's project.
+    """
+    return get_compiled_rules(db, get_project_id_for_container(db, container))
+
+# Compiled rule sets by project id, along with the rules revision they were compiled from.
+# The revision is kept in the database by RulesMapper, so changes made by any process are noticed.
+_compiled_rule_sets = {}
+
+# The number of projects to keep compiled rule sets for
+COMPILED_RULE_SETS_MAX = 1000
+
+def get_compiled_rules(db, project_id):
+    """
+    Return the CompiledRuleSet of a project's enabled rules, compiling them only if they changed.
+    """
+
+    rules_mapper = RulesMapper(db=db)
+    revision = rules_mapper.get_revision(project_id)
+
+    cached = _compiled_rule_sets.get(project_id)
+    if cached is not None and cached[0] == revision:
+        return cached[1]
+
+    rules = list(rules_mapper.find_all(project_id=project_id, disabled={'$ne': True}))
+
+    # Add hardcoded rules that cannot be removed or changed
+    rules.extend(get_base_rules())
+
+    rule_set = CompiledRuleSet(rules)
+
+    if len(_compiled_rule_sets) >= COMPILED_RULE_SETS_MAX:
+        _compiled_rule_sets.clear()
+    _compiled_rule_sets[project_id] = (revision, rule_set)
+
+    return rule_set
 
 def copy_site_rules_for_project(project_id):
     """
@@ -1,161 +1,252 @@
-"""Metrics collection"""
+"""Metrics collection
+
+Metrics are collected by groups, each with its own collection interval. Every pass (see worker.py)
+runs the groups that are due, longest waiting first, until the pass' time budget runs out; the
+remaining groups are deferred to the next pass.
+
+Counts over the (ever growing) access log are maintained incrementally: each pass only reads the
+entries added since the last one (the watermark), and the count and watermark are kept in the
+database so that restarts don't rescan the whole log.
+"""
 import logging
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from timeit import default_timer
 
 from api import config
 from api.auth.authproviders import AuthProviders
 from api.dao import containerstorage
 from api.handlers.devicehandler import get_device_statuses
 from api.metrics import values
+from api.jobs import job_counters
 from api.jobs.queue import JOB_STATES
 
 
 log = logging.getLogger('flywheel.metrics')
 
+# Time budget of a collection pass, in seconds
+COLLECTION_BUDGET_SECONDS = 10
+
+# Access log entries are counted once they are this old, so that entries still being written
+# (with a slightly earlier timestamp) are not skipped by the watermark
+WATERMARK_LAG = timedelta(seconds=5)
+
+USER_LOGIN_QUERY = {'access_type': 'user_login', 'origin.id': {'$regex': '@(?!flywheel\\.io)'}}
+
+EPOCH = datetime(1970, 1, 1)
+
+# [(interval in seconds, collector function)]
+COLLECTORS = []
+
+# Collector name -> time of its last run
+_last_run = {}
+_pass_deadline = 0
+
+
+def collector(interval):
+    """Register a metrics collector function that runs every interval seconds"""
+    def register(fn):
+        COLLECTORS.append((interval, fn))
+        return fn
+    return register
+
+def _out_of_budget():
+    return default_timer() >= _pass_deadline
+
+def _seconds_since_epoch(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+@collector(interval=300)
+def collect_version_metrics():
+    version_info = config.get_version()
+    if version_info:
+        values.DB_VERSION.set(version_info.get('database', 0))
+
+        release = version_info.get('release', 'UNKNOWN')
+        values.RELEASE_VERSION.labels(release).set(1)
 
-def collect_db_metrics():
-    """Collect metrics from mongodb, including version and job states"""
-    try:
-        # Get version info
-        epoch = datetime(1970, 1, 1)
-        version_info = config.get_version()
-        if version_info:
-            values.DB_VERSION.set(version_info.get('database', 0))
-
-            release = version_info.get('release', 'UNKNOWN')
-            values.RELEASE_VERSION.labels(release).set(1)
-
-            flywheel_version = version_info.get('flywheel_release', 'UNKNOWN')
-            values.FLYWHEEL_VERSION.labels(flywheel_version).set(1)
-
-        # Get raw DB stats
-        db_stats = config.db.command('dbstats')
-        values.DB_DATA_SIZE.set(db_stats['dataSize'])
-        values.DB_STORAGE_SIZE.set(db_stats['storageSize'])
-        values.DB_OBJECTS.set(db_stats['objects'])
-
-        # Get jobs info
-        for state in JOB_STATES:
-            count = config.db.jobs.count({'state': state})
-            values.JOBS_BY_STATE.labels(state).set(count)
-
-        # Find the oldest pending job
-        oldest_jobs = list(config.db.jobs.find({'state': 'pending', 'created': {'$exists': 1}},
-            {'created': 1}, sort=[('created', 1)], limit=1))
-        if oldest_jobs:
-            oldest_job_timestamp = (oldest_jobs[0]['created'] - epoch).total_seconds()
+        flywheel_version = version_info.get('flywheel_release', 'UNKNOWN')
+        values.FLYWHEEL_VERSION.labels(flywheel_version).set(1)
+
+
+@collector(interval=300)
+def collect_db_stats():
+    db_stats = config.db.command('dbstats')
+    values.DB_DATA_SIZE.set(db_stats['dataSize'])
+    values.DB_STORAGE_SIZE.set(db_stats['storageSize'])
+    values.DB_OBJECTS.set(db_stats['objects'])
+
+
+@collector(interval=30)
+def collect_job_metrics():
+    job_counts = job_counters.get_counts()
+    for state in JOB_STATES:
+        values.JOBS_BY_STATE.labels(state).set(job_counts.get(state, 0))
+
+    # Find the oldest pending job
+    oldest_jobs = list(config.db.jobs.find({'state': 'pending', 'created': {'$exists': 1}},
+        {'created': 1}, sort=[('created', 1)], limit=1))
+    if oldest_jobs:
+        oldest_job_timestamp = _seconds_since_epoch(oldest_jobs[0]['created'])
+    else:
+        oldest_job_timestamp = float('NaN')
+    values.OLDEST_PENDING_JOB.set(oldest_job_timestamp)
+
+
+@collector(interval=600)
+def collect_collection_stats():
+    for collection_name in config.db.list_collection_names():
+        if _out_of_budget():
+            log.warning('Collection stats incomplete, metrics collection budget exceeded')
+            return
+        stats = config.db.command('collstats', collection_name)
+
+        values.COLLECTION_COUNT.labels(collection_name).set(stats['count'])
+        values.COLLECTION_SIZE.labels(collection_name).set(stats['size'])
+        values.COLLECTION_STORAGE_SIZE.labels(collection_name).set(stats['storageSize'])
+        for index_name, index_size in stats.get('indexSizes', {}).items():
+            values.COLLECTION_INDEX_SIZE.labels(collection_name, index_name).set(index_size)
+        values.COLLECTION_TOTAL_INDEX_SIZE.labels(collection_name).set(stats['totalIndexSize'])
+
+
+@collector(interval=30)
+def collect_user_login_metrics():
+    """Count user logins added to the access log since the watermark of the last pass"""
+    state = config.db.singletons.find_one({'_id': 'metrics_user_login'}) or {}
+    watermark = state.get('watermark')
+    count = state.get('count', 0)
+    last_login = state.get('last_login')
+
+    timestamp_query = {'$lte': datetime.utcnow() - WATERMARK_LAG}
+    if watermark is not None:
+        timestamp_query['$gt'] = watermark
+    query = dict(USER_LOGIN_QUERY, timestamp=timestamp_query)
+
+    new_count, new_watermark = 0, None
+    for entry in config.log_db.access_log.find(query, {'timestamp': 1}, sort=[('timestamp', 1)]):
+        # Stop between timestamps when out of budget; the rest is counted on the next pass
+        if entry['timestamp'] != new_watermark and new_watermark is not None and _out_of_budget():
+            break
+        new_count += 1
+        new_watermark = entry['timestamp']
+
+    if new_watermark is not None:
+        count += new_count
+        watermark = last_login = new_watermark
+        config.db.singletons.replace_one({'_id': 'metrics_user_login'},
+            {'watermark': watermark, 'count': count, 'last_login': last_login}, upsert=True)
+
+    values.USER_LOGIN_COUNT.set(count)
+    if last_login:
+        values.LAST_EVENT_TIME.labels('user_login').set(_seconds_since_epoch(last_login))
+
+
+@collector(interval=30)
+def collect_last_event_metrics():
+    # Get the last session_creation
+    last_event = config.db.sessions.find_one({}, {'created': 1}, sort=[('created', -1)])
+    if last_event:
+        values.LAST_EVENT_TIME.labels('session_created').set(_seconds_since_epoch(last_event['created']))
+
+    # Get the last job_queued by system and user
+    last_event = config.db.jobs.find_one({'origin.type': 'system'}, {'created': 1}, sort=[('created', -1)])
+    if last_event:
+        values.LAST_EVENT_TIME.labels('job_queued_by_system').set(_seconds_since_epoch(last_event['created']))
+
+    last_event = config.db.jobs.find_one({'origin.type': 'user'}, {'created': 1}, sort=[('created', -1)])
+    if last_event:
+        values.LAST_EVENT_TIME.labels('job_queued_by_user').set(_seconds_since_epoch(last_event['created']))
+
+
+@collector(interval=300)
+def collect_gear_metrics():
+    gear_count = 0
+    job_count_by_gear = job_counters.get_counts_by_gear()
+
+    for gear_doc in config.db.gears.find({}, {'gear.name': 1, 'gear.version': 1, 'created': 1}):
+        gear = gear_doc.get('gear', {})
+        name = gear.get('name', 'UNKNOWN')
+        version = gear.get('version', 'UNKNOWN')
+        created = str(gear_doc.get('created', 'UNKNOWN'))
+        count = job_count_by_gear.get(str(gear_doc['_id']), 0)
+        values.GEAR_VERSIONS.labels(name, version, created).set(count)
+        gear_count = gear_count + 1
+    values.COLLECTION_COUNT.labels('gears').set(gear_count)
+
+
+@collector(interval=300)
+def collect_auth_provider_metrics():
+    auth_config = config.get_config()['auth']
+    for key in AuthProviders.keys():
+        values.AUTH_PROVIDER_TYPES.labels(key).set(int(key in auth_config))
+
+# Report the configured auth providers on the next pass instead of up to an interval later
+config.on_section_change('auth', lambda _: _last_run.pop(collect_auth_provider_metrics.__name__, None))
+
+
+@collector(interval=30)
+def collect_device_metrics():
+    device_count = 0
+    device_storage = containerstorage.ContainerStorage('devices', use_object_id=True)
+    devices = device_storage.get_all_el(None, None, None)
+    device_statuses = get_device_statuses(devices)
+    status_counts = {}
+    for device in devices:
+        device_id = str(device['_id'])
+        device_type = device.get('type') or device.get('method') or 'UNKNOWN'
+        device_name = device.get('name', 'UNKNOWN')
+        last_seen = device.get('last_seen')
+        if last_seen:
+            since_last_seen = (datetime.now() - last_seen).total_seconds()
         else:
-            oldest_job_timestamp = float('NaN')
-        values.OLDEST_PENDING_JOB.set(oldest_job_timestamp)
-
-        # Get raw collection stats
-        for collection_name in config.db.list_collection_names():
-            stats = config.db.command('collstats', collection_name)
-
-            values.COLLECTION_COUNT.labels(collection_name).set(stats['count'])
-            values.COLLECTION_SIZE.labels(collection_name).set(stats['size'])
-            values.COLLECTION_STORAGE_SIZE.labels(collection_name).set(stats['storageSize'])
-            for index_name, index_size in stats.get('indexSizes', {}).items():
-                values.COLLECTION_INDEX_SIZE.labels(collection_name, index_name).set(index_size)
-            values.COLLECTION_TOTAL_INDEX_SIZE.labels(collection_name).set(stats['totalIndexSize'])
-
-        # Get access logs of type user login
-        login_count = config.log_db.access_log.find({'access_type': 'user_login', 'origin.id': {'$regex': '@(?!flywheel\\.io)'}}).count()
-        values.USER_LOGIN_COUNT.set(login_count)
-
-        ### Last Event Times Collection
-        # Get the last user_login
-        last_event = config.log_db.access_log.find_one({'access_type': 'user_login', 'origin.id': {'$regex': '@(?!flywheel\\.io)'}},
-                                                       sort=[('timestamp', -1)])
-        if last_event:
-            time_since = last_event['timestamp'] - epoch
-            values.LAST_EVENT_TIME.labels('user_login').set(time_since.total_seconds())
-
-        # Get the last session_creation
-        last_event = config.db.sessions.find_one({}, sort=[('created', -1)])
-        if last_event:
-            time_since = last_event['created'] - epoch
-            values.LAST_EVENT_TIME.labels('session_created').set(time_since.total_seconds())
-
-        # Get the last job_queued by system and user
-        last_event = config.db.jobs.find_one({'origin.type': 'system'}, sort=[('created', -1)])
-        if last_event:
-            time_since = last_event['created'] - epoch
-            values.LAST_EVENT_TIME.labels('job_queued_by_system').set(time_since.total_seconds())
-
-        last_event = config.db.jobs.find_one({'origin.type': 'user'}, sort=[('created', -1)])
-        if last_event:
-            time_since = last_event['created'] - epoch
-            values.LAST_EVENT_TIME.labels('job_queued_by_user').set(time_since.total_seconds())
-
-        # Get gear versions
-        gear_count = 0
-        job_count_by_gear = { d['_id']: d['count'] for d in config.db.jobs.aggregate([
-            {
-                '$group': {
-                    '_id': '$gear_id',
-                    'count': {'$sum':1}
-                }
-            }
-        ])}
-
-        for gear_doc in config.db.gears.find():
-            gear = gear_doc.get('gear', {})
-            name = gear.get('name', 'UNKNOWN')
-            version = gear.get('version', 'UNKNOWN')
-            created = str(gear_doc.get('created', 'UNKNOWN'))
-            count = job_count_by_gear.get(str(gear_doc['_id']), 0)
-            values.GEAR_VERSIONS.labels(name, version, created).set(count)
-            gear_count = gear_count + 1
-        values.COLLECTION_COUNT.labels('gears').set(gear_count)
-
-        # Auth provider types
-        auth_config = config.get_config()['auth']
-        for key in AuthProviders.keys():
-            values.AUTH_PROVIDER_TYPES.labels(key).set(int(key in auth_config))
-
-        # Get devices
-        device_count = 0
-        device_storage = containerstorage.ContainerStorage('devices', use_object_id=True)
-        devices = device_storage.get_all_el(None, None, None)
-        device_statuses = get_device_statuses(devices)
-        status_counts = {}
-        for device in devices:
-            device_id = str(device['_id'])
-            device_type = device.get('type') or device.get('method') or 'UNKNOWN'
-            device_name = device.get('name', 'UNKNOWN')
-            last_seen = device.get('last_seen')
-            if last_seen:
-                since_last_seen = (datetime.now() - last_seen).total_seconds()
-            else:
-                since_last_seen = -1
-            interval = device.get('interval', -1)
-
-            # Set
-            device_label = [device_type, device_name, device_id]
-            values.DEVICE_TIME_SINCE_LAST_SEEN.labels(*device_label).set(since_last_seen)
-            values.DEVICE_INTERVAL.labels(*device_label).set(interval)
-
-            # Increment count by type
-            device_status = device_statuses[device_id]['status']
-            status_key = (device_type, device_status)
-            current_count = status_counts.setdefault(status_key, 0)
-            status_counts[status_key] = current_count + 1
-
-            device_count = device_count + 1
-
-        # Device count
-        values.COLLECTION_COUNT.labels('devices').set(device_count)
-
-        # Status count
-        for label, count in status_counts.items():
-            values.DEVICE_STATUS_COUNT.labels(*label).set(count)
-
-    except: # pylint: disable=bare-except
-        log.critical('Error collecting db metrics', exc_info=True)
-
-
-def collect_metrics():
+            since_last_seen = -1
+        interval = device.get('interval', -1)
+
+        # Set
+        device_label = [device_type, device_name, device_id]
+        values.DEVICE_TIME_SINCE_LAST_SEEN.labels(*device_label).set(since_last_seen)
+        values.DEVICE_INTERVAL.labels(*device_label).set(interval)
+
+        # Increment count by type
+        device_status = device_statuses[device_id]['status']
+        status_key = (device_type, device_status)
+        current_count = status_counts.setdefault(status_key, 0)
+        status_counts[status_key] = current_count + 1
+
+        device_count = device_count + 1
+
+    # Device count
+    values.COLLECTION_COUNT.labels('devices').set(device_count)
+
+    # Status count
+    for label, count in status_counts.items():
+        values.DEVICE_STATUS_COUNT.labels(*label).set(count)
+
+
+def collect_db_metrics(force=False):
+    """Run the metrics collectors that are due (or all of them if force is set) within the time budget"""
+    global _pass_deadline # pylint: disable=global-statement
+    _pass_deadline = default_timer() + COLLECTION_BUDGET_SECONDS
+
+    now = default_timer()
+    due = [(interval, fn) for interval, fn in COLLECTORS
+           if force or now - _last_run.get(fn.__name__, float('-inf')) >= interval]
+    # Collectors deferred by an earlier pass go first
+    due.sort(key=lambda item: _last_run.get(item[1].__name__, float('-inf')))
+
+    for i, (_, fn) in enumerate(due):
+        if not force and _out_of_budget():
+            log.warning('Metrics collection budget exceeded, deferring %s',
+                        ', '.join(deferred.__name__ for _, deferred in due[i:]))
+            break
+        _last_run[fn.__name__] = now
+        try:
+            fn()
+        except: # pylint: disable=bare-except
+            log.critical('Error collecting db metrics (%s)', fn.__name__, exc_info=True)
+
+
+def collect_metrics(force=False):
     with values.COLLECT_METRICS_TIME.time():
-        collect_db_metrics()
+        collect_db_metrics(force=force)
@@ -0,0 +1,94 @@
+"""
+MongoDB command instrumentation.
+
+A pymongo command listener records the latency of every command by command name and collection,
+and adds it up per request: while a request is being handled (see RequestWrapper), the number of
+commands it ran and the time spent waiting on them are available from current_request_stats().
+"""
+import threading
+
+from pymongo import monitoring
+
+from . import values
+
+# Commands that are not interesting on their own (driver handshakes, server monitoring)
+IGNORED_COMMANDS = frozenset(['isMaster', 'ismaster', 'ping', 'buildinfo', 'buildInfo', 'saslStart',
+                              'saslContinue', 'getnonce', 'authenticate', 'endSessions'])
+
+
+class RequestDbStats(object):
+    """Database commands run and time spent on them during a single request"""
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Greenlet local under the gevent workers
+_local = threading.local()
+
+def start_request():
+    """Start counting commands for the request handled by the current thread (greenlet).
+
+    Returns:
+        RequestDbStats: The stats that will be updated by every command until end_request()
+    """
+    stats = RequestDbStats()
+    _local.stats = stats
+    return stats
+
+def end_request(stats):
+    """Stop counting commands into stats, if they are still the current request's"""
+    if getattr(_local, 'stats', None) is stats:
+        _local.stats = None
+
+def current_request_stats():
+    """Return the RequestDbStats of the current request, or None outside of requests"""
+    return getattr(_local, 'stats', None)
+
+
+class CommandListener(monitoring.CommandListener):
+    """Records command latency metrics and per-request database stats"""
+    def __init__(self):
+        # (connection_id, request_id) -> (command_name, collection)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        if not isinstance(collection, basestring):
+            collection = ''
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (event.command_name, collection)
+
+    def succeeded(self, event):
+        self._finished(event, 'success')
+
+    def failed(self, event):
+        self._finished(event, 'failure')
+
+    def _finished(self, event, result):
+        with self._lock:
+            command = self._pending.pop((event.connection_id, event.request_id), None)
+        if command is None:
+            return
+        command_name, collection = command
+        seconds = event.duration_micros / 1e6
+        try:
+            values.DB_COMMAND_TIME.labels(command_name, collection, result).observe(seconds)
+        except: # pylint: disable=bare-except
+            # Never fail a database operation over metrics
+            pass
+
+        stats = current_request_stats()
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += seconds
+
+
+listener = CommandListener()
@@ -1,9 +1,15 @@
-""" Prometheus Client Metrics request handler """
+""" Prometheus Client Metrics and profiling request handlers """
+import os
+
 from prometheus_client import multiprocess
 from prometheus_client import generate_latest, CollectorRegistry, CONTENT_TYPE_LATEST
 
+from . import profiler
 from .collect import collect_metrics
 from ..web import base
+from ..web.errors import APIPermissionException, InputValidationException
+
+MAX_PROFILE_SECONDS = 300
 
 class MetricsHandler(base.RequestHandler):
     # NOTE: Unauthenticated due to internal exposure only
@@ -15,7 +21,7 @@ class MetricsHandler(base.RequestHandler):
                 # NOTE: This flag should be used for testing only
                 # It will cause metrics to be incorrect if used in production
                 self.log.critical('Serving metrics after forced collection!')
-                collect_metrics()
+                collect_metrics(force=True)
 
             # Fulfill the request
             registry = CollectorRegistry()
@@ -33,3 +39,22 @@ class MetricsHandler(base.RequestHandler):
 
         return metrics_handler
 
+
+
+class ProfileHandler(base.RequestHandler):
+    def get(self):
+        """ Profile the worker serving this request for ?seconds=N (default 10), as collapsed stacks """
+        if not self.user_is_admin:
+            raise APIPermissionException('Only site admins can profile workers')
+        try:
+            seconds = float(self.get_param('seconds', 10))
+        except ValueError:
+            raise InputValidationException('seconds must be a number')
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise InputValidationException('seconds must be between 0 and {}'.format(MAX_PROFILE_SECONDS))
+
+        session = profiler.profile(seconds)
+
+        self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        self.response.headers['Content-Disposition'] = 'attachment; filename="worker-{}.folded"'.format(os.getpid())
+        self.response.write(session.collapsed())
@@ -0,0 +1,230 @@
+"""
+Sampling profiler for live worker processes.
+
+While profiling, a CPU time interval timer (ITIMER_PROF) interrupts the process every
+SAMPLE_INTERVAL_SECONDS and the signal handler records the stack of the code that was running.
+Under the gevent workers all greenlets run on the main thread, so samples cover whichever greenlet
+was using the CPU; idle time (waiting on I/O) is not sampled.
+
+Samples are aggregated as flamegraph compatible collapsed stacks ("outer;...;inner count" lines).
+The signal handler only records samples (and stops sampling sessions past their deadline); the
+deadline is enforced and sessions are finished (written, logged) by a timer, which is a greenlet
+under the gevent workers.
+
+Profiles are taken:
+ * on demand for the worker handling a request to the admin-only /profile endpoint
+ * on demand for a given worker by sending it SIGUSR2 (the profile is written to core.profile_path)
+ * for every request slower than core.profile_slow_request_seconds (0 disables), written to
+   core.profile_path as <request id>.folded
+"""
+import collections
+import os
+import signal
+import threading
+import time
+
+from .. import config
+
+log = config.log
+
+SAMPLE_INTERVAL_SECONDS = 0.01
+MAX_STACK_DEPTH = 128
+
+# Seconds a SIGUSR2 triggered profile runs for
+SIGNAL_PROFILE_SECONDS = 30
+
+
+class Session(object):
+    """Stack samples collected until the (optional) deadline"""
+    def __init__(self, deadline=None, on_finish=None):
+        self.samples = collections.Counter()
+        self.deadline = deadline
+        self.on_finish = on_finish
+        self.timer = None
+        self.finished = False
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, one "frame;frame;... count" line per stack"""
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.samples.iteritems()))
+
+
+# Global (on demand) sessions of this process
+# NOTE: Not locked, as sessions are also removed from the signal handler; all greenlets and signal
+# handlers run on the main thread
+_sessions = []
+_timer_running = False
+_finish_lock = threading.Lock()
+# Greenlet local under the gevent workers: the request session of the running code
+_local = threading.local()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+
+def _collapse(frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def _sample(_signum, frame):
+    request_session = getattr(_local, 'session', None)
+    if not _sessions and request_session is None:
+        return
+    stack = _collapse(frame)
+    if request_session is not None:
+        request_session.samples[stack] += 1
+
+    now = time.time()
+    for session in list(_sessions):
+        session.samples[stack] += 1
+        if session.deadline is not None and session.deadline <= now:
+            # Stop sampling right away; the session's timer finishes it
+            _remove(session)
+
+
+def slow_request_threshold():
+    try:
+        return float(config.get_item('core', 'profile_slow_request_seconds') or 0)
+    except KeyError:
+        return 0
+
+def profile_path():
+    try:
+        return config.get_item('core', 'profile_path')
+    except KeyError:
+        return None
+
+def _update_timer(threshold=None):
+    """Start or stop the sampling timer, depending on whether anything is being profiled"""
+    global _timer_running # pylint: disable=global-statement
+    if threshold is None:
+        threshold = slow_request_threshold()
+    running = bool(_sessions) or threshold > 0
+    if running == _timer_running:
+        return
+    try:
+        if running:
+            signal.signal(signal.SIGPROF, _sample)
+            # Restart system calls interrupted by samples
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL_SECONDS, SAMPLE_INTERVAL_SECONDS)
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+    except ValueError:
+        # Signals can only be handled on the main thread
+        log.warning('Cannot profile outside of the main thread')
+        return
+    _timer_running = running
+
+
+def start(seconds=None, on_finish=None):
+    """Start profiling this process, until stop() or for the given number of seconds.
+
+    Arguments:
+        seconds (float): The duration of the session, after which a timer stops it
+        on_finish (function): Called with the session once it is stopped (never from a signal handler)
+
+    Returns:
+        Session: The profiling session
+    """
+    session = Session(deadline=time.time() + seconds if seconds else None, on_finish=on_finish)
+    _sessions.append(session)
+    _update_timer()
+    if seconds:
+        session.timer = threading.Timer(seconds, stop, [session])
+        session.timer.daemon = True
+        session.timer.start()
+    return session
+
+def _remove(session):
+    """Stop sampling for a session"""
+    try:
+        _sessions.remove(session)
+    except ValueError:
+        return
+    _update_timer()
+
+def stop(session):
+    """Stop a profiling session and call its on_finish"""
+    with _finish_lock:
+        if session.finished:
+            return
+        session.finished = True
+    _remove(session)
+    if session.timer is not None:
+        session.timer.cancel()
+    if session.on_finish is not None:
+        session.on_finish(session)
+
+def profile(seconds):
+    """Profile this process for seconds and return the session.
+
+    The calling greenlet sleeps in the meantime, leaving the worker to its other requests.
+    """
+    session = start()
+    try:
+        time.sleep(seconds)
+    finally:
+        stop(session)
+    return session
+
+
+def write_profile(session, name):
+    """Write the session to core.profile_path as <name>.folded and return the file path"""
+    path = profile_path()
+    if not path:
+        return None
+    if not os.path.exists(path):
+        os.makedirs(path)
+    filename = os.path.join(path, '{}.folded'.format(name))
+    with open(filename, 'w') as f:
+        f.write(session.collapsed())
+    return filename
+
+
+def start_request():
+    """Capture the profile of the current request, if slow requests are profiled.
+
+    Returns:
+        Session: The request session, or None
+    """
+    threshold = slow_request_threshold()
+    _update_timer(threshold)
+    if threshold <= 0 or not _timer_running:
+        return None
+    session = Session()
+    _local.session = session
+    return session
+
+def end_request(session, request, duration):
+    """Stop capturing the current request's profile, and write it if the request was slow"""
+    if session is None:
+        return
+    if getattr(_local, 'session', None) is session:
+        _local.session = None
+    threshold = slow_request_threshold()
+    if threshold <= 0 or duration < threshold or not session.samples:
+        return
+    try:
+        filename = write_profile(session, request.id)
+        request.logger.warning('Slow request (%.3fs), profile written to %s', duration, filename)
+    except Exception: # pylint: disable=broad-except
+        log.exception('Error writing slow request profile')
+
+
+def install_signal_handler():
+    """Profile the process for SIGNAL_PROFILE_SECONDS when it receives SIGUSR2"""
+    def write_signal_profile(session):
+        try:
+            filename = write_profile(session, 'worker-{}-{}'.format(os.getpid(), int(time.time())))
+            log.info('Worker profile of %s seconds written to %s', SIGNAL_PROFILE_SECONDS, filename)
+        except Exception: # pylint: disable=broad-except
+            log.exception('Error writing worker profile')
+
+    def handle(_signum, _frame):
+        start(SIGNAL_PROFILE_SECONDS, on_finish=write_signal_profile)
+
+    signal.signal(signal.SIGUSR2, handle)
@@ -2,7 +2,7 @@ import collections
 
 from timeit import default_timer
 
-from . import values
+from . import db_monitor, profiler, values
 from .. import config
 
 log = config.log
@@ -21,12 +21,16 @@ class RequestWrapper(object):
         self._response = response
         self._status = 200
         self._write_on_exit = True
+        self._db_stats = None
+        self._profile = None
 
         if response and hasattr(response, 'write'):
             response.write = self.__instrument_write_fn(response.write)
 
     def __enter__(self):
         self._start = default_timer()
+        self._db_stats = db_monitor.start_request()
+        self._profile = profiler.start_request()
         return self
 
     def __exit__(self, exception_type_dummy, exception_value_dummy, traceback_dummy):
@@ -68,6 +72,33 @@ class RequestWrapper(object):
 
         return handler
 
+    def wrap_iter(self, app_iter):
+        """Wrap the response body iterator app_iter, such that stats will be written once it is consumed.
+
+        Arguments:
+            app_iter (iterable): The response body chunks
+
+        Returns:
+            generator: The wrapped iterator
+        """
+        self._write_on_exit = False
+
+        def body():
+            try:
+                for chunk in app_iter:
+                    self._bytes_sent = self._bytes_sent + len(chunk)
+                    yield chunk
+            except Exception:
+                # The status was sent with the first chunk: re-raising makes the server close the
+                # connection, so that the client gets a truncated body rather than a complete one
+                getattr(self._request, 'logger', log).exception('Error streaming response')
+                self._status = 500
+                raise
+            finally:
+                self.__write_metrics()
+
+        return body()
+
     def __instrument_write_fn(self, write):
         """Adds instrumentation to the given write function to collect # of bytes written.
 
@@ -97,10 +128,26 @@ class RequestWrapper(object):
 
             method = getattr(self._request, 'method', 'UNKNOWN')
 
+            db_stats = self._db_stats or db_monitor.RequestDbStats()
+            db_monitor.end_request(self._db_stats)
+
             labels = [ method, template, str(self._status) ]
             values.RESPONSE_TIME.labels(*labels).inc(response_time)
             values.RESPONSE_SIZE.labels(*labels).inc(self._bytes_sent)
             values.RESPONSE_COUNT.labels(*labels).inc(1)
+            values.RESPONSE_DB_TIME.labels(*labels).inc(db_stats.seconds)
+            values.RESPONSE_DB_COMMAND_COUNT.labels(*labels).inc(db_stats.count)
+
+            values.RESPONSE_TIME_HISTOGRAM.labels(method, template).observe(response_time)
+            values.REQUEST_SIZE_HISTOGRAM.labels(method, template).observe(getattr(self._request, 'content_length', None) or 0)
+            values.RESPONSE_SIZE_HISTOGRAM.labels(method, template).observe(self._bytes_sent)
+
+            profiler.end_request(self._profile, self._request, response_time)
+
+            request_log = getattr(self._request, 'logger', log)
+            request_log.info('%s %s %s %d bytes in %.3fs (db: %d queries in %.3fs)',
+                             method, getattr(self._request, 'path', template), self._status, self._bytes_sent,
+                             response_time, db_stats.count, db_stats.seconds)
 
         except: # pylint: disable=bare-except
             log.exception('Error recording metrics')
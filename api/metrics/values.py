@@ -1,5 +1,7 @@
 # Metrics values
-from prometheus_client import Summary, Gauge, Counter
+import os
+
+from prometheus_client import Summary, Gauge, Counter, Histogram
 
 
 #
@@ -9,6 +11,23 @@ from prometheus_client import Summary, Gauge, Counter
 prefix = 'fw_core_'
 
 
+def _buckets(env_var, default):
+    """Return histogram buckets from a comma separated environment variable, or default.
+
+    Buckets are read once at import (not from the db config), so that every worker process
+    defines the same buckets for the multiprocess collector to merge.
+    """
+    value = os.environ.get(env_var)
+    if not value:
+        return default
+    return tuple(sorted(float(bucket) for bucket in value.split(','))) + (float('inf'),)
+
+RESPONSE_TIME_BUCKETS = _buckets('SCITRAN_METRICS_RESPONSE_TIME_BUCKETS',
+                                 (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf')))
+BODY_SIZE_BUCKETS = _buckets('SCITRAN_METRICS_BODY_SIZE_BUCKETS',
+                             (100, 1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000, float('inf')))
+
+
 # ===== Request Handlers =====
 # Labels: Method, Path, Code
 
@@ -21,9 +40,43 @@ RESPONSE_SIZE = Counter(prefix + 'response_size_bytes_sum', 'Observed response s
 # Response Count
 RESPONSE_COUNT = Counter(prefix + 'response_count', 'Observed response counts', ['method', 'template', 'status'])
 
+# Labels: Method, Path (route template, not the raw url, to keep cardinality bounded)
+
+# Response Time distribution
+RESPONSE_TIME_HISTOGRAM = Histogram(prefix + 'response_latency_seconds', 'Observed time to complete response, in seconds', ['method', 'template'],
+                                    buckets=RESPONSE_TIME_BUCKETS)
+
+# Request Size distribution
+REQUEST_SIZE_HISTOGRAM = Histogram(prefix + 'request_body_bytes', 'Observed request body size, in bytes', ['method', 'template'],
+                                   buckets=BODY_SIZE_BUCKETS)
+
+# Response Size distribution
+RESPONSE_SIZE_HISTOGRAM = Histogram(prefix + 'response_body_bytes', 'Observed response size, in bytes', ['method', 'template'],
+                                    buckets=BODY_SIZE_BUCKETS)
+
 # Log Counter
 LOG_MESSAGE_COUNT = Counter(prefix + 'log_message_count', 'Observed log statement counts', ['name', 'level'])
 
+# Payload validation time (label=schema)
+SCHEMA_VALIDATION_TIME = Counter(prefix + 'schema_validation_seconds_sum', 'Observed time to validate payloads against a schema, in seconds', ['schema'])
+
+# Schema compile time saved by reusing compiled validators (label=schema)
+SCHEMA_COMPILE_TIME_SAVED = Counter(prefix + 'schema_compile_saved_seconds_sum', 'Time not spent loading and compiling schemas thanks to compiled validator reuse, in seconds', ['schema'])
+
+# Time spent on database commands while handling requests
+RESPONSE_DB_TIME = Counter(prefix + 'response_db_time_seconds_sum', 'Observed time spent on database commands during responses, in seconds', ['method', 'template', 'status'])
+
+# Number of database commands run while handling requests
+RESPONSE_DB_COMMAND_COUNT = Counter(prefix + 'response_db_command_count', 'Observed number of database commands run during responses', ['method', 'template', 'status'])
+
+
+# ===== DB Commands =====
+# Labels: Command, Collection, Result
+
+# Command latency
+DB_COMMAND_TIME = Histogram(prefix + 'db_command_seconds', 'Observed database command latency, in seconds', ['command', 'collection', 'result'],
+                            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')))
+
 
 # ===== DB Stats =====
 
@@ -142,7 +142,7 @@ class Placer(object):
                     replaced_files.append(containerutil.FileReference(self.container_type, self.id_, file_attrs['name']))
 
                 rules.create_jobs(config.db, container_before, self.container, self.container_type, replaced_files=replaced_files,
-                    rule_failure_callback=self.handle_rule_failure)
+                    rule_failure_callback=self.handle_rule_failure, changed_files=[file_attrs['name']])
 
     def update_file(self, file_attrs):
         """
@@ -155,7 +155,7 @@ class Placer(object):
         else:
             self.container = container_after
             rules.create_jobs(config.db, container_before, self.container, self.container_type,
-                rule_failure_callback=self.handle_rule_failure)
+                rule_failure_callback=self.handle_rule_failure, changed_files=[file_attrs['name']])
 
     def recalc_session_compliance(self):
         if self.container_type in ['session', 'acquisition'] and self.id_:
@@ -1,5 +1,9 @@
 """Provides repository-layer functions for loading/saving providers"""
+import copy
 import datetime
+import threading
+import time
+
 import bson
 
 from flywheel_common.providers import ProviderClass, create_provider
@@ -16,6 +20,58 @@ def is_compute_dispatcher(device_type):
     return device_type in COMPUTE_DISPATCHERS
 
 
+# Loaded providers (and the storage plugins they hold, with their connections), cached per
+# process by provider id. Every provider update bumps a revision stored in the database; a
+# process checks the revision at most every PROVIDER_CHECK_SECONDS and drops its cache when
+# the revision changed.
+PROVIDER_CHECK_SECONDS = 5
+_provider_cache = {}
+_provider_cache_lock = threading.Lock()
+_provider_cache_revision = None
+_provider_cache_checked = 0
+
+
+def get_providers_revision():
+    """Get the current provider revision"""
+    doc = config.db.singletons.find_one({'_id': 'provider_revision'}, {'revision': 1})
+    return doc.get('revision', 0) if doc else 0
+
+
+def bump_providers_revision():
+    """Mark every cached provider stale, in this and all other API processes"""
+    global _provider_cache_revision # pylint: disable=global-statement
+    config.db.singletons.update_one({'_id': 'provider_revision'}, {'$inc': {'revision': 1}}, upsert=True)
+    with _provider_cache_lock:
+        _provider_cache.clear()
+        _provider_cache_revision = None
+
+
+def _get_cached_provider(provider_id):
+    """Get the cached provider model matching provider_id, loading it if needed.
+
+    Returns:
+        The shared provider object, or None if not found
+    """
+    global _provider_cache_revision, _provider_cache_checked # pylint: disable=global-statement
+    now = time.time()
+    if _provider_cache_revision is None or now - _provider_cache_checked > PROVIDER_CHECK_SECONDS:
+        revision = get_providers_revision()
+        with _provider_cache_lock:
+            if revision != _provider_cache_revision:
+                _provider_cache.clear()
+                _provider_cache_revision = revision
+            _provider_cache_checked = now
+
+    key = str(provider_id)
+    provider = _provider_cache.get(key)
+    if provider is None:
+        provider = mappers.Providers().get(provider_id)
+        if provider is not None:
+            with _provider_cache_lock:
+                provider = _provider_cache.setdefault(key, provider)
+    return provider
+
+
 def get_provider(provider_id, secure=False):
     """Get the provider model matching provider_id, or None if not found.
 
@@ -29,10 +85,11 @@ def get_provider(provider_id, secure=False):
     Raises:
         APINotFoundException: If the provider does not exist.
     """
-    mapper = mappers.Providers()
-    result = mapper.get(provider_id)
+    result = _get_cached_provider(provider_id)
     if not result:
         raise errors.ResourceNotFound(provider_id, 'Provider {path} not found!')
+    # Callers get their own model, sharing the cached storage plugin
+    result = copy.copy(result)
     if not secure:
         return _scrub_config(result)
     return result
@@ -48,8 +105,7 @@ def validate_provider_class(provider_id, provider_class):
         APIValidationException: If the provider either doesn't exist or is not of the specified class.
     """
     provider_class = ProviderClass(provider_class).value
-    mapper = mappers.Providers()
-    result = mapper.get(provider_id)
+    result = _get_cached_provider(provider_id)
 
     if not result:
         raise errors.ResourceNotFound(provider_id, 'Provider {path} does not exist')
@@ -129,7 +185,11 @@ def insert_provider(provider):
     provider.validate_permissions()
     # All was good, create the mapper and insert, errors will bubble up
     mapper = mappers.Providers()
-    return mapper.insert(provider)
+    provider_id = mapper.insert(provider)
+    if provider.provider_class == ProviderClass.storage.value:
+        # The signed_url feature is derived from the storage providers
+        config.bump_config_version()
+    return provider_id
 
 
 def update_provider(provider_id, doc):
@@ -176,6 +236,7 @@ def update_provider(provider_id, doc):
         provider.validate_permissions()
 
     mapper.patch(provider_id, current_provider)
+    bump_providers_revision()
 
 #pylint: disable=unused-argument
 def validate_provider_updates(container, provider_ids, is_admin):
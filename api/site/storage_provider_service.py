@@ -7,6 +7,9 @@ from ..types import Origin
 from . import providers
 from .. import config
 
+# The local storage provider only depends on static config, so one instance is shared per process
+_local_storage = None
+
 class StorageProviderService(object):
 
     # pylint: disable=unused-argument
@@ -63,5 +66,8 @@ class StorageProviderService(object):
 
     def get_local_storage(self):
         """ Local storage is a storage plugin that supports get_fs. But it will not clean up automatically"""
-        return create_provider(ProviderClass.storage.value, 'local', 'temp_storage',
-                               {'path': config.local_fs_url}, None)
+        global _local_storage # pylint: disable=global-statement
+        if _local_storage is None:
+            _local_storage = create_provider(ProviderClass.storage.value, 'local', 'temp_storage',
+                                             {'path': config.local_fs_url}, None)
+        return _local_storage
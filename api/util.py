@@ -1,3 +1,4 @@
+import base64
 import datetime
 import enum as baseEnum
 import hashlib
@@ -12,6 +13,7 @@ import uuid
 import requests
 
 import bson
+import bson.json_util
 import fs.errors
 import fs.path
 import pymongo
@@ -489,6 +491,36 @@ def parse_pagination_sort_param(sort_param):
     return pagination_sort
 
 
+# Datetimes are stored naive (UTC)
+CURSOR_JSON_OPTIONS = bson.json_util.JSONOptions(tz_aware=False)
+
+def parse_pagination_cursor(cursor_param):
+    """
+    Return parsed pagination cursor (dict with sort and after values) from cursor param (str).
+    An empty cursor param (first page) is parsed as None.
+    """
+    if not cursor_param:
+        return None
+    try:
+        padded = str(cursor_param) + '=' * (-len(cursor_param) % 4)
+        cursor = bson.json_util.loads(base64.urlsafe_b64decode(padded), json_options=CURSOR_JSON_OPTIONS)
+        sort = [(key, order) for key, order in cursor['sort']]
+        after = list(cursor['after'])
+        if not all(isinstance(key, basestring) and order in (pymongo.ASCENDING, pymongo.DESCENDING)
+                   for key, order in sort):
+            raise ValueError('invalid sort')
+    except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+        raise PaginationParseError('Invalid pagination cursor: {}'.format(cursor_param))
+
+    return {'sort': sort, 'after': after}
+
+
+def encode_pagination_cursor(sort, after):
+    """Return opaque cursor param (str) for the page after the given sort values."""
+    cursor = bson.json_util.dumps({'sort': sort, 'after': after})
+    return base64.urlsafe_b64encode(cursor).rstrip('=')
+
+
 def parse_pagination_int_param(int_param):
     """Return positive int parsed from string."""
     try:
@@ -501,6 +533,14 @@ def parse_pagination_int_param(int_param):
     return pagination_int
 
 
+def parse_pagination_bool_param(bool_param):
+    """Return bool parsed from string (true|false)."""
+    if bool_param.lower() not in ('true', 'false'):
+        raise PaginationParseError('Invalid pagination bool: expected true or false, got {}'.format(bool_param))
+
+    return bool_param.lower() == 'true'
+
+
 class dotdict(dict):
     def __getattr__(self, name):
         if not self.get(name):
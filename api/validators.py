@@ -2,12 +2,26 @@ import copy
 import json
 import jsonschema
 import os
+import threading
+import urlparse
+
+from timeit import default_timer
 
 from . import config
+from .metrics import values
 from .web.errors import DBValidationException, InputValidationException
 
 log = config.log
 
+# Schemas and their validators, compiled once per process and keyed by schema path (and method).
+# Schema files only change with a deploy, so entries are never invalidated.
+# Every reuse of a compiled validator is credited with the time it took to compile, which is the
+# time the previous load-per-request approach spent on each call.
+_schemas = {}
+_validators = {}
+_registry_lock = threading.Lock()
+_registry_stats = {'hits': 0, 'compile_seconds': 0.0, 'saved_seconds': 0.0}
+
 
 def validate_data(data, schema_json, schema_type, verb, optional=False):
     """
@@ -26,12 +40,126 @@ def validate_data(data, schema_json, schema_type, verb, optional=False):
 def _validate_json(json_data, schema, resolver):
     jsonschema.validate(json_data, schema, resolver=resolver, format_checker=jsonschema.FormatChecker())
 
-def _resolve_schema(schema_file_uri):
+def _load_refs(node, resolver, seen):
+    """Resolve every $ref reachable from node, so that the resolver's store holds them all"""
+    if isinstance(node, list):
+        for item in node:
+            _load_refs(item, resolver, seen)
+    elif isinstance(node, dict):
+        ref = node.get('$ref')
+        if isinstance(ref, basestring):
+            url = urlparse.urljoin(resolver.resolution_scope, ref)
+            if url not in seen:
+                seen.add(url)
+                url, resolved = resolver.resolve(ref)
+                resolver.push_scope(url)
+                try:
+                    _load_refs(resolved, resolver, seen)
+                finally:
+                    resolver.pop_scope()
+        for key, value in node.iteritems():
+            if key != '$ref':
+                _load_refs(value, resolver, seen)
+
+def _get_schema_entry(schema_file_uri):
+    entry = _schemas.get(schema_file_uri)
+    if entry is not None:
+        return entry
+
+    start = default_timer()
     with open(schema_file_uri) as schema_file:
         base_uri = os.path.dirname(schema_file_uri)
         schema = json.load(schema_file)
-        resolver = jsonschema.RefResolver('file://'+base_uri+'/', schema)
-        return (schema, resolver)
+    resolver = jsonschema.RefResolver('file://'+base_uri+'/', schema)
+    _load_refs(schema, resolver, set())
+    # The resolver keeps a scope stack while following refs, so it is used by one validation at a
+    # time: the lock is shared by every validator compiled from the schema (ie. POST and PUT)
+    entry = {'schema': schema, 'resolver': resolver, 'lock': threading.Lock(), 'load_time': default_timer() - start}
+
+    with _registry_lock:
+        _registry_stats['compile_seconds'] += entry['load_time']
+        return _schemas.setdefault(schema_file_uri, entry)
+
+def _resolve_schema(schema_file_uri):
+    entry = _get_schema_entry(schema_file_uri)
+    return (entry['schema'], entry['resolver'])
+
+def get_validator(schema_file_uri, method):
+    """
+    Return the compiled validator of a schema for a request method, along with a lock to hold
+    while validating (the schema's resolver keeps a scope stack while following refs).
+
+    PUT validators ignore the schema's required properties.
+    """
+    key = (schema_file_uri, method)
+    entry = _validators.get(key)
+    if entry is not None:
+        with _registry_lock:
+            _registry_stats['hits'] += 1
+            _registry_stats['saved_seconds'] += entry['compile_time']
+        values.SCHEMA_COMPILE_TIME_SAVED.labels(os.path.basename(schema_file_uri)).inc(entry['compile_time'])
+        return entry['validator'], entry['lock']
+
+    start = default_timer()
+    schema_entry = _get_schema_entry(schema_file_uri)
+    schema = schema_entry['schema']
+    if method == 'PUT' and schema.get('required'):
+        schema = copy.copy(schema)
+        schema.pop('required')
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema, resolver=schema_entry['resolver'], format_checker=jsonschema.FormatChecker())
+    entry = {
+        'validator': validator,
+        'lock': schema_entry['lock'],
+        'compile_time': schema_entry['load_time'] + default_timer() - start
+    }
+
+    with _registry_lock:
+        _registry_stats['compile_seconds'] += default_timer() - start
+        entry = _validators.setdefault(key, entry)
+    return entry['validator'], entry['lock']
+
+def _validate(schema_file_uri, payload, method):
+    validator, lock = get_validator(schema_file_uri, method)
+    start = default_timer()
+    try:
+        with lock:
+            validator.validate(payload)
+    finally:
+        values.SCHEMA_VALIDATION_TIME.labels(os.path.basename(schema_file_uri)).inc(default_timer() - start)
+
+def load_schemas(schema_types=('input', 'mongo')):
+    """
+    Compile the POST and PUT validators of every schema of the given types.
+
+    Meant to be called once per worker (eg. from gunicorn's post_fork), so that no request pays
+    for loading schemas. Returns the number of validators compiled.
+    """
+    count = 0
+    for schema_type in schema_types:
+        for schema_name in sorted(os.listdir(os.path.join(config.schema_path, schema_type))):
+            if not schema_name.endswith('.json'):
+                continue
+            for method in ('POST', 'PUT'):
+                try:
+                    get_validator(schema_uri(schema_type, schema_name), method)
+                    count += 1
+                except (jsonschema.SchemaError, jsonschema.RefResolutionError) as e:
+                    log.warning('Skipping invalid schema %s/%s: %s', schema_type, schema_name, e.message)
+                    break
+    log.info('Compiled %d schema validators in %.3fs', count, _registry_stats['compile_seconds'])
+    return count
+
+def get_registry_stats():
+    """
+    Return the number of compiled schemas and validators, validator reuses, the total time spent
+    compiling and the compile time saved by reuse (in seconds).
+    """
+    with _registry_lock:
+        stats = dict(_registry_stats)
+        stats.update({'schemas': len(_schemas), 'validators': len(_validators)})
+    return stats
 
 def no_op(g, *args): # pylint: disable=unused-argument
     return g
@@ -46,18 +174,12 @@ def schema_uri(type_, schema_name):
 def decorator_from_schema_path(schema_url):
     if schema_url is None:
         return no_op
-    schema, resolver = _resolve_schema(schema_url)
     def g(exec_op):
         def validator(method, **kwargs):
             payload = kwargs['payload']
-            if method == 'PUT' and schema.get('required'):
-                _schema = copy.copy(schema)
-                _schema.pop('required')
-            else:
-                _schema = schema
             if method in ['POST', 'PUT']:
                 try:
-                    _validate_json(payload, _schema, resolver)
+                    _validate(schema_url, payload, method)
                 except jsonschema.ValidationError as e:
                     raise DBValidationException(str(e))
             return exec_op(method, **kwargs)
@@ -67,17 +189,10 @@ def decorator_from_schema_path(schema_url):
 def from_schema_path(schema_url):
     if schema_url is None:
         return no_op
-    # split the url in base_uri and schema_name
-    schema, resolver = _resolve_schema(schema_url)
     def g(payload, method):
-        if method == 'PUT' and schema.get('required'):
-            _schema = copy.copy(schema)
-            _schema.pop('required')
-        else:
-            _schema = schema
         if method in ['POST', 'PUT']:
             try:
-                _validate_json(payload, _schema, resolver)
+                _validate(schema_url, payload, method)
             except jsonschema.ValidationError as e:
                 raise InputValidationException(cause=e)
     return g
@@ -10,6 +10,7 @@ from .. import util
 from .. import config
 from ..types import Origin
 from ..auth.authproviders import AuthProvider
+from ..auth import authcache
 from ..auth.apikeys import APIKey
 from ..auth import require_privilege, has_privilege, Role, Privilege
 from ..web import errors
@@ -88,25 +89,35 @@ class RequestHandler(webapp2.RequestHandler):
 
             # Upsert for backwards compatibility (ie. not-yet-seen device still using drone secret)
             label = (drone_method + '_' + drone_name).replace(' ', '_')  # Note: old drone _id's are kept under label
-            self.device = config.db.devices.find_one_and_update(
-                {'label': label},
-                {'$set': {'label': label, 'type': drone_method, 'name': drone_name}},
-                upsert=True,
-                return_document=pymongo.collection.ReturnDocument.AFTER
-            )
+            self.device = authcache.get('devices_by_label', label)
+            if self.device is None or (self.device.get('type'), self.device.get('name')) != (drone_method, drone_name):
+                self.device = config.db.devices.find_one_and_update(
+                    {'label': label},
+                    {'$set': {'label': label, 'type': drone_method, 'name': drone_name}},
+                    upsert=True,
+                    return_document=pymongo.collection.ReturnDocument.AFTER
+                )
+                authcache.put('devices_by_label', label, self.device)
 
             self.origin = {'type': Origin.device, 'id': self.device['_id']}
             drone_request = True
 
         if self.origin['type'] == Origin.device:
-            # Update device.last_seen
+            # Update device.last_seen (written behind, see authcache)
             # In the future, consider merging any keys into self.origin?
-            self.device = config.db.devices.find_one_and_update(
-                {'_id': self.origin['id']},
-                {'$set': {
-                    'last_seen': datetime.datetime.utcnow(),
-                    'errors': []  # Reset errors list if device checks in
-                }}, return_document=pymongo.collection.ReturnDocument.AFTER)
+            self.device = authcache.get('devices', self.origin['id'])
+            if self.device is None:
+                self.device = config.db.devices.find_one({'_id': self.origin['id']})
+                authcache.put('devices', self.origin['id'], self.device)
+
+            if self.device is not None:
+                if self.device.get('errors'):
+                    # Reset errors list if device checks in
+                    config.db.devices.update_one({'_id': self.origin['id']}, {'$set': {'errors': []}})
+                    self.device['errors'] = []
+                    authcache.put('devices', self.origin['id'], self.device)
+                self.device['last_seen'] = datetime.datetime.utcnow()
+                authcache.touch('devices', self.origin['id'], 'last_seen', self.device['last_seen'])
 
             # Bit hackish - detect from route if a job is the origin, and if so what job ID.
             # Could be removed if routes get reorganized. POST /api/jobs/id/result, maybe?
@@ -159,6 +170,8 @@ class RequestHandler(webapp2.RequestHandler):
         # Add origin to log context
         self.log = self.log.with_context(origin=util.origin_to_str(self.origin))
 
+        authcache.flush_if_due()
+
     def authenticate_user_token(self, session_token):
         """
         AuthN for user accounts. Calls self.abort on failure.
@@ -168,7 +181,10 @@ class RequestHandler(webapp2.RequestHandler):
 
         uid = None
         timestamp = datetime.datetime.utcnow()
-        cached_token = config.db.authtokens.find_one({'_id': session_token})
+        cached_token = authcache.get('authtokens', session_token)
+        if cached_token is None:
+            cached_token = config.db.authtokens.find_one({'_id': session_token})
+            authcache.put('authtokens', session_token, cached_token)
 
         if cached_token:
 
@@ -179,7 +195,10 @@ class RequestHandler(webapp2.RequestHandler):
                 inactivity_timeout = None
 
             if inactivity_timeout:
-                last_seen = cached_token.get('last_seen')
+                # Latest of the stored and the not yet written last_seen (either may be missing)
+                last_seen = [cached_token.get('last_seen'),
+                             authcache.last_touched('authtokens', cached_token['_id'], 'last_seen')]
+                last_seen = max([seen for seen in last_seen if seen is not None] or [None])
 
                 # If now - last_seen is greater than inactivity timeout, clear out session
                 if last_seen and (timestamp - last_seen).total_seconds() > int(inactivity_timeout):
@@ -187,10 +206,11 @@ class RequestHandler(webapp2.RequestHandler):
                     # Token expired and no refresh token, remove and deny request
                     config.db.authtokens.delete_one({'_id': cached_token['_id']})
                     config.db.refreshtokens.delete_one({'uid': cached_token['uid'], 'auth_type': cached_token['auth_type']})
+                    authcache.invalidate('authtokens', cached_token['_id'])
                     self.abort(401, 'Inactivity timeout')
 
                 # set last_seen to now
-                config.db.authtokens.update_one({'_id': cached_token['_id']}, {'$set': {'last_seen': timestamp}})
+                authcache.touch('authtokens', cached_token['_id'], 'last_seen', timestamp)
 
 
             # Check if token is expired
@@ -215,6 +235,7 @@ class RequestHandler(webapp2.RequestHandler):
                         # Remove the bad refresh token and session token:
                         config.db.refreshtokens.delete_one({'_id': refresh_token['_id']})
                         config.db.authtokens.delete_one({'_id': cached_token['_id']})
+                        authcache.invalidate('authtokens', cached_token['_id'])
 
                         # TODO: Rework auth so it's not tied to init, then:
                         #   - Raise a refresh token exception specifically in this situation
@@ -223,10 +244,12 @@ class RequestHandler(webapp2.RequestHandler):
                         self.abort(401, 'invalid_refresh_token')
 
                     config.db.authtokens.update_one({'_id': cached_token['_id']}, {'$set': updated_token_info})
+                    authcache.invalidate('authtokens', cached_token['_id'])
 
                 else:
                     # Token expired and no refresh token, remove and deny request
                     config.db.authtokens.delete_one({'_id': cached_token['_id']})
+                    authcache.invalidate('authtokens', cached_token['_id'])
                     self.abort(401, 'invalid_refresh_token')
 
             uid = cached_token['uid']
@@ -346,6 +369,7 @@ class RequestHandler(webapp2.RequestHandler):
         if not token:
             self.abort(401, 'User not logged in.')
         result = config.db.authtokens.delete_one({'_id': token})
+        authcache.invalidate('authtokens', token)
         return {'tokens_removed': result.deleted_count}
 
     def is_true(self, param):
@@ -369,19 +393,27 @@ class RequestHandler(webapp2.RequestHandler):
 
         Query params:
             ?after_id=id
+            ?cursor=[cursor]
             ?filter=k1=v1,k2>v2,k2<v3 [, ...]
             ?sort=k1,k2:desc [, ...]
             ?page=N
             ?skip=N
             ?limit=N
+            ?total=true|false
+
+        Cursor pagination starts with an empty cursor (optionally with sort) and continues with
+        the next_cursor of each page (which requires the `pagination` feature). Totals are computed
+        for paginated responses, except for cursor pagination, unless set with total.
         """
 
         pagination = {}
         parsers = {'after_id': util.parse_pagination_value,
+                   'cursor': util.parse_pagination_cursor,
                    'filter': util.parse_pagination_filter_param,
-                   'sort': util.parse_pagination_sort_param}
+                   'sort': util.parse_pagination_sort_param,
+                   'total': util.parse_pagination_bool_param}
 
-        for param_name in ('after_id', 'filter', 'sort', 'page', 'skip', 'limit'):
+        for param_name in ('after_id', 'cursor', 'filter', 'sort', 'page', 'skip', 'limit', 'total'):
             param_count = len(self.request.GET.getall(param_name))
             if param_count > 1:
                 raise errors.APIValidationException('Multiple "{}" query params not allowed'.format(param_name))
@@ -398,6 +430,15 @@ class RequestHandler(webapp2.RequestHandler):
                 if param in pagination:
                     raise errors.APIValidationException('"after_id" query param cannot be used with "{}"'.format(param))
 
+        if 'cursor' in pagination:
+            if not self.is_enabled('pagination'):
+                raise errors.APIValidationException('"cursor" query param requires the pagination feature')
+            for param in ('after_id', 'page', 'skip'):
+                if param in pagination:
+                    raise errors.APIValidationException('"cursor" query param cannot be used with "{}"'.format(param))
+            if pagination['cursor'] and 'sort' in pagination:
+                raise errors.APIValidationException('"sort" query param cannot be used with a non-empty "cursor"')
+
         if 'page' in pagination:
             if 'skip' in pagination:
                 raise errors.APIValidationException('"page" and "skip" query params are mutually exclusive')
@@ -405,15 +446,19 @@ class RequestHandler(webapp2.RequestHandler):
                 raise errors.APIValidationException('"limit" query param is required with "page"')
             pagination['skip'] = pagination['limit'] * (pagination.pop('page') - 1)
 
+        pagination.setdefault('total', self.is_enabled('pagination') and 'cursor' not in pagination)
         return pagination
 
     def format_page(self, page):
         """
-        Return page (dict with total and results) if `pagination` feature is enabled.
+        Return page (dict with results, and total and next_cursor if computed) if `pagination`
+        feature is enabled.
         Return `page['results']` (list) otherwise, for backwards compatibility.
         """
         if not self.is_enabled('pagination'):
             return page['results']
+        if not isinstance(page['results'], list):
+            page['results'] = list(page['results'])
         page['count'] = len(page['results'])
         return page
 
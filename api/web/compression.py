@@ -0,0 +1,111 @@
+"""
+WSGI middleware that gzip compresses responses for clients that accept it.
+
+Responses are compressed chunk by chunk, flushing the compressor after every chunk (and every
+write() call), so streamed responses (chunked JSON, server-sent events, tar downloads) keep
+streaming. Already compressed content (by content type, or by the attachment's file name for
+application/octet-stream downloads), partial content and responses smaller than
+core.gzip_min_size bytes are passed through as-is. Setting core.gzip_level to 0 disables
+compression.
+"""
+import mimetypes
+import re
+import zlib
+
+from .. import config
+
+log = config.log
+
+# Content type prefixes of content that doesn't compress
+COMPRESSED_TYPES = (
+    'image/', 'video/', 'audio/',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+)
+FILENAME_RE = re.compile(r'filename="?([^";]+)"?')
+
+
+def gzip_level():
+    try:
+        return int(config.get_item('core', 'gzip_level'))
+    except KeyError:
+        return 0
+
+def gzip_min_size():
+    try:
+        return int(config.get_item('core', 'gzip_min_size'))
+    except KeyError:
+        return 0
+
+
+def is_compressible(status, headers, min_size):
+    """Return True if a response with the given status and headers should be compressed"""
+    if not status.startswith('200'):
+        return False
+    headers = {key.lower(): value for key, value in headers}
+    if 'content-encoding' in headers or 'content-range' in headers:
+        return False
+    content_length = headers.get('content-length')
+    if content_length is not None and int(content_length) < min_size:
+        return False
+
+    content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+    if content_type == 'application/octet-stream':
+        # Downloads: judge by the attachment's file name (eg. .tar is compressed, .nii.gz isn't)
+        match = FILENAME_RE.search(headers.get('content-disposition', ''))
+        if match:
+            content_type, encoding = mimetypes.guess_type(match.group(1))
+            if encoding is not None:
+                return False
+            content_type = content_type or 'application/octet-stream'
+    return not content_type.startswith(COMPRESSED_TYPES)
+
+
+class GzipMiddleware(object):
+    def __init__(self, app):
+        """Wrap the WSGI application app with response compression"""
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        level = gzip_level()
+        if (level <= 0 or environ.get('REQUEST_METHOD') == 'HEAD' or
+                'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', '').lower()):
+            return self.app(environ, start_response)
+
+        # Created by start_response if the response is to be compressed
+        state = {'compressor': None}
+
+        def compress(data):
+            if not data:
+                return data
+            return state['compressor'].compress(data) + state['compressor'].flush(zlib.Z_SYNC_FLUSH)
+
+        def gzip_start_response(status, headers, exc_info=None):
+            if is_compressible(status, headers, gzip_min_size()):
+                state['compressor'] = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                headers = [(key, value) for key, value in headers if key.lower() != 'content-length']
+                headers.append(('Content-Encoding', 'gzip'))
+                headers.append(('Vary', 'Accept-Encoding'))
+            write = start_response(status, headers, exc_info)
+            if state['compressor'] is None:
+                return write
+            return lambda data: write(compress(data))
+
+        app_iter = self.app(environ, gzip_start_response)
+        return self._compressed_iter(app_iter, state, compress)
+
+    @staticmethod
+    def _compressed_iter(app_iter, state, compress):
+        try:
+            for chunk in app_iter:
+                if state['compressor'] is None:
+                    yield chunk
+                else:
+                    compressed = compress(chunk)
+                    if compressed:
+                        yield compressed
+            if state['compressor'] is not None:
+                yield state['compressor'].flush(zlib.Z_FINISH)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -1,5 +1,6 @@
 from pymongo.cursor import Cursor
 import bson.objectid
+import collections
 import datetime
 import json
 import pytz
@@ -21,6 +22,58 @@ def custom_json_serializer(obj):
     raise TypeError(repr(obj) + " is not JSON serializable")
 
 
+# Size of the chunks json_stream_encode yields, in bytes
+JSON_STREAM_CHUNK_SIZE = 64 * 1024
+
+def is_streamed(obj):
+    """
+    Return True if obj is an iterator (eg. a cursor or a generator), or a dict holding one.
+    """
+    if isinstance(obj, collections.Iterator):
+        return True
+    if isinstance(obj, dict):
+        return any(isinstance(value, collections.Iterator) for value in obj.itervalues())
+    return False
+
+def json_stream_encode(obj, chunk_size=JSON_STREAM_CHUNK_SIZE):
+    """
+    Encode obj as JSON incrementally, yielding chunks of about chunk_size bytes.
+
+    Iterators in obj (at the top level or as values of a top level dict) are encoded as arrays
+    one item at a time, so that only the current item and chunk are held in memory.
+    """
+    chunk, size = [], 0
+    for piece in _iterencode(obj):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+def _iterencode(obj):
+    if isinstance(obj, collections.Iterator):
+        yield '['
+        for i, item in enumerate(obj):
+            if i:
+                yield ', '
+            for piece in _iterencode(item):
+                yield piece
+        yield ']'
+    elif isinstance(obj, dict) and is_streamed(obj):
+        yield '{'
+        for i, (key, value) in enumerate(obj.iteritems()):
+            if i:
+                yield ', '
+            yield json.dumps(key) + ': '
+            for piece in _iterencode(value):
+                yield piece
+        yield '}'
+    else:
+        yield json.dumps(obj, default=custom_json_serializer)
+
+
 def sse_pack(d):
     """
     Format a map with Server-Sent-Event-meaningful keys into a string for transport.
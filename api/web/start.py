@@ -1,4 +1,5 @@
 import atexit
+import itertools
 import json
 import os
 import traceback
@@ -78,7 +79,14 @@ def dispatcher(router, request, response):
                 # Bypass webapp2 handler, rv will be called with (environ, start_response)
                 if callable(rv):
                     return metrics.wrap_handler(rv)
-                response.write(json.dumps(rv, default=encoder.custom_json_serializer))
+                if encoder.is_streamed(rv):
+                    # Encode iterators (eg. cursors) into a chunked response as they are consumed.
+                    # The first chunk is encoded before responding, so that errors until then (which
+                    # covers most responses) are reported with a proper status.
+                    chunks = encoder.json_stream_encode(rv)
+                    response.app_iter = metrics.wrap_iter(itertools.chain([next(chunks, '')], chunks))
+                else:
+                    response.write(json.dumps(rv, default=encoder.custom_json_serializer))
                 response.headers['Content-Type'] = 'application/json; charset=utf-8'
         except webapp2.HTTPException as e:
             # pylint: disable=no-member
@@ -1,3 +1,4 @@
 from .web import start
+from .web.compression import GzipMiddleware
 
-application = start.app_factory()
+application = GzipMiddleware(start.app_factory())
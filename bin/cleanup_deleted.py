@@ -59,13 +59,14 @@ def main(*argv):
     cleanup_files(args.all, origins, args.project, args.job_phi)
 
 
-def execute_job_operations(job_operations, job_log_operations):
+def execute_job_operations(job_operations, job_log_operations, job_log_chunk_operations):
     """Unsets produced metadata and deletes job logs for the the jobs specified
     by the request list given
 
     Args:
         job_operations (list): A list of UpdateOne operations
         job_log_operations (list): A list of DeleteOne operations
+        job_log_chunk_operations (list): A list of DeleteMany operations
     Returns:
         tuple: tuple of modified count and deleted count
     """
@@ -82,6 +83,8 @@ def execute_job_operations(job_operations, job_log_operations):
         deleted_count = job_log_bulk_response.deleted_count
     else:
         deleted_count = 0
+    if job_log_chunk_operations:
+        db.job_log_chunks.bulk_write(job_log_chunk_operations)
 
     return modified_count, deleted_count
 
@@ -107,6 +110,7 @@ def generate_job_operations(container_list):
     log.debug('Found %s jobs', jobs.count())
     job_operations = []
     job_log_operations = []
+    job_log_chunk_operations = []
     for job in jobs:
         job_operations.append(pymongo.operations.UpdateOne(
             {'_id': job['_id']},
@@ -115,8 +119,11 @@ def generate_job_operations(container_list):
         job_log_operations.append(pymongo.operations.DeleteOne(
             {'_id': str(job['_id'])}
         ))
+        job_log_chunk_operations.append(pymongo.operations.DeleteMany(
+            {'job': str(job['_id'])}
+        ))
 
-    return job_operations, job_log_operations
+    return job_operations, job_log_operations, job_log_chunk_operations
 
 
 def cleanup_files(remove_all, origins, project_id, job_phi):
@@ -243,16 +250,16 @@ def cleanup_files(remove_all, origins, project_id, job_phi):
             if len(container_ids) == 100:
                 # Chunking the number of jobs to find to
                 # Number of jobs from 100 containers
-                job_operations, job_log_operations = generate_job_operations(container_ids)
-                result = execute_job_operations(job_operations, job_log_operations)
+                job_operations, job_log_operations, job_log_chunk_operations = generate_job_operations(container_ids)
+                result = execute_job_operations(job_operations, job_log_operations, job_log_chunk_operations)
                 jobs_modified += result[0]
                 job_logs_deleted += result[1]
                 container_ids = []
 
     if container_ids:
         # find the jobs % 100 left
-        job_operations, job_log_operations = generate_job_operations(container_ids)
-        result = execute_job_operations(job_operations, job_log_operations)
+        job_operations, job_log_operations, job_log_chunk_operations = generate_job_operations(container_ids)
+        result = execute_job_operations(job_operations, job_log_operations, job_log_chunk_operations)
         jobs_modified += result[0]
         job_logs_deleted += result[1]
         container_ids = []
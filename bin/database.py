@@ -23,6 +23,7 @@ from api.dao import containerutil
 from api.dao.containerstorage import ProjectStorage
 from api.jobs.jobs import Job
 from api.jobs import gears
+from api.jobs import job_counters
 from api.types import Origin
 from api.jobs import batch
 
@@ -30,7 +31,7 @@ from fixes import get_available_fixes, has_unappliable_fixes, apply_available_fi
 from checks import get_available_checks, apply_available_checks, get_check_function
 from process_cursor import process_cursor
 
-CURRENT_DATABASE_VERSION = 67 # An int that is bumped when a new schema change is made
+CURRENT_DATABASE_VERSION = 69 # An int that is bumped when a new schema change is made
 
 
 def get_db_version():
@@ -465,13 +466,13 @@ def upgrade_to_13():
     """
     config.db.singletons.find_one_and_update(
         {'_id': 'config', 'persistent.schema_path': {'$exists': True}},
-        {'$unset': {'persistent.schema_path': ''}})
+        {'$unset': {'persistent.schema_path': ''}, '$inc': {'version': 1}})
 
 def upgrade_to_14():
     """schema_path is no longer user configurable"""
     config.db.singletons.find_one_and_update(
         {'_id': 'config', 'persistent.schema_path': {'$exists': True}},
-        {'$unset': {'persistent.schema_path': ''}})
+        {'$unset': {'persistent.schema_path': ''}, '$inc': {'version': 1}})
 
 def upgrade_to_15():
     """
@@ -881,7 +882,9 @@ def upgrade_to_23():
         auth_config = db_config.get('auth', {})
         if auth_config.get('auth_type'):
             auth_type = auth_config.pop('auth_type')
-            config.db.singletons.update_one({'_id': 'config'}, {'$set': {'auth': {auth_type: auth_config}}})
+            # Bump the version, so that running API processes reload the config
+            config.db.singletons.update_one({'_id': 'config'},
+                                            {'$set': {'auth': {auth_type: auth_config}}, '$inc': {'version': 1}})
 
 def upgrade_to_24():
     """
@@ -2556,9 +2559,26 @@ def upgrade_to_67():
             }
         },
         True)
+    # Let running API processes re-derive the signed_url feature
+    config.db.singletons.update_one({'_id': 'config'}, {'$inc': {'version': 1}})
 
     upgrade_provider_id(storage.inserted_id)
 
+def upgrade_to_68():
+    """
+    Give all pending jobs the default priority, so they sort correctly in the scheduling indexes
+    """
+    config.db.jobs.update_many({'state': 'pending', 'priority': {'$exists': False}},
+                               {'$set': {'priority': 0}})
+
+
+def upgrade_to_69():
+    """
+    Count the existing jobs into the job counters by state, gear and compute provider
+    """
+    job_counters.reconcile()
+
+
 def upgrade_provider_id(storage_id):
 
     # Check if any file does not have a vaild _id
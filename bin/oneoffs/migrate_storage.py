@@ -283,6 +283,9 @@ def migrate_gears():
         migrate_gear_files(f)
         show_progress(i + 1, len(_files))
 
+    # Let running API processes drop their cached gear documents
+    db.singletons.update_one({'_id': 'gear_revision'}, {'$inc': {'revision': 1}}, upsert=True)
+
 def get_source_fs(provider_id): 
     if not sources.get('provider_id'):
         sources[provider_id] = get_provider(provider_id)
@@ -80,6 +80,8 @@ def main(*argv):
     log.info('Setting storage provider: %s', storage.inserted_id)
     update = {'$set': {'providers.storage': storage.inserted_id}}
     db.singletons.update({'_id': 'site'}, update)
+    # Let running API processes re-derive the signed_url feature
+    db.singletons.update_one({'_id': 'config'}, {'$inc': {'version': 1}})
     log.info('Providers have been modified')
 
 
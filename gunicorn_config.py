@@ -30,6 +30,16 @@ def child_exit(server, worker):
 
 def post_fork(server, worker):
     _init_logging()
+    _load_schemas()
+
+
+def post_worker_init(worker):
+    # After the worker's own signal handlers are set up
+    try:
+        from api.metrics import profiler
+        profiler.install_signal_handler()
+    except:
+        log.exception('Error installing profiler signal handler!')
 
 
 def when_ready(server):
@@ -40,6 +50,15 @@ def when_ready(server):
         log.exception('Error starting metrics worker!')
 
 
+def _load_schemas():
+    # Compile request validators before the worker takes requests
+    try:
+        from api import validators
+        validators.load_schemas()
+    except:
+        log.exception('Error loading validation schemas!')
+
+
 def _init_logging():
     logging_config_file = '/src/core/logging/core_config.yml'
     logging.init_flywheel_logging(logging_config_file, tag='uwsgi')
@@ -162,6 +162,22 @@ module.exports = function(grunt) {
       'name': 'after_id',
       'description': 'Paginate after the given id. (Cannot be used with sort, page or skip)'
     });
+
+    // Cursor
+    op.parameters.push({
+      'in': 'query',
+      'type': 'string',
+      'name': 'cursor',
+      'description': 'Paginate after the given cursor (next_cursor of the previous page, empty for the first page). (Cannot be used with page or skip, or with sort after the first page)'
+    });
+
+    // Total
+    op.parameters.push({
+      'in': 'query',
+      'type': 'boolean',
+      'name': 'total',
+      'description': 'Whether to count the total number of results (defaults to true, except with cursor)'
+    });
   }
 
 };
@@ -313,6 +313,44 @@ def test_batch(data_builder, as_user, as_admin, as_root, as_drone):
     r = as_admin.get('/batch/' + batch_id)
     assert r.json()['state'] == 'failed'
 
+    # Test batch run in the background
+    r = as_admin.post('/batch', json={
+        'gear_id': analysis_gear,
+        'targets': [{'type': 'session', 'id': session}]
+    })
+    assert r.ok
+    batch_id = r.json()['_id']
+
+    r = as_admin.post('/batch/' + batch_id + '/run', params={'async': 'true'})
+    assert r.status_code == 202
+    assert r.json()['state'] == 'running'
+    assert r.json()['progress']['total'] == 1
+
+    # wait for the launch to complete
+    for _ in range(50):
+        r = as_admin.get('/batch/' + batch_id)
+        if r.json()['progress']['launched'] == 1:
+            break
+        time.sleep(0.1)
+    assert r.json()['progress']['launched'] == 1
+    assert 'error' not in r.json()['progress']
+    assert len(r.json()['jobs']) == 1
+    job = r.json()['jobs'][0]
+
+    r = as_admin.get('/jobs/' + job)
+    assert r.json()['destination']['type'] == 'analysis'
+    analysis = r.json()['destination']['id']
+    r = as_admin.get('/analyses/' + analysis)
+    assert r.ok
+    assert r.json()['job'] == job
+
+    # cancel batch cancels its pending jobs
+    r = as_admin.post('/batch/' + batch_id + '/cancel')
+    assert r.ok
+    assert r.json()['number_cancelled'] == 1
+    r = as_admin.get('/jobs/' + job)
+    assert r.json()['state'] == 'cancelled'
+
 def test_no_input_batch(data_builder, default_payload, randstr, as_admin, as_drone, api_db):
     project = data_builder.create_project()
     session = data_builder.create_session(project=project)
@@ -970,6 +1008,14 @@ def test_batch_providers(compute_provider, data_builder, api_db, as_user, as_adm
     })
     assert r.status_code == 403
 
+    # Cannot create a batch with preconstructed jobs, raising the priority (if not admin)
+    batch_jobs_with_priority = copy.deepcopy(batch_jobs)
+    batch_jobs_with_priority[0]['priority'] = 10
+    r = as_user.post('/batch/jobs', json={
+        'jobs': batch_jobs_with_priority
+    })
+    assert r.status_code == 403
+
     # Can create a batch with preconstructed jobs, overriding provider_id (if admin)
     r = as_admin.post('/batch/jobs', json={
         'jobs': batch_jobs_with_provider
@@ -462,6 +462,10 @@ def test_jobs_full(data_builder, default_payload, as_public, as_user, as_admin,
     r = as_admin.get('/jobs/'+str(job_instance['_id'])+'/logs')
     assert r.ok
     assert "The job did not report in for a long time and was canceled. " in [log["msg"] for log in r.json()['logs']]
+    r = as_admin.get('/jobs/'+str(job_instance['_id']))
+    assert r.ok
+    assert r.json()['state'] == 'failed'
+    assert 'reap_id' not in r.json()
     api_db.jobs.delete_one({"_id": bson.ObjectId("5a007cdb0f352600d94c845f")})
 
     r = as_admin.get('/jobs/stats')
@@ -1052,6 +1056,10 @@ def test_jobs_ask(data_builder, default_payload, as_public, as_user, as_admin, a
     r = as_admin.get('/jobs/'+str(job_instance['_id'])+'/logs')
     assert r.ok
     assert "The job did not report in for a long time and was canceled. " in [log["msg"] for log in r.json()['logs']]
+    r = as_admin.get('/jobs/'+str(job_instance['_id']))
+    assert r.ok
+    assert r.json()['state'] == 'failed'
+    assert 'reap_id' not in r.json()
     api_db.jobs.delete_one({"_id": bson.ObjectId("5a007cdb0f352600d94c845f")})
 
     r = as_admin.get('/jobs/stats')
@@ -1931,6 +1939,7 @@ def test_job_requests(randstr, default_payload, data_builder, as_admin, as_drone
     # Create gears
     gear_doc = default_payload['gear']['gear']
     gear_doc['name'] = randstr()
+    gear_doc['capabilities'] = ['networking']
     gear_doc['inputs'] = {
         'dicom': {
             'base': 'file',
@@ -3153,3 +3162,466 @@ def test_jobs_projects_filter(compute_provider, data_builder, default_payload, a
         if j['_id'] == job_id:
             found = True
     assert not found
+
+def test_jobs_ask_multiple(randstr, data_builder, default_payload, as_admin, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {
+        'dicom': {
+            'base': 'file'
+        }
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    tag = randstr()
+    job_data = {
+        'gear_id': gear,
+        'inputs': {
+            'dicom': {
+                'type': 'acquisition',
+                'id': acquisition,
+                'name': 'test.zip'
+            }
+        },
+        'config': { 'two-digit multiple of ten': 20 },
+        'destination': {
+            'type': 'acquisition',
+            'id': acquisition
+        },
+        'tags': [ tag ]
+    }
+
+    job_ids = []
+    for _ in range(5):
+        r = as_admin.post('/jobs/add', json=job_data)
+        assert r.ok
+        job_ids.append(r.json()['_id'])
+
+    # try to peek more than one job
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'tag': [ tag ] },
+        'return': { 'jobs': 2, 'peek': True },
+    }))
+    assert r.status_code == 400
+
+    # try to start more jobs than allowed at once
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'tag': [ tag ] },
+        'return': { 'jobs': 100000 },
+    }))
+    assert r.status_code == 400
+
+    # start three jobs at once, in FIFO order
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'tag': [ tag ] },
+        'return': { 'jobs': 3 },
+    }))
+    assert r.ok
+    started = r.json()['jobs']
+    assert [job['id'] for job in started] == job_ids[:3]
+    for job in started:
+        assert job['state'] == 'running'
+        assert job['request']['target']['command']
+        job_doc = api_db.jobs.find_one({'_id': bson.ObjectId(job['id'])})
+        assert job_doc['request'] == job['request']
+        assert 'claim_id' not in job_doc
+
+    # start the rest via the legacy route, asking for more than there are
+    r = as_admin.get('/jobs/next', params={'tags': tag, 'count': 3})
+    assert r.ok
+    assert [job['id'] for job in r.json()] == job_ids[3:]
+
+    # nothing left to hand out
+    r = as_admin.get('/jobs/next', params={'tags': tag, 'count': 3})
+    assert r.ok
+    assert r.json() == []
+
+    # count must be a non-negative integer
+    for count in ('three', '-1', '1.5'):
+        r = as_admin.get('/jobs/next', params={'tags': tag, 'count': count})
+        assert r.status_code == 400
+    assert api_db.jobs.count({'tags': tag, 'state': 'running'}) == 5
+
+def test_jobs_priority_and_fair_share(randstr, data_builder, default_payload, as_admin, as_user, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {
+        'dicom': {
+            'base': 'file'
+        }
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    tag = randstr()
+
+    def add_job(acquisition, **kwargs):
+        job_data = {
+            'gear_id': gear,
+            'inputs': {
+                'dicom': {
+                    'type': 'acquisition',
+                    'id': acquisition,
+                    'name': 'test.zip'
+                }
+            },
+            'destination': {
+                'type': 'acquisition',
+                'id': acquisition
+            },
+            'tags': [ tag ]
+        }
+        job_data.update(kwargs)
+        r = as_admin.post('/jobs/add', json=job_data)
+        assert r.ok
+        return r.json()['_id']
+
+    group = data_builder.create_group()
+    acquisitions = {}
+    for name in ('busy', 'quiet'):
+        project = data_builder.create_project(group=group)
+        session = data_builder.create_session(project=project)
+        acquisitions[name] = data_builder.create_acquisition(session=session)
+        assert as_admin.post('/acquisitions/' + acquisitions[name] + '/files', files=file_form('test.zip')).ok
+
+    # The busy project queues a batch, the quiet project queues a single job afterwards
+    busy_jobs = [add_job(acquisitions['busy']) for _ in range(4)]
+    quiet_job = add_job(acquisitions['quiet'])
+    assert api_db.jobs.find_one({'_id': bson.ObjectId(quiet_job)})['priority'] == 0
+
+    # try to add job with invalid priority
+    r = as_admin.post('/jobs/add', json={'gear_id': gear, 'priority': 'high', 'destination': {'type': 'acquisition', 'id': acquisitions['busy']}})
+    assert r.status_code == 400
+
+    # try to raise priority as non-admin
+    r = as_user.post('/jobs/add', json={'gear_id': gear, 'priority': 10, 'destination': {'type': 'acquisition', 'id': acquisitions['busy']}})
+    assert r.status_code == 403
+
+    # Queue stats show the backlog per project
+    r = as_admin.get('/jobs/stats', params={'backlog': True})
+    assert r.ok
+    backlog = r.json()['backlog']
+    assert backlog['level'] == 'project'
+    assert sum(tenant['pending'] for tenant in backlog['tenants'].values()) >= 5
+
+    # Two jobs are shared between the projects despite the busy project's older backlog
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'group': [ group ], 'tag': [ tag ] },
+        'return': { 'jobs': 2 },
+    }))
+    assert r.ok
+    assert {job['id'] for job in r.json()['jobs']} == {busy_jobs[0], quiet_job}
+
+    # A high priority job jumps the queue
+    urgent_job = add_job(acquisitions['busy'], priority=10)
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'group': [ group ], 'tag': [ tag ] },
+        'return': { 'jobs': 1 },
+    }))
+    assert r.ok
+    assert [job['id'] for job in r.json()['jobs']] == [urgent_job]
+
+    # The busy project drains in FIFO order
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'group': [ group ], 'tag': [ tag ] },
+        'return': { 'jobs': 5 },
+    }))
+    assert r.ok
+    assert [job['id'] for job in r.json()['jobs']] == busy_jobs[1:]
+
+
+def test_jobs_request_precomputed(randstr, data_builder, default_payload, as_admin, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {
+        'dicom': {
+            'base': 'file'
+        }
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    tag = randstr()
+    job_data = {
+        'gear_id': gear,
+        'inputs': {
+            'dicom': {
+                'type': 'acquisition',
+                'id': acquisition,
+                'name': 'test.zip'
+            }
+        },
+        'config': { 'two-digit multiple of ten': 20 },
+        'destination': {
+            'type': 'acquisition',
+            'id': acquisition
+        },
+        'tags': [ tag ]
+    }
+
+    # the request is generated when the job is added, referencing its id
+    r = as_admin.post('/jobs/add', json=job_data)
+    assert r.ok
+    job = r.json()['_id']
+
+    job_doc = api_db.jobs.find_one({'_id': bson.ObjectId(job)})
+    assert job_doc['state'] == 'pending'
+    assert any(job in i['uri'] for i in job_doc['request']['inputs'])
+
+    # starting the job hands out the precomputed request
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'tag': [ tag ] },
+        'return': { 'jobs': 1 },
+    }))
+    assert r.ok
+    started = r.json()['jobs']
+    assert [j['id'] for j in started] == [job]
+    assert started[0]['request'] == job_doc['request']
+
+    # a pending job whose request was dropped gets it regenerated when started
+    r = as_admin.post('/jobs/add', json=job_data)
+    assert r.ok
+    job = r.json()['_id']
+    api_db.jobs.update_one({'_id': bson.ObjectId(job)}, {'$unset': {'request': ''}})
+
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'tag': [ tag ] },
+        'return': { 'jobs': 1 },
+    }))
+    assert r.ok
+    started = r.json()['jobs']
+    assert [j['id'] for j in started] == [job]
+    assert api_db.jobs.find_one({'_id': bson.ObjectId(job)})['request'] == started[0]['request']
+
+    # the start of the job is recorded in its logs
+    r = as_admin.get('/jobs/' + job + '/logs')
+    assert r.ok
+    assert r.json()['logs'][0]['msg'].startswith('Gear Name: ')
+
+
+def test_jobs_reap_in_bulk(randstr, data_builder, default_payload, as_admin, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {
+        'dicom': {
+            'base': 'file'
+        }
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    tag = randstr()
+    job_data = {
+        'gear_id': gear,
+        'inputs': {
+            'dicom': {
+                'type': 'acquisition',
+                'id': acquisition,
+                'name': 'test.zip'
+            }
+        },
+        'config': { 'two-digit multiple of ten': 20 },
+        'destination': {
+            'type': 'acquisition',
+            'id': acquisition
+        },
+        'tags': [ tag ]
+    }
+
+    job_ids = []
+    for _ in range(3):
+        r = as_admin.post('/jobs/add', json=job_data)
+        assert r.ok
+        job_ids.append(r.json()['_id'])
+
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'tag': [ tag ] },
+        'return': { 'jobs': 3 },
+    }))
+    assert r.ok
+    assert len(r.json()['jobs']) == 3
+
+    # the last job has used up its attempts
+    api_db.jobs.update_many({'_id': {'$in': [bson.ObjectId(job_id) for job_id in job_ids]}},
+                            {'$set': {'modified': datetime.datetime(1980, 1, 1)}})
+    api_db.jobs.update_one({'_id': bson.ObjectId(job_ids[2])}, {'$set': {'attempt': 5}})
+
+    r = as_admin.post('/jobs/reap')
+    assert r.ok
+    stats = r.json()
+    assert stats['orphaned'] == 3
+    assert stats['retried'] == 2
+    assert stats['duration_ms'] >= 0
+
+    for job_id in job_ids:
+        assert api_db.jobs.find_one({'_id': bson.ObjectId(job_id)})['state'] == 'failed'
+
+    for job_id in job_ids[:2]:
+        retry = api_db.jobs.find_one({'previous_job_id': job_id})
+        assert retry['state'] == 'pending'
+        assert retry['attempt'] == 2
+        assert all(job_id not in i['uri'] for i in retry['request']['inputs'])
+
+        r = as_admin.get('/jobs/' + job_id + '/logs')
+        assert r.ok
+        messages = [log['msg'] for log in r.json()['logs']]
+        assert 'The job did not report in for a long time and was canceled. ' in messages
+        assert 'Retried job as ' + str(retry['_id']) in messages
+
+    assert api_db.jobs.find_one({'previous_job_id': job_ids[2]}) is None
+
+    # nothing left to reap
+    r = as_admin.post('/jobs/reap')
+    assert r.ok
+    assert r.json()['orphaned'] == 0
+
+
+def test_job_counters(randstr, data_builder, default_payload, as_admin, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['name'] = randstr()
+    gear_doc['inputs'] = {
+        'dicom': {
+            'base': 'file'
+        }
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    job_data = {
+        'gear_id': gear,
+        'inputs': {
+            'dicom': {
+                'type': 'acquisition',
+                'id': acquisition,
+                'name': 'test.zip'
+            }
+        },
+        'config': { 'two-digit multiple of ten': 20 },
+        'destination': {
+            'type': 'acquisition',
+            'id': acquisition
+        }
+    }
+
+    def states():
+        r = as_admin.post('/jobs/ask', json=question({
+            'whitelist': { 'gear-name': [ gear_doc['name'] ] },
+            'return': { 'states': True },
+        }))
+        assert r.ok
+        return r.json()['states']
+
+    job_ids = []
+    for _ in range(3):
+        r = as_admin.post('/jobs/add', json=job_data)
+        assert r.ok
+        job_ids.append(r.json()['_id'])
+    assert states()['pending'] == 3
+
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'gear-name': [ gear_doc['name'] ] },
+        'return': { 'jobs': 2 },
+    }))
+    assert r.ok
+    assert len(r.json()['jobs']) == 2
+    running = [job['id'] for job in r.json()['jobs']]
+    pending = [job_id for job_id in job_ids if job_id not in running][0]
+
+    assert as_admin.put('/jobs/' + running[0], json={'state': 'complete'}).ok
+    assert as_admin.put('/jobs/' + pending, json={'state': 'cancelled'}).ok
+    counts = states()
+    assert counts['pending'] == 0
+    assert counts['running'] == 1
+    assert counts['complete'] == 1
+    assert counts['cancelled'] == 1
+
+    # jobs needing capabilities that were not asked for are not counted
+    r = as_admin.post('/jobs/ask', json=question({
+        'whitelist': { 'gear-name': [ gear_doc['name'] ] },
+        'capabilities': [],
+        'return': { 'states': True },
+    }))
+    assert r.ok
+    assert sum(r.json()['states'].values()) == 0
+
+    # reconcile rebuilds counters that drifted
+    api_db.job_counters.update_many({'gear_id': gear}, {'$set': {'count': 42}})
+    r = as_admin.post('/jobs/reconcile')
+    assert r.ok
+    assert r.json()['corrected'] >= 3
+    assert states() == counts
+
+
+def test_job_logs_ranges(data_builder, default_payload, as_admin, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {
+        'dicom': {
+            'base': 'file'
+        }
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    r = as_admin.post('/jobs/add', json={
+        'gear_id': gear,
+        'inputs': {
+            'dicom': {
+                'type': 'acquisition',
+                'id': acquisition,
+                'name': 'test.zip'
+            }
+        },
+        'config': { 'two-digit multiple of ten': 20 },
+        'destination': {
+            'type': 'acquisition',
+            'id': acquisition
+        },
+    })
+    assert r.ok
+    job = r.json()['_id']
+
+    # logs written before chunking are read as the start of the log
+    api_db.job_logs.insert_one({'_id': job, 'logs': [{'fd': -1, 'msg': 'legacy\n'}]})
+
+    assert as_admin.post('/jobs/' + job + '/logs', json=[{'fd': 1, 'msg': 'a'}, {'fd': 1, 'msg': 'b'}]).ok
+    since = datetime.datetime.utcnow()
+    assert as_admin.post('/jobs/' + job + '/logs', json=[{'fd': 2, 'msg': 'c'}]).ok
+
+    # every add is stored as its own chunk
+    assert api_db.job_log_chunks.count({'job': job}) == 2
+
+    r = as_admin.get('/jobs/' + job + '/logs')
+    assert r.ok
+    assert [log['msg'] for log in r.json()['logs']] == ['legacy\n', 'a', 'b', 'c']
+    assert r.json()['offset'] == 0
+    assert r.json()['length'] == 4
+
+    r = as_admin.get('/jobs/' + job + '/logs', params={'offset': 2})
+    assert r.ok
+    assert [log['msg'] for log in r.json()['logs']] == ['b', 'c']
+    assert r.json()['offset'] == 2
+
+    r = as_admin.get('/jobs/' + job + '/logs', params={'tail': 3})
+    assert r.ok
+    assert [log['msg'] for log in r.json()['logs']] == ['a', 'b', 'c']
+    assert r.json()['offset'] == 1
+
+    r = as_admin.get('/jobs/' + job + '/logs', params={'since': since.isoformat()})
+    assert r.ok
+    assert [log['msg'] for log in r.json()['logs']] == ['c']
+
+    r = as_admin.get('/jobs/' + job + '/logs/text', params={'tail': 2})
+    assert r.ok
+    assert r.text == 'bc'
+
+    r = as_admin.get('/jobs/' + job + '/logs/html', params={'offset': 3})
+    assert r.ok
+    assert r.text == '<span class="fd-2">c</span>\n'
+
+    # invalid ranges
+    r = as_admin.get('/jobs/' + job + '/logs', params={'tail': -1})
+    assert r.status_code == 400
+    r = as_admin.get('/jobs/' + job + '/logs', params={'offset': 'x'})
+    assert r.status_code == 400
+    r = as_admin.get('/jobs/' + job + '/logs', params={'since': 'not a date'})
+    assert r.status_code == 400
@@ -1504,6 +1504,45 @@ def test_67(api_db, database, data_builder):
     # assert a['files'][0].get('provider_id') == local_storage['_id']
 
 
+def test_68(api_db, database):
+    pending = bson.ObjectId()
+    complete = bson.ObjectId()
+    prioritized = bson.ObjectId()
+    api_db.jobs.insert_many([
+        {'_id': pending, 'state': 'pending'},
+        {'_id': complete, 'state': 'complete'},
+        {'_id': prioritized, 'state': 'pending', 'priority': 5},
+    ])
+
+    database.upgrade_to_68()
+
+    assert api_db.jobs.find_one({'_id': pending})['priority'] == 0
+    assert 'priority' not in api_db.jobs.find_one({'_id': complete})
+    assert api_db.jobs.find_one({'_id': prioritized})['priority'] == 5
+
+    api_db.jobs.delete_many({'_id': {'$in': [pending, complete, prioritized]}})
+
+
+def test_69(api_db, database):
+    gear_id = str(bson.ObjectId())
+    job_ids = [bson.ObjectId() for _ in range(3)]
+    api_db.jobs.insert_many([
+        {'_id': job_ids[0], 'state': 'pending', 'gear_id': gear_id, 'gear_info': {'name': 'upgrade-gear'}},
+        {'_id': job_ids[1], 'state': 'pending', 'gear_id': gear_id, 'gear_info': {'name': 'upgrade-gear'}},
+        {'_id': job_ids[2], 'state': 'complete', 'gear_id': gear_id, 'gear_info': {'name': 'upgrade-gear'}},
+    ])
+
+    database.upgrade_to_69()
+
+    counters = {c['state']: c for c in api_db.job_counters.find({'gear_id': gear_id})}
+    assert counters['pending']['count'] == 2
+    assert counters['pending']['gear_name'] == 'upgrade-gear'
+    assert counters['complete']['count'] == 1
+
+    api_db.jobs.delete_many({'_id': {'$in': job_ids}})
+    api_db.job_counters.delete_many({'gear_id': gear_id})
+
+
 def test_fix_move_flair_from_measurement_to_feature_66(api_db, fixes):
     if not api_db.modalities.find_one({'_id': 'MR'}):
         api_db.modalities.insert_one({
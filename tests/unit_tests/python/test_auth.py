@@ -6,6 +6,7 @@ import pytest
 import requests_mock
 
 import api.auth.authproviders
+from api.auth import authcache
 from api.auth.authproviders import BasicAuthProvider, AuthProviders
 
 
@@ -303,6 +304,7 @@ def test_google_auth(config, as_drone, as_public, api_db):
         # try to access api w/ expired token - provider fails to refresh token
         api_db.authtokens.update_one({'_id': token_1}, {'$set':
             {'expires': datetime.datetime.now() - datetime.timedelta(seconds=1)}})
+        authcache.clear()  # expire cached session tokens
         m.post(config.auth.google.refresh_endpoint, status_code=400)
         r = as_public.get('', headers={'Authorization': token_1})
         assert r.status_code == 401
@@ -320,6 +322,7 @@ def test_google_auth(config, as_drone, as_public, api_db):
         # try to access api w/ expired token but w/o persisted refresh_token
         api_db.authtokens.update_one({'_id': token_2}, {'$set':
             {'expires': datetime.datetime.now() - datetime.timedelta(seconds=1)}})
+        authcache.clear()  # expire cached session tokens
         api_db.refreshtokens.delete_one({'uid': uid})
         r = as_public.get('', headers={'Authorization': token_2})
         assert r.status_code == 401
@@ -405,6 +408,7 @@ def test_wechat_auth(config, as_drone, as_public, api_db):
         # try to access api w/ expired token - provider fails to refresh token
         api_db.authtokens.update_one({'_id': token_1}, {'$set':
             {'expires': datetime.datetime.now() - datetime.timedelta(seconds=1)}})
+        authcache.clear()  # expire cached session tokens
         m.post(config.auth.wechat.refresh_endpoint, status_code=400)
         r = as_public.get('', headers={'Authorization': token_1})
         assert r.status_code == 401
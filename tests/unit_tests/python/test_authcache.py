@@ -0,0 +1,130 @@
+import datetime
+
+import mock
+import pytest
+
+from api import config
+from api.auth import authcache
+from api.auth.apikeys import UserApiKey, APIKey
+from api.web.errors import APIAuthProviderException
+
+
+def test_api_key_cache(api_db):
+    authcache.clear()
+    api_db.apikeys.insert_one({
+        '_id': 'cached-key',
+        'created': datetime.datetime.utcnow(),
+        'last_used': None,
+        'type': 'user',
+        'origin': {'type': 'user', 'id': 'cached@user.com'}
+    })
+
+    api_key = APIKey.validate('cached-key')
+    assert api_key['origin']['id'] == 'cached@user.com'
+    assert authcache.last_touched('apikeys', 'cached-key', 'last_used') is not None
+
+    # Callers get a copy of the cached document
+    api_key['origin']['id'] = 'changed'
+    # Changes made behind the cache's back are seen once the entry expires
+    api_db.apikeys.delete_one({'_id': 'cached-key'})
+    assert APIKey.validate('cached-key')['origin']['id'] == 'cached@user.com'
+
+    # Revoking the key invalidates it immediately
+    UserApiKey.revoke('cached@user.com')
+    with pytest.raises(APIAuthProviderException):
+        APIKey.validate('cached-key')
+
+
+def test_auth_cache_expiry(mocker):
+    authcache.clear()
+    now = 1000.0
+    mocker.patch('api.auth.authcache.time.time', side_effect=lambda: now)
+    mocker.patch('api.auth.authcache.cache_ttl', return_value=10)
+
+    authcache.put('authtokens', 'token', {'_id': 'token', 'uid': 'user@user.com'})
+    assert authcache.get('authtokens', 'token') == {'_id': 'token', 'uid': 'user@user.com'}
+    authcache.invalidate('authtokens', match=lambda token: token['uid'] == 'other@user.com')
+    assert authcache.get('authtokens', 'token') is not None
+
+    now += 11
+    assert authcache.get('authtokens', 'token') is None
+
+
+def test_auth_cache_revision(api_db, mocker):
+    now = [1000.0]
+    mocker.patch('api.auth.authcache.time.time', side_effect=lambda: now[0])
+    mocker.patch('api.auth.authcache.cache_ttl', return_value=10)
+    authcache.clear()
+
+    authcache.put('authtokens', 'token', {'_id': 'token', 'uid': 'user@user.com'})
+    authcache.put('apikeys', 'key', {'_id': 'key'})
+    assert authcache.get('authtokens', 'token') is not None
+
+    # Another process revokes a token: the namespace is dropped on the next revision check
+    api_db.singletons.update_one({'_id': 'auth_revision'}, {'$inc': {'authtokens': 1}}, upsert=True)
+    assert authcache.get('authtokens', 'token') is not None
+    now[0] += authcache.AUTH_CHECK_SECONDS + 1
+    assert authcache.get('authtokens', 'token') is None
+    assert authcache.get('apikeys', 'key') is not None
+
+    # Local invalidations bump the revision for the other processes
+    revision = authcache.get_revisions().get('apikeys', 0)
+    authcache.invalidate('apikeys', 'key')
+    assert authcache.get_revisions()['apikeys'] == revision + 1
+    authcache.invalidate('apikeys', 'other-key', local=True)
+    assert authcache.get_revisions()['apikeys'] == revision + 1
+
+
+def test_auth_flush(mocker):
+    db = mock.MagicMock()
+    mocker.patch('api.auth.authcache.config.db', db)
+    authcache.flush()
+    db.reset_mock()
+
+    earlier = datetime.datetime(2018, 1, 1)
+    later = datetime.datetime(2018, 1, 2)
+    authcache.touch('devices', 'device', 'last_seen', later)
+    authcache.touch('devices', 'device', 'last_seen', earlier)
+    authcache.touch('authtokens', 'token', 'last_seen', earlier)
+    assert authcache.last_touched('devices', 'device', 'last_seen') == later
+
+    authcache.flush()
+    assert authcache.last_touched('devices', 'device', 'last_seen') is None
+    operations = db['devices'].bulk_write.call_args[0][0]
+    assert len(operations) == 1
+    assert operations[0]._doc == {'$max': {'last_seen': later}}
+
+    # Write errors are logged, not raised
+    db['authtokens'].bulk_write.side_effect = Exception('write failed')
+    authcache.touch('authtokens', 'token', 'last_seen', later)
+    authcache.flush()
+
+
+def test_session_token_inactivity_timeout(as_public, api_db, mocker):
+    authcache.clear()
+    authcache.flush()
+    get_item = config.get_item
+    mocker.patch('api.web.base.config.get_item', side_effect=lambda section, key:
+                 3600 if (section, key) == ('site', 'inactivity_timeout') else get_item(section, key))
+    api_db.users.insert_one({'_id': 'inactive@user.com', 'firstname': 'Inactive', 'lastname': 'User'})
+    now = datetime.datetime.utcnow()
+
+    # Token never seen and not touched by this process yet
+    api_db.authtokens.insert_one({'_id': 'untouched-token', 'uid': 'inactive@user.com', 'auth_type': 'google',
+                                  'expires': now + datetime.timedelta(hours=1)})
+    assert as_public.get('/users/self', headers={'Authorization': 'untouched-token'}).ok
+    assert authcache.last_touched('authtokens', 'untouched-token', 'last_seen') is not None
+
+    # Token seen (in the database) recently, but not by this process
+    authcache.flush()
+    assert as_public.get('/users/self', headers={'Authorization': 'untouched-token'}).ok
+
+    # Token not seen for longer than the timeout
+    authcache.flush()
+    authcache.clear()
+    api_db.authtokens.update_one({'_id': 'untouched-token'},
+                                 {'$set': {'last_seen': now - datetime.timedelta(hours=2)}})
+    assert as_public.get('/users/self', headers={'Authorization': 'untouched-token'}).status_code == 401
+    assert api_db.authtokens.find_one({'_id': 'untouched-token'}) is None
+
+    api_db.users.delete_one({'_id': 'inactive@user.com'})
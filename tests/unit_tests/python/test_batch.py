@@ -0,0 +1,50 @@
+import datetime
+
+from api.jobs import batch
+from api.jobs.queue import Queue
+
+
+def test_reap_stale_launch(api_db, mocker):
+    batch_id = batch.insert({'state': 'pending', 'proposal': {'preconstructed_jobs': [{}, {}]}})
+
+    # The launcher dies before launching any of the jobs
+    mocker.patch('api.jobs.batch.threading.Thread')
+    batch.run_in_background(batch.get(batch_id))
+    batch_doc = api_db.batch.find_one({'_id': batch_id})
+    assert batch_doc['state'] == 'running'
+    assert batch_doc['progress']['launched'] == 0
+    assert batch.check_state(batch_id) is None
+    assert batch.reap_stale_launches() == 0
+
+    # Once the heartbeat is stale, the launch is stopped and the batch fails
+    api_db.batch.update_one({'_id': batch_id}, {'$set': {
+        'progress.heartbeat': datetime.datetime.utcnow() - batch.BATCH_LAUNCH_TIMEOUT - datetime.timedelta(seconds=1)}})
+    assert batch.reap_stale_launches() == 1
+    batch_doc = api_db.batch.find_one({'_id': batch_id})
+    assert batch_doc['state'] == 'failed'
+    assert batch_doc['progress']['error'] == 'The batch launch stopped after launching 0 of 2 jobs'
+    assert batch.reap_stale_launches() == 0
+
+    api_db.batch.delete_one({'_id': batch_id})
+
+
+def test_check_state_stale_launch(api_db):
+    stale = datetime.datetime.utcnow() - batch.BATCH_LAUNCH_TIMEOUT - datetime.timedelta(seconds=1)
+    batch_id = batch.insert({'state': 'running', 'jobs': [],
+                             'progress': {'total': 2, 'launched': 0, 'heartbeat': stale}})
+
+    assert batch.check_state(batch_id) == 'failed'
+    assert 'error' in api_db.batch.find_one({'_id': batch_id})['progress']
+
+    api_db.batch.delete_one({'_id': batch_id})
+
+
+def test_scan_for_orphans_reaps_stale_launches(api_db):
+    stale = datetime.datetime.utcnow() - batch.BATCH_LAUNCH_TIMEOUT - datetime.timedelta(seconds=1)
+    batch_id = batch.insert({'state': 'running', 'jobs': [],
+                             'progress': {'total': 2, 'launched': 0, 'heartbeat': stale}})
+
+    assert Queue.scan_for_orphans()['stale_batch_launches'] == 1
+    assert api_db.batch.find_one({'_id': batch_id})['state'] == 'failed'
+
+    api_db.batch.delete_one({'_id': batch_id})
@@ -0,0 +1,80 @@
+import gzip
+import json
+import StringIO
+import zlib
+
+import webob
+
+from api.web.compression import GzipMiddleware, is_compressible
+
+
+def make_app(status, headers, chunks=(), writes=()):
+    def app(environ, start_response):
+        write = start_response(status, list(headers))
+        for data in writes:
+            write(data)
+        return iter(chunks)
+    return app
+
+def call(app, accept_encoding='gzip, deflate'):
+    """Call the app, return (status, headers, writes, chunks)"""
+    result = {}
+    writes = []
+    def start_response(status, headers, exc_info=None):
+        result['status'], result['headers'] = status, dict(headers)
+        return writes.append
+    environ = webob.Request.blank('/api/test', headers={'Accept-Encoding': accept_encoding}).environ
+    chunks = list(GzipMiddleware(app)(environ, start_response))
+    return result['status'], result['headers'], writes, chunks
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+
+def test_is_compressible():
+    json_headers = [('Content-Type', 'application/json; charset=utf-8')]
+    assert is_compressible('200 OK', json_headers, 1024)
+    assert is_compressible('200 OK', json_headers + [('Content-Length', '2048')], 1024)
+    assert not is_compressible('200 OK', json_headers + [('Content-Length', '100')], 1024)
+    assert not is_compressible('206 Partial Content', json_headers, 1024)
+    assert not is_compressible('200 OK', json_headers + [('Content-Encoding', 'gzip')], 1024)
+    assert not is_compressible('200 OK', [('Content-Type', 'image/png')], 1024)
+    assert is_compressible('200 OK', [('Content-Type', 'application/octet-stream'),
+                                      ('Content-Disposition', 'attachment; filename="download.tar"')], 1024)
+    assert not is_compressible('200 OK', [('Content-Type', 'application/octet-stream'),
+                                          ('Content-Disposition', 'attachment; filename="brain.nii.gz"')], 1024)
+    assert not is_compressible('200 OK', [('Content-Type', 'application/octet-stream'),
+                                          ('Content-Disposition', 'attachment; filename="images.zip"')], 1024)
+
+
+def test_gzip_middleware(config):
+    docs = [{'_id': str(i), 'label': 'compressed'} for i in range(1000)]
+    body = json.dumps(docs)
+    chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]
+    app = make_app('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))], chunks)
+
+    status, headers, _, compressed = call(app)
+    assert status == '200 OK'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Length' not in headers
+    assert len(''.join(compressed)) < len(body) / 5
+    assert json.loads(gunzip(''.join(compressed))) == docs
+
+    # Not accepted by the client
+    _, headers, _, uncompressed = call(app, accept_encoding='identity')
+    assert 'Content-Encoding' not in headers
+    assert ''.join(uncompressed) == body
+
+
+def test_gzip_streamed_writes(config):
+    events = ['event: progress\ndata: {}\n\n'.format(i) for i in range(3)]
+    app = make_app('200 OK', [('Content-Type', 'text/event-stream; charset=utf-8')], writes=events)
+
+    _, headers, writes, chunks = call(app)
+    assert headers['Content-Encoding'] == 'gzip'
+    # Every write is flushed, so that the client can decode each event as it arrives
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for event, data in zip(events, writes):
+        assert decompressor.decompress(data) == event
+    assert gunzip(''.join(writes + chunks)) == ''.join(events)
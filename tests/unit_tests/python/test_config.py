@@ -1,3 +1,4 @@
+import collections
 import copy
 import datetime
 import json
@@ -74,14 +75,14 @@ def test_apply_env_variables(mocker, tmpdir):
         'test': {'true': True, 'false': False, 'none': None},
         'site': {'upload_maximum_bytes': '10'},
         'features': features2}
-    api.config.__last_update = datetime.datetime.min
+    api.config.__last_check = datetime.datetime.min
 
     try:
         result = api.config.get_config()
         assert result['features']['new_feature'] == 'test_value'
         assert not result['features']['true']
     finally:
-        api.config.__last_update = datetime.datetime.min
+        api.config.__last_check = datetime.datetime.min
 
 def test_create_or_recreate_ttl_index(mocker):
     db = mocker.patch('api.config.db')
@@ -118,7 +119,7 @@ def test_signed_urls():
 
     #We should assume our tests start with a valid state
     api.config.db.providers.remove({'label': regex})
-    api.config.__last_update = datetime.datetime(2000, 1, 1)
+    api.config.bump_config_version()
     assert api.config.get_config()['features']['signed_url'] == False
 
     # One OSFS is assumed to be local storage
@@ -127,25 +128,73 @@ def test_signed_urls():
 
     # Lets add a signed url storage provider to trigger signed_url boolean true
     api.config.db.providers.insert({'label': 'remove_me_signed', 'provider_class': 'storage', 'provider_type': 'aws'})
-    api.config.__last_update = datetime.datetime(2000, 1, 1)
+    api.config.bump_config_version()
     assert api.config.get_config()['features']['signed_url'] == True
 
     # Multiple signed url providers is still true
     api.config.db.providers.insert({'label': 'remove_me_signed_gc', 'provider_class': 'storage', 'provider_type': 'gc'})
-    api.config.__last_update = datetime.datetime(2000, 1, 1)
+    api.config.bump_config_version()
     assert api.config.get_config()['features']['signed_url'] == True
 
     # Signed with only one gc provider
     api.config.db.providers.remove({'label': 'remove_me_signed'})
-    api.config.__last_update = datetime.datetime(2000, 1, 1)
+    api.config.bump_config_version()
     assert api.config.get_config()['features']['signed_url'] == True
     api.config.db.providers.insert({'label': 'remove_me_signed', 'provider_class': 'storage', 'provider_type': 'aws'})
 
     # The second osfs will render signed urls False
     api.config.db.providers.insert({'label': 'remove_me_2', 'provider_class': 'storage', 'provider_type': 'osfs'})
-    api.config.__last_update = datetime.datetime(2000, 1, 1)
+    api.config.bump_config_version()
     assert api.config.get_config()['features']['signed_url'] == False
 
 
     #Clean up our providers
     api.config.db.providers.remove({'label': regex})
+
+
+def test_config_reload(mocker):
+    # Register the callbacks of this test only for its duration
+    mocker.patch.object(api.config, '__section_callbacks', collections.defaultdict(list))
+    changed_sections = []
+    api.config.on_section_change('site', lambda site: changed_sections.append(('site', site['name'])))
+    api.config.on_section_change('auth', lambda auth: changed_sections.append(('auth', auth)))
+
+    site_name = api.config.get_item('site', 'name')
+    api.config.reload_if_changed()
+    assert not api.config.reload_if_changed()
+
+    # Changes are picked up when the version changes
+    api.config.db.singletons.find_one_and_update({'_id': 'config'}, {'$set': {'site.name': 'Reloaded'}})
+    assert not api.config.reload_if_changed()
+    assert api.config.get_item('site', 'name') == site_name
+
+    api.config.db.singletons.find_one_and_update({'_id': 'config'}, {'$inc': {'version': 1}})
+    assert api.config.reload_if_changed()
+    assert api.config.get_item('site', 'name') == 'Reloaded'
+    assert changed_sections == [('site', 'Reloaded')]
+
+    # Clean up
+    api.config.db.singletons.find_one_and_update({'_id': 'config'},
+        {'$set': {'site.name': site_name}, '$inc': {'version': 1}})
+    assert api.config.reload_if_changed()
+    assert changed_sections == [('site', 'Reloaded'), ('site', site_name)]
+
+
+def test_config_persist_version(mocker):
+    api.config.get_config()
+    version = api.config.get_config_version()
+
+    # Persisting an unchanged config leaves the version alone
+    mocker.patch.object(api.config, '__config_persisted', False)
+    api.config.get_config()
+    assert api.config.get_config_version() == version
+    assert not api.config.reload_if_changed()
+
+    # Persisting the config with a section missing from the database bumps the version
+    queue = api.config.db.singletons.find_one({'_id': 'config'})['queue']
+    api.config.db.singletons.update_one({'_id': 'config'}, {'$unset': {'queue': ''}})
+    mocker.patch.object(api.config, '__config_persisted', False)
+    assert api.config.get_config()['version'] == version + 1
+    assert api.config.get_config_version() == version + 1
+    assert api.config.db.singletons.find_one({'_id': 'config'})['queue'] == queue
+    assert not api.config.reload_if_changed()
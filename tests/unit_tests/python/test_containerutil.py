@@ -1,7 +1,11 @@
 # coding=utf-8
-from api.dao.containerutil import ContainerReference
+import bson
 import mock
 
+from api.dao import containerutil
+from api.dao.basecontainerstorage import ContainerStorage
+from api.dao.containerutil import ContainerReference
+
 
 def test_container_reference_file_uri_should_not_raise_exception_if_unicode_in_filename():
     container_reference = ContainerReference('sessions', 'session-id')
@@ -11,3 +15,42 @@ def test_container_reference_file_uri_should_not_raise_exception_if_unicode_in_f
     file_uri = container_reference.file_uri(filename)
 
     assert file_uri == '/sessions/session-id/files/åß∂.txt'
+
+
+def test_container_types(api_db, mocker):
+    session_id, acquisition_id = bson.ObjectId(), bson.ObjectId()
+    api_db.groups.insert_one({'_id': 'indexed-group'})
+    api_db.sessions.insert_one({'_id': session_id})
+    api_db.acquisitions.insert_one({'_id': acquisition_id})
+
+    # Containers not indexed yet are searched for and indexed
+    ids = [session_id, acquisition_id, 'indexed-group', bson.ObjectId(), 'missing-group']
+    types = {session_id: 'sessions', acquisition_id: 'acquisitions', 'indexed-group': 'groups'}
+    assert containerutil.container_types(ids) == types
+    assert api_db.container_index.count({'_id': {'$in': ids}}) == 3
+
+    # Then found in the index with one query
+    find_spies = [mocker.spy(api_db[coll_name], 'find') for coll_name in containerutil.PLURAL_CONT_TYPES]
+    assert containerutil.container_types(ids[:3]) == types
+    assert all(spy.call_count == 0 for spy in find_spies)
+    assert containerutil.container_types([session_id], collections=['acquisitions']) == {}
+
+    # Searching by id queries the container's collection only
+    results = containerutil.container_search({'_id': str(acquisition_id)}, projection={'_id': 1})
+    assert results == [('acquisitions', [{'_id': acquisition_id}])]
+    assert sum(spy.call_count for spy in find_spies) == 1
+
+    for coll_name in ['groups', 'sessions', 'acquisitions']:
+        api_db[coll_name].delete_many({'_id': {'$in': ids}})
+    api_db.container_index.delete_many({'_id': {'$in': ids}})
+
+
+def test_container_storage_indexes_containers(api_db):
+    storage = ContainerStorage('collections', use_object_id=True)
+    collection_id = bson.ObjectId()
+    storage.create_el({'_id': collection_id, 'label': 'Indexed'}, None)
+    assert api_db.container_index.find_one({'_id': collection_id})['type'] == 'collections'
+
+    storage.delete_el(collection_id)
+    assert api_db.container_index.find_one({'_id': collection_id}) is None
+    assert containerutil.container_search({'_id': collection_id}) == []
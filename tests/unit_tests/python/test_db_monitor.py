@@ -0,0 +1,62 @@
+import mock
+
+from api.metrics import db_monitor, values
+from api.metrics.request_wrapper import RequestWrapper
+
+
+def _run_command(listener, command_name, command, duration_micros, request_id, failed=False):
+    listener.started(mock.MagicMock(command_name=command_name, command=command, connection_id=('db', 27017),
+                                    request_id=request_id))
+    event = mock.MagicMock(duration_micros=duration_micros, connection_id=('db', 27017), request_id=request_id)
+    if failed:
+        listener.failed(event)
+    else:
+        listener.succeeded(event)
+
+
+def test_command_listener():
+    listener = db_monitor.CommandListener()
+
+    def command_time_count(command, collection, result='success'):
+        return sum(bucket.get() for bucket in values.DB_COMMAND_TIME.labels(command, collection, result)._buckets)
+
+    find_count = command_time_count('find', 'monitored')
+    failed_count = command_time_count('update', 'monitored', 'failure')
+
+    # Commands outside of requests are only recorded in the histogram
+    _run_command(listener, 'find', {'find': 'monitored'}, 1000, 1)
+    assert command_time_count('find', 'monitored') == find_count + 1
+    assert db_monitor.current_request_stats() is None
+
+    stats = db_monitor.start_request()
+    _run_command(listener, 'find', {'find': 'monitored'}, 2000, 2)
+    _run_command(listener, 'getMore', {'getMore': 123, 'collection': 'monitored'}, 3000, 3)
+    _run_command(listener, 'update', {'update': 'monitored'}, 4000, 4, failed=True)
+    _run_command(listener, 'ismaster', {'ismaster': 1}, 5000, 5)
+    db_monitor.end_request(stats)
+    _run_command(listener, 'find', {'find': 'monitored'}, 6000, 6)
+
+    assert stats.count == 3
+    assert abs(stats.seconds - 0.009) < 1e-9
+    assert command_time_count('find', 'monitored') == find_count + 3
+    assert command_time_count('getMore', 'monitored') >= 1
+    assert command_time_count('update', 'monitored', 'failure') == failed_count + 1
+
+
+def test_request_db_stats(config):
+    request = mock.MagicMock(method='GET', path='/api/monitored')
+    request.route.template = '/api/monitored'
+    labels = ['GET', '/api/monitored', '200']
+    db_time = values.RESPONSE_DB_TIME.labels(*labels)._value.get()
+    db_count = values.RESPONSE_DB_COMMAND_COUNT.labels(*labels)._value.get()
+
+    with RequestWrapper(request, None):
+        _run_command(db_monitor.listener, 'find', {'find': 'monitored'}, 250000, 7)
+        _run_command(db_monitor.listener, 'find', {'find': 'monitored'}, 250000, 8)
+
+    assert db_monitor.current_request_stats() is None
+    assert values.RESPONSE_DB_TIME.labels(*labels)._value.get() == db_time + 0.5
+    assert values.RESPONSE_DB_COMMAND_COUNT.labels(*labels)._value.get() == db_count + 2
+    args = request.logger.info.call_args[0]
+    assert args[1:4] == ('GET', '/api/monitored', 200)
+    assert args[-2:] == (2, 0.5)
@@ -0,0 +1,65 @@
+import datetime
+import json
+
+import bson
+import pytest
+
+from api.web import encoder
+
+
+def test_json_stream_encode():
+    oid = bson.ObjectId()
+    docs = [{'_id': oid, 'created': datetime.datetime(2018, 1, 1), 'n': i} for i in range(100)]
+    expected = json.loads(json.dumps(docs, default=encoder.custom_json_serializer))
+
+    assert not encoder.is_streamed(docs)
+    assert encoder.is_streamed(iter(docs))
+    assert encoder.is_streamed({'total': 100, 'results': iter(docs)})
+
+    chunks = list(encoder.json_stream_encode(iter(docs), chunk_size=256))
+    assert len(chunks) > 1
+    assert json.loads(''.join(chunks)) == expected
+
+    page = ''.join(encoder.json_stream_encode({'total': 100, 'results': (doc for doc in docs)}))
+    assert json.loads(page) == {'total': 100, 'results': expected}
+
+    assert ''.join(encoder.json_stream_encode(iter([]))) == '[]'
+
+
+def test_streamed_response(as_admin, api_db):
+    api_db.jobs.insert_many([{'state': 'pending', 'gear_id': 'streamed-gear', 'produced_metadata': {}}
+                             for _ in range(3)])
+
+    r = as_admin.get('/jobs')
+    assert r.ok
+    jobs = [job for job in r.json if job.get('gear_id') == 'streamed-gear']
+    assert len(jobs) == 3
+    assert all('produced_metadata' not in job for job in jobs)
+
+    # Paginated responses are materialized to report the count
+    r = as_admin.get('/jobs?limit=1', headers={'X-Accept-Feature': 'pagination'})
+    assert r.ok
+    assert r.json['count'] == 1
+
+    api_db.jobs.delete_many({'gear_id': 'streamed-gear'})
+
+
+def test_streamed_response_error(as_admin, mocker):
+    def failing_results():
+        raise Exception('Cursor lost')
+        yield  # pylint: disable=unreachable
+
+    # Errors while encoding the first chunk are reported with an error status
+    mocker.patch('api.dao.dbutil.paginate_find', return_value={'results': failing_results()})
+    r = as_admin.get('/jobs')
+    assert r.status_code == 500
+
+    # Later errors end the response without closing the array
+    def results():
+        yield {'_id': bson.ObjectId(), 'gear_id': 'x' * encoder.JSON_STREAM_CHUNK_SIZE}
+        raise Exception('Cursor lost')
+    mocker.patch('api.dao.dbutil.paginate_find', return_value={'results': results()})
+    r = as_admin.get('/jobs')
+    assert r.status_code == 200
+    with pytest.raises(Exception):
+        r.body
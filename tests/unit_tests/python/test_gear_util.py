@@ -1,6 +1,10 @@
 
 import copy
+
+import pytest
+
 from api.jobs import gears
+from api.web.errors import APINotFoundException
 
 # DISCUSS: this basically asserts that the log helper doesn't throw, which is of non-zero but questionable value.
 # Could instead be marked for pytest et. al to ignore coverage? Desirability? Compatibility?
@@ -54,3 +58,44 @@ def test_fill_defaults():
     assert result['key_one'] == None
     assert result['key_two'] == []
     assert result['key_three'] == 3
+
+
+def test_gear_cache(api_db, mocker):
+    gear_doc = {'gear': {'name': 'cached-gear', 'version': '0.0.1', 'inputs': {}, 'config': {'x': {'type': 'integer'}}}}
+    gear_id = api_db.gears.insert_one(gear_doc).inserted_id
+    gears.bump_gears_revision()
+    now = [1000.0]
+    mocker.patch('api.jobs.gears.time.time', side_effect=lambda: now[0])
+
+    gear = gears.get_gear(gear_id)
+    assert gear['gear']['name'] == 'cached-gear'
+
+    # Cached gears are served from memory, as copies
+    gear['gear']['name'] = 'mutated'
+    api_db.gears.update_one({'_id': gear_id}, {'$set': {'gear.name': 'renamed'}})
+    assert gears.get_gear(str(gear_id))['gear']['name'] == 'cached-gear'
+
+    # Validators are compiled once per cached gear
+    derive = mocker.patch('api.jobs.gears.gear_tools.derive_invocation_schema', return_value={})
+    isolate = mocker.patch('api.jobs.gears.gear_tools.isolate_config_invocation', return_value={'type': 'object'})
+    gears.validate_gear_config(gear, {'x': 1})
+    gears.validate_gear_config(gears.get_gear(gear_id), {'x': 2})
+    assert derive.call_count == 1
+    assert isolate.call_count == 1
+
+    # The revision is checked at most every GEAR_CHECK_SECONDS
+    get_revision = mocker.spy(gears, 'get_gears_revision')
+    gears.get_gear(gear_id)
+    assert get_revision.call_count == 0
+
+    # Bumping the revision (as any other process changing gears does) drops the cache
+    api_db.singletons.find_one_and_update({'_id': 'gear_revision'}, {'$inc': {'revision': 1}}, upsert=True)
+    assert gears.get_gear(gear_id)['gear']['name'] == 'cached-gear'
+    now[0] += gears.GEAR_CHECK_SECONDS + 1
+    assert gears.get_gear(gear_id)['gear']['name'] == 'renamed'
+    assert get_revision.call_count == 1
+
+    # Removing the gear invalidates it
+    gears.remove_gear(gear_id)
+    with pytest.raises(APINotFoundException):
+        gears.get_gear(gear_id)
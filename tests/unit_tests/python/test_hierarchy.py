@@ -0,0 +1,117 @@
+import bson
+
+from api.dao import hierarchy
+from api.dao.basecontainerstorage import ContainerStorage
+
+
+def create_tree(api_db, group_id, n_acquisitions=2):
+    project_id, subject_id, session_id = bson.ObjectId(), bson.ObjectId(), bson.ObjectId()
+    api_db.groups.insert_one({'_id': group_id, 'label': 'Tree Group'})
+    api_db.projects.insert_one({'_id': project_id, 'label': 'Project', 'group': group_id,
+                                'parents': {'group': group_id}})
+    api_db.subjects.insert_one({'_id': subject_id, 'code': 'Subject', 'project': project_id,
+                                'parents': {'group': group_id, 'project': project_id}})
+    api_db.sessions.insert_one({'_id': session_id, 'label': 'Session', 'subject': subject_id, 'project': project_id,
+                                'parents': {'group': group_id, 'project': project_id, 'subject': subject_id}})
+    acquisition_ids = [bson.ObjectId() for _ in range(n_acquisitions)]
+    api_db.acquisitions.insert_many([{
+        '_id': acquisition_id, 'label': 'Acquisition', 'session': session_id,
+        'parents': {'group': group_id, 'project': project_id, 'subject': subject_id, 'session': session_id}
+    } for acquisition_id in acquisition_ids])
+    return project_id, subject_id, session_id, acquisition_ids
+
+def delete_tree(api_db, group_id):
+    for collection in ['projects', 'subjects', 'sessions', 'acquisitions']:
+        api_db[collection].delete_many({'parents.group': group_id})
+    api_db.groups.delete_one({'_id': group_id})
+
+
+def test_get_parent_trees(api_db, mocker):
+    hierarchy.clear_ancestor_cache()
+    project_id, subject_id, session_id, acquisition_ids = create_tree(api_db, 'tree-group')
+
+    tree = hierarchy.get_parent_tree('acquisitions', str(acquisition_ids[0]))
+    assert tree['acquisition']['_id'] == acquisition_ids[0]
+    assert tree['session']['_id'] == session_id
+    assert tree['subject']['_id'] == subject_id
+    assert tree['project']['_id'] == project_id
+    assert tree['group']['_id'] == 'tree-group'
+
+    # One query for the containers, ancestors come from the cache
+    find_spies = {name: mocker.spy(api_db[name], 'find') for name in ['acquisitions', 'sessions', 'groups']}
+    trees = hierarchy.get_parent_trees('acquisitions', acquisition_ids + [bson.ObjectId()])
+    assert sorted(trees) == sorted(acquisition_ids)
+    assert all(tree['session']['label'] == 'Session' for tree in trees.values())
+    assert find_spies['acquisitions'].call_count == 1
+    assert find_spies['sessions'].call_count == 0
+    assert find_spies['groups'].call_count == 0
+
+    # Cached ancestors expire
+    hierarchy.clear_ancestor_cache()
+    hierarchy.get_parent_trees('acquisitions', acquisition_ids)
+    assert find_spies['sessions'].call_count == 1
+
+    # Missing parents
+    api_db.sessions.delete_one({'_id': session_id})
+    hierarchy.clear_ancestor_cache()
+    assert hierarchy.get_parent_trees('acquisitions', acquisition_ids) == {}
+    assert hierarchy.get_parent_tree('groups', 'missing-group') == {'group': None}
+
+    delete_tree(api_db, 'tree-group')
+
+
+def test_container_storage_parent_trees(api_db, mocker):
+    project_id, subject_id, session_id, acquisition_ids = create_tree(api_db, 'storage-tree-group')
+    storage = ContainerStorage.factory('acquisitions')
+
+    tree = storage.get_parent_tree(acquisition_ids[0], add_self=True)
+    assert [(cont['cont_type'], cont['_id']) for cont in tree] == [
+        ('acquisitions', acquisition_ids[0]),
+        ('sessions', session_id),
+        ('subjects', subject_id),
+        ('projects', project_id),
+        ('groups', 'storage-tree-group'),
+    ]
+    # Sessions come with their subject joined
+    assert tree[1]['subject']['_id'] == subject_id
+    assert tree[2]['label'] == 'Subject'
+
+    # One query per level for many containers
+    find = mocker.spy(api_db.sessions, 'find')
+    conts = list(api_db.acquisitions.find({'_id': {'$in': acquisition_ids}}))
+    trees = storage.get_parent_trees(conts)
+    assert [len(tree) for tree in trees] == [4, 4]
+    assert find.call_count == 1
+
+    # Walking stops at missing parents
+    api_db.subjects.delete_one({'_id': subject_id})
+    assert [cont['cont_type'] for cont in storage.get_parent_tree(acquisition_ids[0])] == ['sessions']
+
+    delete_tree(api_db, 'storage-tree-group')
+
+
+def test_get_top_down_hierarchy(api_db, mocker):
+    project_id, subject_id, session_id, acquisition_ids = create_tree(api_db, 'top-down-group', n_acquisitions=5)
+    api_db.sessions.insert_one({'_id': bson.ObjectId(), 'label': 'Deleted', 'project': project_id, 'deleted': True})
+
+    tree = ContainerStorage.get_top_down_hierarchy('projects', str(project_id))
+    assert tree == {'projects': [str(project_id)], 'sessions': [session_id], 'acquisitions': acquisition_ids}
+
+    tree = ContainerStorage.get_top_down_hierarchy('groups', 'top-down-group', include_subjects=True)
+    assert tree['projects'] == [project_id]
+    assert tree['subjects'] == [subject_id]
+    assert sorted(tree['acquisitions']) == sorted(acquisition_ids)
+
+    # One query per level
+    find = mocker.spy(api_db.acquisitions, 'find')
+    levels = list(ContainerStorage.iter_top_down_hierarchy('sessions', session_id, chunk_size=1))
+    assert levels == [('sessions', [session_id]), ('acquisitions', acquisition_ids)]
+    assert find.call_count == 1
+
+    # No queries below an empty level
+    find_sessions = mocker.spy(api_db.sessions, 'find')
+    tree = ContainerStorage.get_top_down_hierarchy('groups', 'missing-group')
+    assert tree == {'groups': ['missing-group'], 'projects': [], 'sessions': [], 'acquisitions': []}
+    assert find_sessions.call_count == 0
+
+    delete_tree(api_db, 'top-down-group')
@@ -0,0 +1,42 @@
+import bson
+
+from api.jobs import job_counters
+
+
+def test_job_counters(api_db):
+    gear_id = str(bson.ObjectId())
+    provider_id = bson.ObjectId()
+    other_provider_id = bson.ObjectId()
+    jobs = [{
+        '_id': bson.ObjectId(),
+        'state': 'pending',
+        'gear_id': gear_id,
+        'gear_info': {'name': 'counted-gear', 'capabilities': ['networking']},
+        'compute_provider_id': provider_id,
+    } for _ in range(3)]
+
+    job_counters.count_inserted(jobs)
+    assert job_counters.get_counts(gear_names=['counted-gear']) == {'pending': 3}
+
+    job_counters.count_transition(jobs[:2], 'pending', 'running')
+    job_counters.count_transition(jobs[:1], 'running', 'complete')
+    assert job_counters.get_counts(gear_names=['counted-gear']) == {'pending': 1, 'running': 1, 'complete': 1}
+    assert job_counters.get_counts_by_gear()[gear_id] == 3
+
+    # Filters
+    assert job_counters.get_counts(excluded_gear_names=['counted-gear']).get('pending', 0) == \
+        job_counters.get_counts().get('pending', 0) - 1
+    assert job_counters.get_counts(gear_names=['counted-gear'], provider_ids=[str(provider_id)]) == \
+        {'pending': 1, 'running': 1, 'complete': 1}
+    assert job_counters.get_counts(gear_names=['counted-gear'], excluded_provider_ids=[provider_id]) == {}
+    assert job_counters.get_counts(gear_names=['counted-gear'], capabilities=[]) == {}
+    assert job_counters.get_counts(gear_names=['counted-gear'], capabilities=['networking', 'gpu']) == \
+        {'pending': 1, 'running': 1, 'complete': 1}
+
+    # Moving a job to another compute provider
+    job_counters.count_provider_change(jobs[2], 'pending', str(other_provider_id))
+    assert job_counters.get_counts(gear_names=['counted-gear'], provider_ids=[other_provider_id]) == {'pending': 1}
+    assert job_counters.get_counts(gear_names=['counted-gear']) == {'pending': 1, 'running': 1, 'complete': 1}
+
+    # Clean Up
+    api_db.job_counters.delete_many({'gear_id': gear_id})
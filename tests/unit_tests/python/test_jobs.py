@@ -1,5 +1,6 @@
 import bson
 from api.jobs import job_util
+from api.jobs.jobs import Logs
 
 
 def test_removing_phi_from_job_map():
@@ -60,3 +61,26 @@ def test_removing_phi_from_job_map_with_config_set_to_None():
     assert clean_job_map.get('produced_metadata') is None
     assert clean_job_map.get('config') is None
 
+
+
+def test_add_system_logs_many(api_db, mocker):
+    Logs.add('job-a', [{'msg': 'first', 'fd': 1}])
+
+    # Another append to the same log lands between reserving a chunk and inserting it
+    chunk = Logs._chunk
+    def racing_chunk(_id, log_header, doc):
+        if _id == 'job-a' and not racing_chunk.raced:
+            racing_chunk.raced = True
+            Logs.add('job-a', [{'msg': 'racing', 'fd': 1}])
+        return chunk(_id, log_header, doc)
+    racing_chunk.raced = False
+    mocker.patch.object(Logs, '_chunk', side_effect=racing_chunk)
+
+    Logs.add_system_logs_many({'job-a': ['system 1', 'system 2'], 'job-b': ['system'], 'job-c': []})
+
+    assert [s['msg'] for s in Logs.get('job-a')['logs']] == ['first', 'system 1', 'system 2', 'racing']
+    assert [s['msg'] for s in Logs.get('job-b')['logs']] == ['system']
+    assert Logs.get('job-c')['logs'] == []
+
+    api_db.job_logs.delete_many({'_id': {'$in': ['job-a', 'job-b']}})
+    api_db.job_log_chunks.delete_many({'job': {'$in': ['job-a', 'job-b']}})
@@ -0,0 +1,79 @@
+import datetime
+
+from api.metrics import collect, values
+
+
+def test_user_login_watermark(api_db, log_db, mocker):
+    api_db.singletons.delete_one({'_id': 'metrics_user_login'})
+    mocker.patch('api.metrics.collect._out_of_budget', return_value=False)
+    now = datetime.datetime.utcnow()
+    def login(uid, seconds_ago):
+        log_db.access_log.insert_one({'access_type': 'user_login', 'origin': {'type': 'user', 'id': uid},
+                                      'timestamp': now - datetime.timedelta(seconds=seconds_ago)})
+
+    login('first@user.com', 60)
+    login('second@user.com', 50)
+    login('admin@flywheel.io', 40)
+    login('recent@user.com', 1)  # Counted once older than the watermark lag
+    collect.collect_user_login_metrics()
+    assert values.USER_LOGIN_COUNT._value.get() == 2
+
+    # Only entries past the watermark are read
+    find = mocker.spy(log_db.access_log, 'find')
+    login('third@user.com', 30)
+    collect.collect_user_login_metrics()
+    assert values.USER_LOGIN_COUNT._value.get() == 3
+    assert find.call_args[0][0]['timestamp']['$gt'] == now - datetime.timedelta(seconds=50)
+    state = api_db.singletons.find_one({'_id': 'metrics_user_login'})
+    assert state['count'] == 3
+    assert state['last_login'] == now - datetime.timedelta(seconds=30)
+
+    # Out of budget, the pass stops between timestamps and the next one picks up the rest
+    login('fourth@user.com', 20)
+    login('fifth@user.com', 20)
+    login('sixth@user.com', 10)
+    mocker.patch('api.metrics.collect._out_of_budget', return_value=True)
+    collect.collect_user_login_metrics()
+    assert values.USER_LOGIN_COUNT._value.get() == 5
+    mocker.patch('api.metrics.collect._out_of_budget', return_value=False)
+    collect.collect_user_login_metrics()
+    assert values.USER_LOGIN_COUNT._value.get() == 6
+
+    log_db.access_log.delete_many({'access_type': 'user_login'})
+    api_db.singletons.delete_one({'_id': 'metrics_user_login'})
+
+
+def test_collector_intervals(mocker):
+    calls = []
+    mocker.patch.object(collect, 'COLLECTORS', [
+        (30, lambda: calls.append('frequent')),
+        (300, lambda: calls.append('rare')),
+    ])
+    collect.COLLECTORS[0][1].__name__ = 'frequent'
+    collect.COLLECTORS[1][1].__name__ = 'rare'
+    mocker.patch.dict(collect._last_run, clear=True)
+    timer = mocker.patch('api.metrics.collect.default_timer', return_value=1000.0)
+
+    collect.collect_db_metrics()
+    assert calls == ['frequent', 'rare']
+
+    timer.return_value = 1040.0
+    collect.collect_db_metrics()
+    assert calls == ['frequent', 'rare', 'frequent']
+
+    # Deferred collectors run first on the next pass
+    mocker.patch.dict(collect._last_run, clear=True)
+    mocker.patch('api.metrics.collect._out_of_budget', side_effect=[False, True])
+    collect.collect_db_metrics()
+    assert calls[-1] == 'frequent'
+    assert 'rare' not in collect._last_run
+    mocker.patch('api.metrics.collect._out_of_budget', return_value=False)
+    timer.return_value = 1080.0
+    del calls[:]
+    collect.collect_db_metrics()
+    assert calls == ['rare', 'frequent']
+
+    # All collectors run when forced
+    del calls[:]
+    collect.collect_db_metrics(force=True)
+    assert calls == ['frequent', 'rare']
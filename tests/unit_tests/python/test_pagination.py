@@ -1,6 +1,9 @@
+import bson
 import mock
+import pytest
 
-from  api.dao.dbutil import paginate_find
+from  api.dao.dbutil import paginate_find, paginate_pipe, PaginationError
+from api.util import parse_pagination_cursor
 
 def test_paginate_find_with_filter_in_both_arguments_findwkargs_win():
 
@@ -29,3 +32,94 @@ def test_paginate_find_with_filter_in_both_merges():
     mock_collection = mock.MagicMock()
     paginate_find(mock_collection, find_kwargs, pagination)
     mock_collection.find.assert_called_with(filter=expected_filter)
+
+def test_paginate_find_total_optional():
+    mock_collection = mock.MagicMock()
+    page = paginate_find(mock_collection, {}, {'limit': 10, 'total': False})
+    assert 'total' not in page
+    mock_collection.find.return_value.count.assert_not_called()
+
+    page = paginate_find(mock_collection, {}, {'limit': 10})
+    assert page['total'] == mock_collection.find.return_value.count.return_value
+
+def _cursor_pages(collection, pagination, paginate=paginate_find):
+    """Return the pages fetched by following the cursors from the first page"""
+    pages = []
+    cursor = None
+    while True:
+        page_pagination = dict(pagination, cursor=parse_pagination_cursor(cursor or ''))
+        if cursor:
+            page_pagination.pop('sort', None)
+        page = paginate(collection, {}, page_pagination)
+        pages.append(page)
+        cursor = page['next_cursor']
+        if not cursor:
+            return pages
+
+def test_paginate_find_cursor(api_db):
+    docs = [{'_id': bson.ObjectId(), 'label': 'cursor-doc', 'rank': i % 3} for i in range(7)]
+    api_db.pagination_test.insert_many(docs)
+
+    pages = _cursor_pages(api_db.pagination_test, {'filter': {'label': 'cursor-doc'}, 'sort': [('rank', -1)], 'limit': 3,
+                                                   'total': False})
+    assert [len(page['results']) for page in pages] == [3, 3, 1]
+    expected = sorted(docs, key=lambda doc: (-doc['rank'], doc['_id']))
+    assert [doc['_id'] for page in pages for doc in page['results']] == [doc['_id'] for doc in expected]
+    assert all('total' not in page for page in pages)
+
+    pages = _cursor_pages(api_db.pagination_test, {'filter': {'label': 'cursor-doc'}, 'limit': 5, 'total': True})
+    assert [page['total'] for page in pages] == [7, 7]
+    assert [doc['_id'] for page in pages for doc in page['results']] == sorted(doc['_id'] for doc in docs)
+
+    # Cursors from another sort are rejected
+    cursor = parse_pagination_cursor(pages[0]['next_cursor'])
+    cursor['after'].append(1)
+    with pytest.raises(PaginationError):
+        paginate_find(api_db.pagination_test, {}, {'cursor': cursor, 'total': False})
+
+    api_db.pagination_test.drop()
+
+def test_paginate_pipe_cursor(api_db):
+    docs = [{'_id': bson.ObjectId(), 'label': 'cursor-doc', 'rank': i % 3} for i in range(7)]
+    api_db.pagination_test.insert_many(docs)
+
+    def paginate(collection, _, pagination):
+        pagination['pipe_key'] = lambda key: 'original.' + key
+        pipeline = [{'$match': {'label': 'cursor-doc'}}, 
+                    {'$project': {'original': {'_id': '$_id', 'rank': '$rank'}}}]
+        return paginate_pipe(collection, pipeline, pagination)
+
+    pages = _cursor_pages(api_db.pagination_test, {'sort': [('rank', 1)], 'limit': 4, 'total': True}, paginate=paginate)
+    assert [page['total'] for page in pages] == [7, 7]
+    expected = sorted(docs, key=lambda doc: (doc['rank'], doc['_id']))
+    assert [r['original']['_id'] for page in pages for r in page['results']] == [doc['_id'] for doc in expected]
+
+    # Skip and limit without the total
+    page = paginate_pipe(api_db.pagination_test, [{'$sort': {'_id': 1}}], {'skip': 5, 'total': False})
+    assert page == {'results': sorted(docs, key=lambda doc: doc['_id'])[5:]}
+
+    api_db.pagination_test.drop()
+
+def test_paginate_find_cursor_missing_values(api_db):
+    docs = [{'_id': bson.ObjectId(), 'label': 'cursor-doc'} for i in range(7)]
+    for doc, rank in zip(docs, [2, None, 1, None, 2, None, None]):
+        if rank is not None:
+            doc['rank'] = rank
+    api_db.pagination_test.insert_many(docs)
+
+    # Missing values sort before all others
+    for order in (1, -1):
+        pages = _cursor_pages(api_db.pagination_test, {'filter': {'label': 'cursor-doc'}, 'sort': [('rank', order)],
+                                                       'limit': 2, 'total': False})
+        ranked = sorted(sorted(docs, key=lambda doc: doc['_id']),
+                        key=lambda doc: (doc.get('rank') is not None, doc.get('rank')), reverse=order == -1)
+        assert [doc['_id'] for page in pages for doc in page['results']] == [doc['_id'] for doc in ranked]
+
+    api_db.pagination_test.drop()
+
+def test_cursor_requires_pagination_feature(as_admin):
+    r = as_admin.get('/jobs?cursor=')
+    assert r.status_code == 422
+    r = as_admin.get('/jobs?cursor=', headers={'X-Accept-Feature': 'pagination'})
+    assert r.ok
+    assert 'next_cursor' in r.json
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+import mock
+
+from api.metrics import profiler
+from api.metrics.request_wrapper import RequestWrapper
+
+
+def busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(100))
+
+
+def test_profile_session(config):
+    session = profiler.start()
+    busy_loop(0.2)
+    profiler.stop(session)
+    assert not profiler._timer_running
+
+    collapsed = session.collapsed()
+    assert 'busy_loop ({}'.format(__file__.rstrip('c')) in collapsed
+    for line in collapsed.splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+        assert stack.split(';')[-1]
+
+    # Sessions with a deadline stop themselves, outside of the signal handler
+    finished = []
+    def on_finish(session):
+        finished.append(threading.current_thread())
+    profiler.start(0.05, on_finish=on_finish)
+    busy_loop(0.2)
+    assert len(finished) == 1
+    assert finished[0] is not threading.current_thread()
+    assert not profiler._timer_running
+
+    # The deadline is wall-clock time, enforced without any samples
+    session = profiler.start(0.05, on_finish=on_finish)
+    time.sleep(0.2)
+    assert len(finished) == 2
+    assert session.finished
+    assert not profiler._timer_running
+
+
+def test_slow_request_profile(config, mocker, tmpdir):
+    threshold = mocker.patch('api.metrics.profiler.slow_request_threshold', return_value=0.1)
+    mocker.patch('api.metrics.profiler.profile_path', return_value=str(tmpdir))
+    request = mock.MagicMock(id='slow-request')
+    with RequestWrapper(request, None):
+        busy_loop(0.2)
+    with RequestWrapper(mock.MagicMock(id='fast-request'), None):
+        pass
+    threshold.return_value = 0
+    profiler._update_timer()
+    assert not profiler._timer_running
+
+    assert os.listdir(str(tmpdir)) == ['slow-request.folded']
+    assert 'busy_loop' in tmpdir.join('slow-request.folded').read()
+    assert request.logger.warning.called
+
+
+def test_profile_endpoint(as_admin, as_user):
+    r = as_user.get('/profile?seconds=0.1')
+    assert r.status_code == 403
+
+    r = as_admin.get('/profile?seconds=1000')
+    assert r.status_code == 400
+
+    r = as_admin.get('/profile?seconds=0.1')
+    assert r.ok
+    assert r.headers['Content-Type'].startswith('text/plain')
+    assert not profiler._timer_running
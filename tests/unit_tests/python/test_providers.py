@@ -323,6 +323,29 @@ def test_provider_repository_load(api_db):
         api_db.providers.remove({'_id': cid})
         api_db.providers.remove({'_id': sid})
 
+def test_provider_repository_cache(api_db, mocker):
+    storage_provider = _make_storage_provider()
+    sid = mappers.Providers().insert(storage_provider)
+    spy_get = mocker.spy(mappers.Providers, 'get')
+
+    try:
+        # Loaded once, then served from the cache
+        result = providers.get_provider(sid)
+        result2 = providers.get_provider(str(sid))
+        providers.validate_provider_class(sid, 'storage')
+        assert spy_get.call_count == 1
+
+        # Callers get separate models which share the storage plugin
+        assert result is not result2
+        assert result.storage_plugin is result2.storage_plugin
+        assert providers.get_provider(sid, secure=True).storage_plugin is result.storage_plugin
+
+        # Updates invalidate the cache
+        providers.update_provider(sid, {'label': 'New Label'})
+        assert providers.get_provider(sid).label == 'New Label'
+    finally:
+        api_db.providers.remove({'_id': sid})
+
 def test_validate_provider_updates(api_db):
     compute_provider = _make_compute_provider()
     compute_provider2 = _make_compute_provider()
@@ -0,0 +1,36 @@
+import mock
+
+from api.metrics import values
+from api.metrics.request_wrapper import RequestWrapper
+
+
+def _histogram_counts(histogram, *labels):
+    return [bucket.get() for bucket in histogram.labels(*labels)._buckets]
+
+
+def test_histogram_buckets(mocker):
+    mocker.patch.dict('os.environ', {'SCITRAN_METRICS_TEST_BUCKETS': '1,0.5,10'})
+    assert values._buckets('SCITRAN_METRICS_TEST_BUCKETS', (1, float('inf'))) == (0.5, 1.0, 10.0, float('inf'))
+    assert values._buckets('SCITRAN_METRICS_MISSING_BUCKETS', (1, float('inf'))) == (1, float('inf'))
+
+
+def test_request_histograms(config):
+    request = mock.MagicMock(method='POST', content_length=2048)
+    request.route.template = '/api/histogram/<cid>'
+    response = mock.MagicMock()
+    labels = ['POST', '/api/histogram/<cid>']
+
+    time_counts = _histogram_counts(values.RESPONSE_TIME_HISTOGRAM, *labels)
+    request_counts = _histogram_counts(values.REQUEST_SIZE_HISTOGRAM, *labels)
+    response_counts = _histogram_counts(values.RESPONSE_SIZE_HISTOGRAM, *labels)
+
+    with RequestWrapper(request, response):
+        response.write('x' * 500)
+
+    assert sum(_histogram_counts(values.RESPONSE_TIME_HISTOGRAM, *labels)) == sum(time_counts) + 1
+
+    # Sizes land in their buckets (100, 1000, 10000, ...)
+    request_counts[values.BODY_SIZE_BUCKETS.index(10000)] += 1
+    assert _histogram_counts(values.REQUEST_SIZE_HISTOGRAM, *labels) == request_counts
+    response_counts[values.BODY_SIZE_BUCKETS.index(1000)] += 1
+    assert _histogram_counts(values.RESPONSE_SIZE_HISTOGRAM, *labels) == response_counts
@@ -2,6 +2,7 @@ import pytest
 import pymongo
 import bson
 
+from api.dao import containerutil
 from api.jobs import rules, models, mappers
 from api.web import errors
 
@@ -683,3 +684,152 @@ def test_rules_mapper_delete_rule_that_does_not_exist(api_db):
     deleted_count = rules_mapper.delete(bson.ObjectId())
     assert deleted_count == 0
 
+
+
+def test_compiled_rule_set_candidates():
+    def rule(name, all_=None, any_=None):
+        return models.Rule('gear_id', name, any_ or [], all_ or [], [])
+
+    rule_set = rules.CompiledRuleSet([
+        rule('by_type', all_=[{'type': 'file.type', 'value': 'DICOM'}, {'type': 'file.name', 'value': '*.zip'}]),
+        rule('by_classification', all_=[{'type': 'file.classification', 'value': 'Functional'}]),
+        rule('by_name', all_=[{'type': 'file.name', 'value': '*.dcm'}]),
+        rule('by_regex', all_=[{'type': 'file.type', 'value': 'nifti|dicom', 'regex': True}]),
+        rule('by_any', any_=[{'type': 'file.type', 'value': 'dicom'}]),
+    ])
+
+    def candidates(file_):
+        return [compiled.rule.name for compiled in rule_set.candidates(file_)]
+
+    # Indexed rules are candidates only for files they can match, in rule order
+    assert candidates({'name': 'a.zip', 'type': 'dicom'}) == ['by_type', 'by_regex', 'by_any']
+    assert candidates({'name': 'a.DCM', 'classification': {'Intent': ['functional']}}) == [
+        'by_classification', 'by_name', 'by_regex', 'by_any']
+    assert candidates({'name': 'a.txt'}) == ['by_regex', 'by_any']
+
+    # Candidates still have to match
+    container = {'files': []}
+    file_ = {'name': 'a.txt', 'type': 'dicom'}
+    assert [c.rule.name for c in rule_set.candidates(file_) if c.matches(file_, container)] == ['by_regex', 'by_any']
+
+
+def test_get_compiled_rules(api_db):
+    rules_mapper = mappers.RulesMapper(db=api_db)
+    project_id = str(bson.ObjectId())
+
+    rule_set = rules.get_compiled_rules(api_db, project_id)
+    assert rule_set.rules == []
+
+    rule = models.Rule.from_dict({
+        'project_id': project_id,
+        'name': 'compiled_rule',
+        'any': [],
+        'all': [{'type': 'file.type', 'value': 'dicom'}],
+        'not': [],
+        'gear_id': 'gear_id',
+    })
+    rules_mapper.insert(rule)
+
+    # Adding a rule recompiles
+    rule_set = rules.get_compiled_rules(api_db, project_id)
+    assert [compiled.rule.name for compiled in rule_set.rules] == ['compiled_rule']
+
+    # Unchanged rules are not recompiled
+    assert rules.get_compiled_rules(api_db, project_id) is rule_set
+
+    # Changing a rule recompiles
+    rules_mapper.patch(rule.rule_id, {'disabled': True})
+    assert rules.get_compiled_rules(api_db, project_id).rules == []
+
+    # Clean Up
+    assert rules_mapper.delete(rule.rule_id) == 1
+    api_db.rule_revisions.delete_one({'_id': project_id})
+
+
+def test_get_changed_files():
+    files_before = [
+        {'name': 'same.txt', 'type': 'text'},
+        {'name': 'modified.txt', 'type': 'text'},
+        {'name': 'removed.txt'},
+    ]
+    files_after = [
+        {'name': 'same.txt', 'type': 'text'},
+        {'name': 'modified.txt', 'type': 'text', 'classification': {'Intent': ['Functional']}},
+        {'name': 'added.txt'},
+    ]
+
+    assert rules.get_changed_files(files_before, files_after) == {'modified.txt', 'removed.txt', 'added.txt'}
+    assert rules.get_changed_files(files_before, files_before) == set()
+
+
+def test_create_potential_jobs_with_broken_rules(api_db):
+    # Cold cache: the rules are compiled during evaluation
+    rules._compiled_rule_sets.clear()
+    project_id = bson.ObjectId()
+    api_db.project_rules.insert_many([
+        {'project_id': str(project_id), 'name': 'invalid_regex', 'gear_id': 'gear_id', 'any': [], 'not': [],
+         'all': [{'type': 'file.type', 'value': '[', 'regex': True}]},
+        {'project_id': str(project_id), 'name': 'null_name', 'gear_id': 'gear_id', 'any': [], 'not': [],
+         'all': [{'type': 'file.name', 'value': None}]},
+        {'project_id': str(project_id), 'name': 'not_matching', 'gear_id': 'gear_id', 'any': [], 'not': [],
+         'all': [{'type': 'file.type', 'value': 'nifti'}]},
+    ])
+
+    failures = []
+    container = {'_id': project_id, 'files': [{'name': 'a.dcm', 'type': 'dicom'}]}
+    jobs = rules.create_potential_jobs(api_db, container, 'project', container['files'][0],
+                                       rule_failure_callback=lambda rule, exc: failures.append(rule['name']))
+
+    # Broken rules are reported, the others are still evaluated
+    assert jobs == []
+    assert sorted(failures) == ['invalid_regex', 'null_name']
+    rule_set = rules.get_compiled_rules(api_db, str(project_id))
+    assert [bool(compiled.errors) for compiled in rule_set.rules] == [True, True, False]
+
+    api_db.project_rules.delete_many({'project_id': str(project_id)})
+
+
+def test_create_jobs_for_unchanged_files(api_db, mocker):
+    enqueue = mocker.patch('api.jobs.rules.Queue.enqueue_job')
+    project_id = bson.ObjectId()
+    gear_ids = {
+        'container-gear': str(api_db.gears.insert_one({'gear': {
+            'name': 'container-gear', 'version': '0.0.1', 'config': {},
+            'inputs': {'file': {'base': 'file'}}}}).inserted_id),
+        'fixed-gear': str(api_db.gears.insert_one({'gear': {
+            'name': 'fixed-gear', 'version': '0.0.1', 'config': {},
+            'inputs': {'file': {'base': 'file'}, 'fixed': {'base': 'file'}}}}).inserted_id),
+    }
+    api_db.project_rules.insert_many([
+        {'project_id': str(project_id), 'name': 'container_dependent', 'gear_id': gear_ids['container-gear'],
+         'any': [], 'not': [],
+         'all': [{'type': 'file.type', 'value': 'nifti'}, {'type': 'container.has-type', 'value': 'dicom'}]},
+        {'project_id': str(project_id), 'name': 'fixed_input', 'gear_id': gear_ids['fixed-gear'],
+         'any': [], 'not': [], 'all': [{'type': 'file.type', 'value': 'nifti'}],
+         'fixed_inputs': [{'input': 'fixed', 'type': 'project', 'id': str(project_id), 'name': 'fixed.txt'}]},
+    ])
+    nifti = {'name': 'a.nii', 'type': 'nifti'}
+    fixed = {'name': 'fixed.txt', 'type': 'text'}
+    dicom = {'name': 'b.dcm', 'type': 'dicom'}
+
+    def create_jobs(files_before, files_after, changed_files, replaced_files=None):
+        enqueue.reset_mock()
+        spawned = rules.create_jobs(api_db, {'_id': project_id, 'files': files_before},
+                                    {'_id': project_id, 'files': files_after}, 'project',
+                                    replaced_files=replaced_files, changed_files=changed_files)
+        return sorted(api_db.gears.find_one({'_id': bson.ObjectId(gear_id)})['gear']['name'] for gear_id in spawned)
+
+    # Adding a file of another type triggers the container dependent rule for the unchanged nifti file
+    assert create_jobs([nifti, fixed], [nifti, fixed, dicom], ['b.dcm']) == ['container-gear']
+    assert enqueue.call_count == 1
+
+    # Replacing the fixed input re-triggers the rule for the unchanged nifti file
+    replaced = [containerutil.FileReference(type='project', id=str(project_id), name='fixed.txt')]
+    assert create_jobs([nifti, fixed], [nifti, dict(fixed, modified=True)], ['fixed.txt'], replaced) == ['fixed-gear']
+
+    # Unchanged files are not evaluated otherwise
+    assert create_jobs([nifti, fixed, dicom], [nifti, dict(fixed, modified=True), dicom], ['fixed.txt']) == []
+    assert enqueue.call_count == 0
+
+    api_db.project_rules.delete_many({'project_id': str(project_id)})
+    api_db.gears.delete_many({'_id': {'$in': [bson.ObjectId(gear_id) for gear_id in gear_ids.values()]}})
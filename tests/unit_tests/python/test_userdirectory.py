@@ -0,0 +1,74 @@
+import datetime
+
+from api.dao import userdirectory
+from api.dao.basecontainerstorage import ContainerStorage
+from api.dao.containerstorage import UserStorage
+
+
+def insert_user(api_db, uid, firstname, modified=None):
+    api_db.users.insert_one({
+        '_id': uid, 'firstname': firstname, 'lastname': 'User', 'email': uid,
+        'avatar': 'https://avatar/' + uid, 'modified': modified or datetime.datetime.utcnow(),
+    })
+
+
+def test_join_avatars(api_db, mocker):
+    userdirectory.invalidate()
+    insert_user(api_db, 'joined@user.com', 'Joined')
+    insert_user(api_db, 'noted@user.com', 'Noted')
+    insert_user(api_db, 'unreferenced@user.com', 'Unreferenced')
+
+    containers = [{
+        'label': 'Joined',
+        'permissions': [{'_id': 'joined@user.com', 'access': 'admin'}, {'_id': 'missing@user.com', 'access': 'ro'}],
+        'notes': [{'_id': 'note', 'user': 'noted@user.com', 'text': 'note'}],
+    }]
+    find = mocker.spy(api_db.users, 'find')
+    ContainerStorage.join_avatars(containers)
+    assert containers[0]['permissions'][0]['firstname'] == 'Joined'
+    assert containers[0]['permissions'][0]['avatar'] == 'https://avatar/joined@user.com'
+    assert 'firstname' not in containers[0]['permissions'][1]
+    assert containers[0]['notes'][0]['firstname'] == 'Noted'
+    # Only the referenced users are read
+    assert find.call_count == 1
+    assert sorted(find.call_args[0][0]['_id']['$in']) == ['joined@user.com', 'missing@user.com', 'noted@user.com']
+
+    # The next join is served from the directory
+    ContainerStorage.join_avatars([{'label': 'Cached', 'permissions': [{'_id': 'joined@user.com'}]}])
+    assert find.call_count == 1
+
+    api_db.users.delete_many({'_id': {'$in': ['joined@user.com', 'noted@user.com', 'unreferenced@user.com']}})
+
+
+def test_user_directory_refresh(api_db, mocker):
+    userdirectory.invalidate()
+    now = [1000.0]
+    mocker.patch('api.dao.userdirectory.time.time', side_effect=lambda: now[0])
+    insert_user(api_db, 'refreshed@user.com', 'Before', modified=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+
+    assert userdirectory.get_users(['refreshed@user.com'])['refreshed@user.com']['firstname'] == 'Before'
+
+    # Modified users are read again on the next refresh
+    api_db.users.update_one({'_id': 'refreshed@user.com'},
+                            {'$set': {'firstname': 'After', 'modified': datetime.datetime.utcnow()}})
+    assert userdirectory.get_users(['refreshed@user.com'])['refreshed@user.com']['firstname'] == 'Before'
+    now[0] += userdirectory.REFRESH_SECONDS
+    assert userdirectory.get_users(['refreshed@user.com'])['refreshed@user.com']['firstname'] == 'After'
+
+    # Deleted users are gone once their entry expires
+    api_db.users.delete_one({'_id': 'refreshed@user.com'})
+    assert 'refreshed@user.com' in userdirectory.get_users(['refreshed@user.com'])
+    now[0] += userdirectory.MAX_AGE_SECONDS
+    assert userdirectory.get_users(['refreshed@user.com']) == {}
+
+
+def test_user_storage_invalidates_directory(api_db):
+    userdirectory.invalidate()
+    insert_user(api_db, 'invalidated@user.com', 'Before')
+    assert userdirectory.get_users(['invalidated@user.com'])['invalidated@user.com']['firstname'] == 'Before'
+
+    UserStorage().update_el('invalidated@user.com', {'firstname': 'After'})
+    assert userdirectory.get_users(['invalidated@user.com'])['invalidated@user.com']['firstname'] == 'After'
+
+    UserStorage().delete_el('invalidated@user.com')
+    assert userdirectory.get_users(['invalidated@user.com']) == {}
@@ -146,3 +146,21 @@ def test_parse_pagination_filter_param():
         util.parse_pagination_filter_param('label') == {}
     with pytest.raises(util.PaginationParseError):
         util.parse_pagination_filter_param('') == {}
+
+def test_pagination_cursor():
+    oid = bson.ObjectId()
+    created = datetime(2019, 5, 22, 12, 30)
+    cursor = util.encode_pagination_cursor([('created', -1)], [created, oid])
+    assert '=' not in cursor
+    assert util.parse_pagination_cursor(cursor) == {'sort': [('created', -1)], 'after': [created, oid]}
+    assert util.parse_pagination_cursor('') is None
+    with pytest.raises(util.PaginationParseError):
+        util.parse_pagination_cursor('not-a-cursor')
+    with pytest.raises(util.PaginationParseError):
+        util.parse_pagination_cursor(util.encode_pagination_cursor([('created', 2)], [created]))
+
+def test_parse_pagination_bool_param():
+    assert util.parse_pagination_bool_param('true') is True
+    assert util.parse_pagination_bool_param('False') is False
+    with pytest.raises(util.PaginationParseError):
+        util.parse_pagination_bool_param('1')
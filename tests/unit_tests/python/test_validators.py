@@ -5,6 +5,7 @@ import pytest
 import fnmatch, json, os, os.path, re
 
 from api import config, validators
+from api.web.errors import InputValidationException
 
 log = logging.getLogger(__name__)
 sh = logging.StreamHandler()
@@ -78,6 +79,34 @@ def test_file_output_invalid():
     with pytest.raises(jsonschema.exceptions.ValidationError):
         validators._validate_json(payload, schema, resolver)
 
+def test_schema_registry():
+    assert validators.load_schemas() > 0
+    stats = validators.get_registry_stats()
+    assert stats['validators'] >= stats['schemas'] > 0
+
+    # Compiled validators are reused
+    schema_uri = validators.schema_uri('input', 'project.json')
+    post_validator, post_lock = validators.get_validator(schema_uri, 'POST')
+    stats = validators.get_registry_stats()
+    assert validators.get_validator(schema_uri, 'POST')[0] is post_validator
+    stats_ = validators.get_registry_stats()
+    assert stats_['hits'] == stats['hits'] + 1
+    assert stats_['saved_seconds'] > stats['saved_seconds']
+    assert stats_['compile_seconds'] == stats['compile_seconds']
+
+    # POST and PUT validators share the schema's resolver, and so its lock
+    put_validator, put_lock = validators.get_validator(schema_uri, 'PUT')
+    assert put_validator is not post_validator
+    assert put_validator.resolver is post_validator.resolver
+    assert put_lock is post_lock
+
+    # PUT validators ignore required properties
+    with pytest.raises(InputValidationException):
+        validators.validate_data({}, 'project.json', 'input', 'POST')
+    validators.validate_data({}, 'project.json', 'input', 'PUT')
+    with pytest.raises(InputValidationException):
+        validators.validate_data({'label': 1}, 'project.json', 'input', 'PUT')
+
 def test_jsonschema_validate_enum_with_null():
     schema = {
         'oneOf': [